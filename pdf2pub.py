@@ -1,14 +1,27 @@
 #!/usr/bin/env python
 
 from lxml import etree
-from subprocess import Popen, PIPE
-import sys, math, itertools
+import sys, os, re, math, itertools, collections, cProfile
 
 import inkex
 from simplestyle import *
 from simpletransform import *
 from simplepath import *
 
+from pdf2pub_geometry import query_all, query_inkscape, compare_queries, shell_pool
+from pdf2pub_geometry import QueryCache, default_cache_dir
+from pdf2pub_geometry import path_endpoints, find_axes, find_frame, split_grid, parse_query
+from pdf2pub_geometry import split_axes, locate, element_transform, transform_box, identity
+from pdf2pub_traces import merge_segments, decimate_paths, clip_paths, instance_markers
+from pdf2pub_output import compact_document, merge_duplicates, collect_garbage, find_equal
+from pdf2pub_output import precision_decimals
+from pdf2pub_images import resample_images
+from pdf2pub_raster import count_points, rasterize
+from pdf2pub_analysis import read_analysis, write_analysis, restore_elements
+from pdf2pub_analysis import changed_sections, section_options, element_ids
+from pdf2pub_analysis import analysis_report, write_report
+from pdf2pub_stats import Stages
+
 
 # General presets
 arrow_stroke_width = '0.8'
@@ -17,9 +30,298 @@ legend_entry_sep = 18 - 1.5
 legend_font_size = 10   # pt!
 
 
+class Pdf2pubError(Exception):
+    """Error that stops the processing of a figure"""
+    pass
+
+
 def stop(msg="Error!"):
-    inkex.errormsg(msg)
-    sys.exit(0)
+    raise Pdf2pubError(msg)
+
+
+class StyleCache:
+    """Parsed styles shared by all elements with the same style string
+
+    Each distinct style string is parsed once. Parsed styles are shared and
+    must not be modified: changes are recorded with update() and written
+    back to the elements, once per element, by commit().
+    """
+    def __init__(self):
+        """Constructor"""
+        self.parsed = {}
+        self.formatted = {}
+        self.pending = {}
+        self.order = []
+
+    def parse(self, style):
+        """Return the (shared) parsed style for a style string"""
+        try:
+            return self.parsed[style]
+        except KeyError:
+            self.parsed[style] = parseStyle(style)
+            return self.parsed[style]
+
+    def get(self, element):
+        """Return the parsed style of element (without pending changes)"""
+        return self.parse(element.get('style'))
+
+    def update(self, element, changes):
+        """Record changes, a list of (property, value), to element's style"""
+        if element not in self.pending:
+            self.pending[element] = []
+            self.order.append(element)
+        self.pending[element].extend(changes)
+
+    def commit(self):
+        """Write all pending changes back to the document"""
+        for element in self.order:
+            style = element.get('style')
+            changes = tuple(self.pending[element])
+
+            # Elements sharing a style and changes share the result
+            key = (style, changes)
+            if key not in self.formatted:
+                element_style = dict(self.parse(style))
+                for (name, value) in changes:
+                    element_style[name] = value
+                self.formatted[key] = formatStyle(element_style)
+
+            element.set('style', self.formatted[key])
+
+        self.pending = {}
+        self.order = []
+
+
+def make_classes(groups):
+    """Move style properties shared by groups of elements to CSS classes
+
+    groups is a list of (class name, elements). The properties that all
+    elements of a group have in common are removed from their inline styles
+    and the class is added to them. Returns the rules [(class name, style)]
+    of the corresponding style sheet.
+    """
+    rules = []
+    for (name, elements) in groups:
+        if len(elements) == 0:
+            continue
+
+        parsed = {}
+        for element in elements:
+            if element.get('style') not in parsed:
+                parsed[element.get('style')] = parseStyle(element.get('style'))
+
+        common = None
+        for style in parsed.values():
+            if common is None:
+                common = dict(style)
+            else:
+                common = dict([(prop, value) for (prop, value) in common.items()
+                               if style.get(prop) == value])
+        if not common:
+            continue
+
+        # Elements sharing a style share the inline rest
+        inline = {}
+        for element in elements:
+            style = element.get('style')
+            if style not in inline:
+                inline[style] = formatStyle(dict([(prop, value) for (prop, value)
+                                                  in parsed[style].items() if prop not in common]))
+
+            if inline[style]:
+                element.set('style', inline[style])
+            else:
+                del element.attrib['style']
+            element.set('class', ' '.join(element.get('class', '').split() + [name]))
+
+        rules.append((name, common))
+
+    return rules
+
+
+def inline_classes(root_node, sheet_id):
+    """Undo make_classes for the style sheet with id sheet_id
+
+    The properties of its rules go back to the inline styles of the
+    elements of its classes (inline properties still take precedence),
+    the classes are removed from the elements, and so is the sheet.
+    """
+    sheets = [node for node in root_node.iter(inkex.addNS('style', 'svg'), 'style')
+              if node.get('id') == sheet_id]
+    if len(sheets) == 0:
+        return
+
+    rules = {}
+    for (name, body) in re.findall(r'\.([-\w]+)\s*\{([^}]*)\}', sheets[0].text or ''):
+        rules[name] = parseStyle(body)
+
+    for element in root_node.iter():
+        if not isinstance(element.tag, str) or element.get('class') is None:
+            continue
+        names = element.get('class').split()
+        if not any([name in rules for name in names]):
+            continue
+
+        style = {}
+        for name in names:
+            style.update(rules.get(name, {}))
+        style.update(parseStyle(element.get('style', '')))
+        element.set('style', formatStyle(style))
+
+        names = [name for name in names if name not in rules]
+        if names:
+            element.set('class', ' '.join(names))
+        else:
+            del element.attrib['class']
+
+    sheets[0].getparent().remove(sheets[0])
+
+
+def get_defs(root_node):
+    """Return the <defs> node of the document, creating it if needed"""
+    defs_nodes = root_node.xpath('//svg:defs', namespaces=inkex.NSS)
+    if len(defs_nodes) == 0:
+        defs_nodes = [etree.Element(inkex.addNS('defs', 'svg'))]
+        root_node.insert(0, defs_nodes[0])
+
+    return defs_nodes[0]
+
+
+def style_matches(element_style, style_find):
+    """Check if element_style has all properties of style_find"""
+    return all([element_style.get(style, '').lower() == style_find[style].lower()
+                for style in style_find.keys()])
+
+
+def find_labels(root_node, tspans):
+    """Texts (x-axis label, y-axis label) of the axis labels
+
+    tspans lists the positions (id, x, y) of <tspan> elements. The x-axis
+    label is the lowest one and the y-axis label the leftmost one. Returns
+    None if they cannot be found.
+    """
+    xlab_id = None
+    xlab_pos = 0
+    ylab_id = None
+    ylab_pos = float('inf')
+    for (tspan_id, x, y) in tspans:
+        if xlab_pos <= y:
+            xlab_pos = y
+            xlab_id = tspan_id
+
+        if ylab_pos >= x:
+            ylab_pos = x
+            ylab_id = tspan_id
+
+    if (xlab_id is None) or (ylab_id is None):
+        return None
+
+    xlab_text = [element.text for element in
+        root_node.xpath('//svg:tspan[@id="%s"]' % xlab_id, namespaces=inkex.NSS)]
+    ylab_text = [element.text for element in
+        root_node.xpath('//svg:tspan[@id="%s"]' % ylab_id, namespaces=inkex.NSS)]
+    if (len(xlab_text) != 1) or (len(ylab_text) != 1):
+        return None
+
+    return (xlab_text[0], ylab_text[0])
+
+
+def classify_elements(root_node, bbox_style_find, grid_style_find, styles):
+    """Sort document elements in a single traversal
+
+    Returns (deleted, removed, bbox, grid, curves_stroke, curves_fill):
+    removed lists the elements to remove during clean up and deleted holds
+    their ids (and those of clip path children). bbox and grid list the
+    bounding box and grid paths, and curves_stroke/curves_fill group the
+    remaining styled elements by stroke/fill color. Styles are parsed
+    through styles (a StyleCache).
+    """
+    svg_ns = '{%s}' % inkex.NSS['svg']
+    path_tag = inkex.addNS('path', 'svg')
+    g_tag = inkex.addNS('g', 'svg')
+    clippath_tag = inkex.addNS('clipPath', 'svg')
+    text_tag = inkex.addNS('text', 'svg')
+
+    deleted = set()
+    removed = []
+    bbox = []
+    grid = []
+    curves_stroke = {}
+    curves_fill = {}
+
+    def classify(element, element_style):
+        if element.tag == path_tag and style_matches(element_style, bbox_style_find):
+            bbox.append(element)
+        elif element.tag == path_tag and style_matches(element_style, grid_style_find):
+            grid.append(element)
+        else:
+            stroke = element_style.get('stroke', 'none')
+            if stroke != 'none':
+                curves_stroke.setdefault(stroke, []).append(element)
+
+            fill = element_style.get('fill', 'none')
+            if fill != 'none':
+                curves_fill.setdefault(fill, []).append(element)
+
+    # Elements whose subtree is removed along with them
+    skipped = set()
+    # White elements (and layers containing only white elements)
+    blank = set()
+    groups = []
+
+    for element in root_node.iter():
+        if not isinstance(element.tag, str):
+            continue
+
+        if element.getparent() in skipped:
+            skipped.add(element)
+            continue
+
+        if element.tag == clippath_tag:
+            # Clip paths have path nodes below that we'll need to ignore later
+            removed.append(element)
+            deleted.add(element.get('id'))
+            deleted.update([child.get('id') for child in element])
+            skipped.add(element)
+            continue
+
+        if element.tag == text_tag:
+            removed.append(element)
+            deleted.add(element.get('id'))
+            skipped.add(element)
+            continue
+
+        if element.tag == g_tag:
+            # Layers are classified once we know whether they are empty
+            groups.append(element)
+            continue
+
+        if element.get('style') is None or not element.tag.startswith(svg_ns):
+            continue
+
+        element_style = styles.get(element)
+        if element.tag == path_tag:
+            obj_fill = element_style.get('fill')
+            obj_stroke = element_style.get('stroke')
+            if ((obj_fill == '#ffffff' and obj_stroke == 'none') or
+                    (obj_fill == 'none' and obj_stroke == '#ffffff')):
+                removed.append(element)
+                deleted.add(element.get('id'))
+                blank.add(element)
+                continue
+
+        classify(element, element_style)
+
+    # Going backwards, inner layers are handled before outer ones
+    for element in reversed(groups):
+        if all([child in blank for child in element]):
+            removed.append(element)
+            deleted.add(element.get('id'))
+            blank.add(element)
+        elif element.get('style') is not None:
+            classify(element, styles.get(element))
+
+    return (deleted, removed, bbox, grid, curves_stroke, curves_fill)
 
 
 class pdf2pub(inkex.Effect):
@@ -58,6 +360,9 @@ class pdf2pub(inkex.Effect):
         self.OptionParser.add_option('--elements_dict', action='store',
                                      type='string', dest='elements_dict',
                                      default='true', help='Legend and additional elements')
+        self.OptionParser.add_option('--multi_axes', action='store',
+                                     type='string', dest='multi_axes',
+                                     default='false', help='Format each axes of subplots')
 
         # Custom options
         self.OptionParser.add_option('--width', action='store',
@@ -88,6 +393,464 @@ class pdf2pub(inkex.Effect):
                                      type='string', dest='grid_style',
                                      default='stroke:#dfdfdf;stroke-width:0.4px', help='Grid style')
 
+        # Advanced options
+        self.OptionParser.add_option('--geometry', action='store',
+                                     type='string', dest='geometry',
+                                     default='python', help='Geometry engine (python, inkscape, shell, or check)')
+        self.OptionParser.add_option('--shell_pool_size', action='store',
+                                     type='int', dest='shell_pool_size',
+                                     default=1, help='Number of Inkscape shell workers')
+        self.OptionParser.add_option('--shell_timeout', action='store',
+                                     type='int', dest='shell_timeout',
+                                     default=60, help='Inkscape shell query timeout (s)')
+        self.OptionParser.add_option('--cache', action='store',
+                                     type='string', dest='cache',
+                                     default='true', help='Cache geometry queries')
+        self.OptionParser.add_option('--cache_dir', action='store',
+                                     type='string', dest='cache_dir',
+                                     default='', help='Geometry cache directory')
+        self.OptionParser.add_option('--cache_size', action='store',
+                                     type='int', dest='cache_size',
+                                     default=64, help='Geometry cache size (MB)')
+        self.OptionParser.add_option('--stream', action='store',
+                                     type='string', dest='stream',
+                                     default='false', help='Stream large documents (batch processing)')
+        self.OptionParser.add_option('--incremental', action='store',
+                                     type='string', dest='incremental',
+                                     default='false', help='Store the analysis for quick re-runs')
+        self.OptionParser.add_option('--analyze_only', action='store',
+                                     type='string', dest='analyze_only',
+                                     default='false', help='Only report what is detected (JSON, no output)')
+        self.OptionParser.add_option('--report', action='store',
+                                     type='string', dest='report',
+                                     default='', help='Analysis report file (default: standard output)')
+        self.OptionParser.add_option('--stats', action='store',
+                                     type='string', dest='stats',
+                                     default='', help='Stage statistics JSON file (-: standard error)')
+        self.OptionParser.add_option('--profile', action='store',
+                                     type='string', dest='profile',
+                                     default='', help='cProfile statistics file')
+
+        # Trace options
+        self.OptionParser.add_option('--clip_traces', action='store',
+                                     type='string', dest='clip_traces',
+                                     default='true', help='Clip traces to the bounding box')
+        self.OptionParser.add_option('--merge_traces', action='store',
+                                     type='string', dest='merge_traces',
+                                     default='false', help='Join end-to-end trace segments')
+        self.OptionParser.add_option('--decimate', action='store',
+                                     type='string', dest='decimate',
+                                     default='false', help='Decimate dense traces')
+        self.OptionParser.add_option('--decimate_tolerance', action='store',
+                                     type='float', dest='decimate_tolerance',
+                                     default=0.1, help='Decimation tolerance (output px)')
+        self.OptionParser.add_option('--instance_markers', action='store',
+                                     type='string', dest='instance_markers',
+                                     default='false', help='Draw repeated markers as symbol instances')
+        self.OptionParser.add_option('--rasterize', action='store',
+                                     type='string', dest='rasterize',
+                                     default='false', help='Rasterize dense traces')
+        self.OptionParser.add_option('--raster_points', action='store',
+                                     type='int', dest='raster_points',
+                                     default=100000, help='Points above which traces are rasterized')
+        self.OptionParser.add_option('--raster_dpi', action='store',
+                                     type='float', dest='raster_dpi',
+                                     default=300, help='Resolution of rasterized traces (dpi)')
+        self.OptionParser.add_option('--raster_engine', action='store',
+                                     type='string', dest='raster_engine',
+                                     default='python', help='Renderer of rasterized traces (python, inkscape)')
+
+        # Output options
+        self.OptionParser.add_option('--css_classes', action='store',
+                                     type='string', dest='css_classes',
+                                     default='false', help='Style elements with CSS classes')
+        self.OptionParser.add_option('--collect_garbage', action='store',
+                                     type='string', dest='collect_garbage',
+                                     default='false', help='Remove unused definitions, metadata, and duplicates')
+        self.OptionParser.add_option('--resample_images', action='store',
+                                     type='string', dest='resample_images',
+                                     default='false', help='Downsample embedded images')
+        self.OptionParser.add_option('--image_dpi', action='store',
+                                     type='float', dest='image_dpi',
+                                     default=300, help='Resolution of resampled images (dpi)')
+        self.OptionParser.add_option('--jpeg_quality', action='store',
+                                     type='int', dest='jpeg_quality',
+                                     default=90, help='Quality of resampled JPEG images (0: always PNG)')
+        self.OptionParser.add_option('--compact', action='store',
+                                     type='string', dest='compact',
+                                     default='false', help='Write compact path data and numbers')
+        self.OptionParser.add_option('--precision', action='store',
+                                     type='float', dest='precision',
+                                     default=0.01, help='Compact output precision (output px)')
+
+
+    def query_geometry(self, root_node):
+        """Get position and size of all elements (`--query-all` records)"""
+        geometry = self.options.geometry
+
+        # Cross-checks always query both engines
+        if self.options.cache != 'true' or geometry == 'check':
+            return self.run_geometry(root_node, geometry)
+
+        try:
+            cache = QueryCache(self.options.cache_dir or default_cache_dir(),
+                               self.options.cache_size*1024*1024)
+            key = cache.key(self.args[-1], geometry)
+        except (IOError, OSError) as err:
+            inkex.errormsg('WARNING: geometry cache unavailable (%s).\n' % err)
+            return self.run_geometry(root_node, geometry)
+
+        allpos = cache.get(key)
+        if allpos is None:
+            allpos = self.run_geometry(root_node, geometry)
+            try:
+                cache.put(key, allpos)
+            except (IOError, OSError) as err:
+                inkex.errormsg('WARNING: could not update geometry cache (%s).\n' % err)
+
+        return allpos
+
+
+    def run_geometry(self, root_node, geometry):
+        """Query geometry using the given engine"""
+        if geometry == 'python':
+            try:
+                allpos = query_all(root_node, self.unittouu)
+            except Exception as err:
+                inkex.errormsg('WARNING: could not compute geometry (%s). '
+                    'Falling back to Inkscape.\n' % err)
+                allpos = query_inkscape(self.args[-1])
+        elif geometry == 'inkscape':
+            allpos = query_inkscape(self.args[-1])
+        elif geometry == 'shell':
+            try:
+                pool = shell_pool(self.options.shell_pool_size, self.options.shell_timeout)
+                allpos = pool.query(self.args[-1])
+            except (IOError, OSError) as err:
+                inkex.errormsg('WARNING: Inkscape shell failed (%s). '
+                    'Falling back to built-in geometry.\n' % err)
+                allpos = query_all(root_node, self.unittouu)
+        elif geometry == 'check':
+            allpos = query_inkscape(self.args[-1])
+            mismatches = compare_queries(query_all(root_node, self.unittouu), allpos)
+            if mismatches:
+                inkex.errormsg('WARNING: geometry engines disagree on %d '
+                    'elements: %s\n' % (len(mismatches), ', '.join(mismatches)))
+        else:
+            stop('Error! This geometry engine "%s" is unknown...' % geometry)
+
+        return allpos
+
+    def affect(self, args=sys.argv[1:], output=True):
+        """Run the extension (with --profile, under cProfile)"""
+        (options, _) = self.OptionParser.parse_args(list(args))
+        filename = options.profile or os.environ.get('PDF2PUB_PROFILE', '')
+        if filename == '':
+            return inkex.Effect.affect(self, args, output)
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(inkex.Effect.affect, self, args, output)
+        finally:
+            profiler.dump_stats(filename)
+
+    def output(self):
+        """Write the document (analysis only writes the report instead)"""
+        if self.options.analyze_only != 'true':
+            inkex.Effect.output(self)
+
+    def analyze(self, root_node, bbox_style_find, grid_style_find, styles, width, height):
+        """Clean up the document and find the plot elements (1 to 3)
+
+        Returns (bbox, grid, curves_stroke, curves_fill, analysis), where
+        analysis holds the positions and sizes needed by 4 to 7 (see
+        pdf2pub_analysis).
+        """
+        # Get position and size of all elements
+        self.stats.stage('Geometry query')
+        allpos = self.query_geometry(root_node)
+
+        # Get largest id number
+        self.stats.stage('Label scan')
+        last_id = re.match(r'[A-z]+(\d+)', allpos.splitlines()[-1].strip())
+        last_id = int(last_id.group(1))
+
+        # Get axes labels (positions of all <tspan>)
+        tspans = []
+        for line in allpos.splitlines():
+            data = re.match(r'^(tspan[\d-]+),(-?\d+.?\d*),(-?\d+.?\d*),\d+.?\d*,\d+.?\d*',
+                line.strip())
+
+            if data is not None:
+                tspans.append((data.group(1), float(data.group(2)), float(data.group(3))))
+
+        # 1. Clean up #########################################################
+        self.stats.stage('1. Clean up')
+        # Sort all elements in one pass: white elements, unused layers, clip
+        # paths, and labels are removed, plot elements are kept for 3.
+        (deleted, removed, bbox, grid, curves_stroke, curves_fill) = \
+            classify_elements(root_node, bbox_style_find, grid_style_find, styles)
+
+        # Subplots: each group of touching bounding box paths is an axes with
+        # its own grid, ticks, and labels (the labels closest to it)
+        axes = []
+        if self.options.multi_axes == 'true':
+            axes = split_axes(bbox, grid)
+        if len(axes) < 2:
+            axes = [(bbox, grid, find_frame(path_endpoints(bbox)))]
+            tspans = [tspans]
+        else:
+            owners = locate([frame for (_, _, frame) in axes],
+                            [(x, y) for (_, x, y) in tspans])
+            tspans = [[tspan for (tspan, owner) in zip(tspans, owners) if owner == k]
+                      for k in range(len(axes))]
+
+        labels = []
+        for axes_tspans in tspans:
+            axes_labels = find_labels(root_node, axes_tspans)
+            if axes_labels is None:
+                inkex.errormsg('WARNING: could not detect labels. '
+                    'Will proceed with placeholder.\n')
+                axes_labels = ('X-AXIS LABEL', 'Y-AXIS LABEL')
+            labels.append(axes_labels)
+
+        for element in removed:
+            element.getparent().remove(element)
+
+        # Traces that were clipped (their clip paths were just removed) are
+        # cut to the bounding box instead. Elements fully outside of it are
+        # removed, and those that cannot be cut get a single clip path.
+        # Subplot traces are cut to the axes they are drawn in. Traces are
+        # left as they are (here and in 3c to 3e) if only analyzing.
+        analyze_only = (self.options.analyze_only == 'true')
+        clipped = {}
+        if self.options.clip_traces == 'true' and not analyze_only:
+            records = parse_query(allpos)
+
+            # Frames in document coordinates, as the bounding boxes of traces
+            frames = [transform_box(element_transform(axes_bbox[0]), frame)
+                      if frame is not None else None
+                      for (axes_bbox, axes_grid, frame) in axes]
+            traces = list(itertools.chain(*([curves_stroke[color] for color in sorted(curves_stroke.keys())] +
+                                            [curves_fill[color] for color in sorted(curves_fill.keys())])))
+            if len(axes) > 1:
+                points = []
+                for (element, row) in zip(traces, path_endpoints(traces)):
+                    if element.get('id') in records:
+                        (x, y, w, h) = records[element.get('id')]
+                        points.append((x + w/2, y + h/2))
+                    else:
+                        points.append((float(row[0]), float(row[1])))
+                owners = locate(frames, points)
+
+            outside = set()
+            for (k, frame) in enumerate(frames):
+                if frame is None:
+                    inkex.errormsg('WARNING: could not find the bounding box. '
+                        'Traces were not clipped.\n')
+                    continue
+
+                if len(axes) > 1:
+                    axes_traces = [element for (element, owner) in zip(traces, owners) if owner == k]
+                else:
+                    axes_traces = traces
+                # Cut traces keep the precision of the final figure, in which
+                # the plot area (about the frame) is width x height
+                decimals = precision_decimals(max(width/((frame[2] - frame[0]) or 1),
+                                                  height/((frame[3] - frame[1]) or 1)),
+                                              self.options.precision)
+                (axes_outside, cut, crossing) = clip_paths(axes_traces, frame, styles,
+                                                           decimals, self.unittouu)
+
+                # Clip paths are in the user space of the elements, so
+                # transformed elements get the frame mapped back to theirs
+                clip_ids = {}
+                for element in [element for element in axes_traces if element in crossing]:
+                    mat = invertTransform(element_transform(element))
+                    key = formatTransform(mat) if mat != identity else None
+                    if key not in clip_ids:
+                        last_id = last_id + 1
+                        clip_ids[key] = 'clipPath%d' % last_id
+                        clip = etree.Element('clipPath',
+                            id = clip_ids[key],
+                            clipPathUnits = 'userSpaceOnUse')
+                        if key is not None:
+                            clip.set('transform', key)
+
+                        last_id = last_id + 1
+                        clip_rect = etree.Element('rect',
+                            id = 'rect%d' % last_id,
+                            x = '%f' % frame[0],
+                            y = '%f' % frame[1],
+                            width = '%f' % (frame[2] - frame[0]),
+                            height = '%f' % (frame[3] - frame[1]))
+
+                        clip.append(clip_rect)
+                        get_defs(root_node).append(clip)
+
+                    clip_id = clip_ids[key]
+                    element.set('clip-path', 'url(#%s)' % clip_id)
+                    if 'clip-path' in styles.get(element):
+                        styles.update(element, [('clip-path', 'url(#%s)' % clip_id)])
+
+                outside.update(axes_outside)
+                clipped.update(dict.fromkeys([element.get('id') for element in
+                                              itertools.chain(cut, crossing)], frame))
+
+            deleted.update([element.get('id') for element in outside])
+            for curves in (curves_stroke, curves_fill):
+                for color in list(curves.keys()):
+                    curves[color] = [element for element in curves[color]
+                                     if element not in outside]
+                    if len(curves[color]) == 0:
+                        del curves[color]
+
+
+        # 2. Resize image #####################################################
+        self.stats.stage('2. Resize image')
+        ### 2a. Get plot area size
+        # Get plot area NW and SE corner positions by matching any element that
+        # is not <tspan> or <text>. We also ignore <svg> and <layer>, since they
+        # bound the full image.
+        plot_nw_x = float('inf')
+        plot_nw_y = float('inf')
+        plot_se_x = 0
+        plot_se_y = 0
+        for line in allpos.splitlines():
+            data = re.match(r'^(?!svg)(?!layer)(?!tspan)(?!text)([-\w]+),(-?\d+.?\d*),(-?\d+.?\d*),(\d+.?\d*),(\d+.?\d*)',
+                line.strip())
+
+            if data and data.group(1) not in deleted:
+                x1 = float(data.group(2))
+                y1 = float(data.group(3))
+                x2 = float(data.group(2)) + float(data.group(4))
+                y2 = float(data.group(3)) + float(data.group(5))
+
+                # Clipped traces end at the bounding box
+                if data.group(1) in clipped:
+                    frame = clipped[data.group(1)]
+                    x1 = max(x1, frame[0])
+                    y1 = max(y1, frame[1])
+                    x2 = min(x2, frame[2])
+                    y2 = min(y2, frame[3])
+
+                if plot_nw_x >= x1:
+                    plot_nw_x = x1
+                if plot_nw_y >= y1:
+                    plot_nw_y = y1
+
+                if plot_se_x <= x2:
+                    plot_se_x = x2
+                if plot_se_y <= y2:
+                    plot_se_y = y2
+
+        # Calculate plot area width and height
+        plot_width = plot_se_x - plot_nw_x
+        plot_height = plot_se_y - plot_nw_y
+
+        # Subplots: the size of each axes (with its grid), the largest of
+        # which is given the plot width and height
+        areas = [(plot_width, plot_height)]
+        if len(axes) > 1:
+            records = parse_query(allpos)
+            areas = []
+            for (axes_bbox, axes_grid, frame) in axes:
+                area = frame
+                for element in axes_bbox + axes_grid:
+                    if element.get('id') in records:
+                        (x, y, w, h) = records[element.get('id')]
+                        area = (min(area[0], x), min(area[1], y),
+                                max(area[2], x + w), max(area[3], y + h))
+                areas.append((area[2] - area[0], area[3] - area[1]))
+            (plot_width, plot_height) = max(areas, key=lambda area: area[0]*area[1])
+
+        ### 2b. Fit canvas to plot area
+        # Texts were removed in 1, so the image bounding box matches the
+        # plot area.
+        nw_x = plot_nw_x
+        nw_y = plot_nw_y
+        se_x = plot_se_x
+        se_y = plot_se_y
+
+        # Set viewbox size
+        root_node.set('viewBox', '%d %d %.8f %.8f' %
+            (nw_x, nw_y, se_x - nw_x, se_y - nw_y))
+
+
+        # 3. Get plot elements ################################################
+        self.stats.stage('3. Get plot elements')
+        ### 3a. Get grid/plot elements
+        # Paths with predefined bounding box/grid color (found in 1).
+
+        ### 3b. Get plot traces
+        # Elements whose colors are not the bounding box/grid colors, grouped
+        # by colors (found in 1).
+
+        # Rewritten path data keeps the precision of the resized figure
+        decimals = precision_decimals(max(width/plot_width, height/plot_height),
+                                      self.options.precision)
+
+        ### 3c. Merge trace segments
+        # Join segments of the same line (same style, drawn end-to-end) into
+        # a single path.
+        if self.options.merge_traces == 'true' and not analyze_only:
+            merged = merge_segments(itertools.chain(*[curves_stroke[color]
+                                                      for color in sorted(curves_stroke.keys())]),
+                                    styles, decimals)
+            for color in curves_stroke.keys():
+                curves_stroke[color] = [element for element in curves_stroke[color]
+                                        if element not in merged]
+
+        ### 3d. Decimate plot traces
+        # Drop points that move traces by less than the tolerance in the
+        # resized figure (see 2c).
+        if self.options.decimate == 'true' and not analyze_only:
+            scale = (width/plot_width, height/plot_height)
+            for color in sorted(curves_stroke.keys()):
+                (before, after) = decimate_paths(curves_stroke[color],
+                                                 self.options.decimate_tolerance,
+                                                 scale, styles, decimals)
+                if after < before:
+                    inkex.errormsg('Traces %s: %d points, %d after decimation.\n' %
+                                   (color, before, after))
+
+        ### 3e. Instance markers
+        # Copies of the same marker are replaced by references to a single
+        # definition, which then stands for all of them in 5.
+        if self.options.instance_markers == 'true' and not analyze_only:
+            traces = itertools.chain(*([curves_stroke[color] for color in sorted(curves_stroke.keys())] +
+                                       [curves_fill[color] for color in sorted(curves_fill.keys())]))
+            (instances, last_id) = instance_markers(traces, styles, get_defs(root_node), last_id)
+
+            for curves in (curves_stroke, curves_fill):
+                for color in curves.keys():
+                    curves[color] = list(collections.OrderedDict.fromkeys(
+                        [instances.get(element, element) for element in curves[color]]))
+
+        ### 3f. Find axes and grid positions
+        # Bounding box left/bottom coordinates and x and y grids of each
+        # axes (ticks are placed on them in 6).
+        positions = []
+        for (k, (axes_bbox, axes_grid, frame)) in enumerate(axes):
+            (xaxis, yaxis) = find_axes(path_endpoints(axes_bbox))
+            (xgrid, ygrid, oblique) = split_grid(path_endpoints(axes_grid))
+            if oblique > 0:
+                stop('Error! There appears to be an '
+                     'oblique path in your grid')
+
+            positions.append({'size': list(areas[k]),
+                              'xaxis': float(xaxis),
+                              'yaxis': float(yaxis),
+                              'xgrid': [float(tick) for tick in xgrid],
+                              'ygrid': [float(tick) for tick in ygrid],
+                              'labels': list(labels[k])})
+
+        analysis = {'last_id': last_id,
+                    'extents': [nw_x, nw_y, se_x, se_y],
+                    'plot': [plot_width, plot_height],
+                    'axes': positions}
+
+        return (bbox, grid, curves_stroke, curves_fill, analysis)
 
     def effect(self):
         """Effect behaviour"""
@@ -179,138 +942,69 @@ class pdf2pub(inkex.Effect):
         if main_layer is None:
             main_layer = root_node
 
-        # Get position and size of all elements
-        p = Popen('inkscape --query-all %s' % self.args[-1],
-            shell=True, stdout=PIPE, stderr=PIPE)
-        rc = p.wait()
-        allpos = p.stdout.read()
-
-        # Get largest id number
-        last_id = re.match(r'[A-z]+(\d+)', allpos.splitlines()[-1].strip())
-        last_id = int(last_id.group(1))
-
-        # Get axes labels
-        xlab_id = None
-        xlab_pos = 0
-        ylab_id = None
-        ylab_pos = float('inf')
-        for line in allpos.splitlines():
-            data = re.match(r'^(tspan[\d-]+),(-?\d+.?\d*),(-?\d+.?\d*),\d+.?\d*,\d+.?\d*',
-                line.strip())
-
-            if data is not None:
-                if xlab_pos <= float(data.group(3)):
-                    xlab_pos = float(data.group(3))
-                    xlab_id = data.group(1)
-
-                if ylab_pos >= float(data.group(2)):
-                    ylab_pos = float(data.group(2))
-                    ylab_id = data.group(1)
-
-        if (xlab_id is not None) and (ylab_id is not None):
-            xlab_text = [element.text for element in
-                root_node.xpath('//svg:tspan[@id="%s"]' % xlab_id, namespaces=inkex.NSS)]
-            ylab_text = [element.text for element in
-                root_node.xpath('//svg:tspan[@id="%s"]' % ylab_id, namespaces=inkex.NSS)]
-
-        if (xlab_id is None) or (ylab_id is None) or (len(xlab_text) != 1) or (len(ylab_text) != 1):
-            inkex.errormsg('WARNING: could not detect labels. '
-                'Will proceed with placeholder.\n')
-            xlab_text = 'X-AXIS LABEL'
-            ylab_text = 'Y-AXIS LABEL'
+        # Stage timings and counters (see pdf2pub_stats)
+        stats_file = self.options.stats or os.environ.get('PDF2PUB_STATS', '')
+        self.stats = Stages(root_node, stats_file != '')
+
+        # A figure pdf2pub already formatted with --incremental is not
+        # analyzed again (1 to 3): the analysis stored in the document is used
+        # instead, and only the sections whose options changed are redone.
+        options = {'width': width, 'height': height,
+                   'font_family': font_family, 'font_color': font_color,
+                   'ticks_size': ticks_size, 'labels_size': labels_size,
+                   'plot_stroke_width': plot_stroke_width,
+                   'color_pal': self.options.color_pal,
+                   'bbox_style': bbox_style, 'grid_style': grid_style,
+                   'xticks': xticks, 'yticks': yticks,
+                   'elements_dict': elements_dict}
+
+        analysis = None
+        if self.options.incremental == 'true':
+            analysis = read_analysis(root_node)
+
+        styles = StyleCache()
+        if analysis is None:
+            restored = False
+            (bbox, grid, curves_stroke, curves_fill, analysis) = \
+                self.analyze(root_node, bbox_style_find, grid_style_find, styles, width, height)
+            redo = dict.fromkeys(section_options, True)
         else:
-            xlab_text = xlab_text[0]
-            ylab_text = ylab_text[0]
-
-        # 1. Clean up #########################################################
-        # Keep list of removed elements
-        deleted = []
-
-        # 1a. Remove white elements, ...
-        for element in root_node.iter(inkex.addNS('path', 'svg')):
-            style = parseStyle(element.get('style'))
-            obj_fill = style.get('fill')
-            obj_stroke = style.get('stroke')
-            if ((obj_fill == '#ffffff' and obj_stroke == 'none') or
-                    (obj_fill == 'none' and obj_stroke == '#ffffff')):
-                deleted.append(element.get('id'))
+            restored = True
+            self.stats.stage('Stored analysis')
+            (bbox, grid, curves_stroke, curves_fill, added) = restore_elements(root_node, analysis)
+            redo = changed_sections(analysis['options'], options)
+
+            # Styles go back inline, and the style sheet of the earlier run is
+            # replaced by one covering all sections (so all are redone)
+            if analysis.get('style_sheet') is not None:
+                inline_classes(root_node, analysis['style_sheet'])
+            if self.options.css_classes == 'true':
+                redo = dict.fromkeys(section_options, True)
+
+            # Elements added by the sections that are redone are replaced
+            outdated = []
+            if redo['ticks']:
+                outdated.extend(added['ticks'] + added['labels'])
+            if redo['legend']:
+                outdated.extend(added['legend'])
+            for element in outdated:
                 element.getparent().remove(element)
 
-        # ... unused layers, ...
-        for element in root_node.iter(inkex.addNS('g', 'svg')):
-            if len(element) == 0:
-                deleted.append(element.get('id'))
-                element.getparent().remove(element)
+        # Analysis only: report what was found and leave the document as is
+        # (it is not written, see output)
+        if self.options.analyze_only == 'true':
+            write_report(analysis_report(analysis, bbox, grid, curves_stroke, curves_fill),
+                         self.options.report)
+            self.stats.finish(stats_file)
+            return
 
-        # ... clip paths, ...
-        for element in root_node.iter(inkex.addNS('clipPath', 'svg')):
-            deleted.append(element.get('id'))
+        last_id = analysis['last_id']
+        (nw_x, nw_y, se_x, se_y) = analysis['extents']
+        (plot_width, plot_height) = analysis['plot']
 
-            # Clip paths have path nodes below that we'll need to ignore later
-            for child in element:
-                deleted.append(child.get('id'))
-
-            element.getparent().remove(element)
-
-        # ... and labels
-        for element in root_node.iter(inkex.addNS('text', 'svg')):
-            deleted.append(element.get('id'))
-            element.getparent().remove(element)
-
-
-        # 2. Resize image #####################################################
-        ### 2a. Get plot area size
-        # Get plot area NW and SE corner positions by matching any element that
-        # is not <tspan> or <text>. We also ignore <svg> and <layer>, since they
-        # bound the full image.
-        plot_nw_x = float('inf')
-        plot_nw_y = float('inf')
-        plot_se_x = 0
-        plot_se_y = 0
-        for line in allpos.splitlines():
-            data = re.match(r'^(?!svg)(?!layer)(?!tspan)(?!text)([-\w]+),(-?\d+.?\d*),(-?\d+.?\d*),(\d+.?\d*),(\d+.?\d*)',
-                line.strip())
-
-            if data and data.group(1) not in deleted:
-                if plot_nw_x >= float(data.group(2)):
-                    plot_nw_x = float(data.group(2))
-                if plot_nw_y >= float(data.group(3)):
-                    plot_nw_y = float(data.group(3))
-
-                if plot_se_x <= float(data.group(2)) + float(data.group(4)):
-                    plot_se_x = float(data.group(2)) + float(data.group(4))
-                if plot_se_y <= float(data.group(3)) + float(data.group(5)):
-                    plot_se_y = float(data.group(3)) + float(data.group(5))
-
-        # Calculate plot area width and height
-        plot_width = plot_se_x - plot_nw_x
-        plot_height = plot_se_y - plot_nw_y
-
-        ### 2b. Fit canvas to plot area
-        # Get image bounding box NW and SE corner positions by matching any
-        # element that is not <svg> or <layer>.
-        nw_x = float('inf')
-        nw_y = float('inf')
-        se_x = 0
-        se_y = 0
-        for line in allpos.splitlines():
-            data = re.match(r'^(?!svg)(?!layer)(?!tspan)(?!text)([-\w]+),(-?\d+.?\d*),(-?\d+.?\d*),(\d+.?\d*),(\d+.?\d*)',
-                line.strip())
-
-            if data and data.group(1) not in deleted:
-                if nw_x >= float(data.group(2)):
-                    nw_x = float(data.group(2))
-                if nw_y >= float(data.group(3)):
-                    nw_y = float(data.group(3))
-
-                if se_x <= float(data.group(2)) + float(data.group(4)):
-                    se_x = float(data.group(2)) + float(data.group(4))
-                if se_y <= float(data.group(3)) + float(data.group(5)):
-                    se_y = float(data.group(3)) + float(data.group(5))
-
-        # Set viewbox size
-        root_node.set('viewBox', '%d %d %.8f %.8f' %
-            (nw_x, nw_y, se_x - nw_x, se_y - nw_y))
+        # 2. Resize image (continued) #########################################
+        self.stats.stage('2. Resize image')
+        # The plot area (2a) and canvas (2b) were found in 1 to 3.
 
         ### 2c. Resize plot
         root_node.set('width', '%.8f' % (width/plot_width*(se_x - nw_x)))
@@ -326,169 +1020,196 @@ class pdf2pub(inkex.Effect):
         scale_size = width/plot_width*scale_x
 
 
-        # 3. Get plot elements ################################################
-        ### 3a. Get grid/plot elements
-        # Look for paths with predefined bounding box/grid color.
-        bbox = []
-        grid = []
-
-        for element in root_node.xpath('//svg:path[@style]',
-                                       namespaces=inkex.NSS):
-            element_style = parseStyle(element.get('style'))
-
-            if all([element_style[style].lower() == bbox_style_find[style].lower() for style in bbox_style_find.keys()]):
-                bbox.append(element)
-            elif all([element_style[style].lower() == grid_style_find[style].lower() for style in grid_style_find.keys()]):
-                grid.append(element)
-
-        ### 3b. Get plot traces
-        # Look for elements whose colors are not the bounding box/grid colors.
-        # Get curves grouped by colors
-        curves_stroke = {}
-        curves_fill = {}
-
-        for element in root_node.xpath('//svg:*[@style]', namespaces=inkex.NSS):
-            if element.tag != inkex.addNS('text', 'svg'):
-                if element.get('id') not in [el.get('id') for el in bbox + grid]:
-                # if any([element_style[style].lower() != bbox_style_find[style].lower() for style in bbox_style_find.keys()]) or any([element_style[style].lower() != grid_style_find[style].lower() for style in grid_style_find.keys()]):
-                    element_style = parseStyle(element.get('style'))
-
-                    if element_style['stroke'] != 'none':
-                        if element_style['stroke'] in curves_stroke.keys():
-                            curves_stroke[element_style['stroke']].append(element)
-                        else:
-                            curves_stroke[element_style['stroke']] = [element]
-
-                    if element_style['fill'] != 'none':
-                        if element_style['fill'] in curves_fill.keys():
-                            curves_fill[element_style['fill']].append(element)
-                        else:
-                            curves_fill[element_style['fill']] = [element]
-
-
         # 4. Fix grid and plot boundaries #####################################
-        ### 4a. Fix bounding box
-        for element in bbox:
-            element_style = parseStyle(element.get('style'))
+        self.stats.stage('4. Fix grid and plot boundaries')
+        # Style changes are collected in styles and written back in 8.
+        # Elements that may share a CSS class are collected in classes.
+        classes = []
 
-            # Fix style
-            for style in bbox_style.keys():
-                if style == 'stroke-width':
-                    element_style[style] = str(self.unittouu(bbox_style[style])/scale_size) + 'px'
-                else:
-                    element_style[style] = bbox_style[style]
+        ### 4a. Fix bounding box
+        changes = []
+        for style in bbox_style.keys():
+            if style == 'stroke-width':
+                changes.append((style, str(self.unittouu(bbox_style[style])/scale_size) + 'px'))
+            else:
+                changes.append((style, bbox_style[style]))
 
-            element.set('style', formatStyle(element_style))
+        for element in bbox:
+            styles.update(element, changes)
+        classes.append(('pdf2pub-bbox', bbox))
 
         ### 4b. Fix grid
-        for element in grid:
-            element_style = parseStyle(element.get('style'))
+        changes = []
+        for style in grid_style.keys():
+            if style == 'stroke-width':
+                changes.append((style, str(self.unittouu(grid_style[style])/scale_size) + 'px'))
+            else:
+                changes.append((style, grid_style[style]))
 
-            # Fix style
-            for style in grid_style.keys():
-                if style == 'stroke-width':
-                    element_style[style] = str(self.unittouu(grid_style[style])/scale_size) + 'px'
-                else:
-                    element_style[style] = grid_style[style]
-
-            element.set('style', formatStyle(element_style))
+        for element in grid:
+            styles.update(element, changes)
+        classes.append(('pdf2pub-grid', grid))
 
 
         # 5. Fix plot traces ##################################################
-        ### 5a. Fix plot traces stroke and thickness
-        color_idx = 0
-        for color in sorted(curves_stroke.keys()):
-            for element in curves_stroke[color]:
-                element_style = parseStyle(element.get('style'))
-
+        self.stats.stage('5. Fix plot traces')
+        # Re-runs only restyle traces if their options changed
+        if redo['traces']:
+            ### 5a. Fix plot traces stroke and thickness
+            color_idx = 0
+            for (entry, color) in enumerate(sorted(curves_stroke.keys())):
                 # Fix thickness
-                element_style['stroke-width'] = str(plot_stroke_width/scale_size) + 'px'
+                changes = [('stroke-width', str(plot_stroke_width/scale_size) + 'px')]
 
-                # Fix strokes
+                # Fix strokes (re-runs without palette bring back the
+                # original colors)
                 if color_pal is not None:
-                    element_style['stroke'] = color_pal[color_idx]
-
-                element.set('style', formatStyle(element_style))
+                    changes.append(('stroke', color_pal[color_idx]))
+                elif restored:
+                    changes.append(('stroke', color))
 
-            if color_pal is not None:
-                color_idx = (color_idx + 1) % len(color_pal)
+                for element in curves_stroke[color]:
+                    styles.update(element, changes)
+                classes.append(('pdf2pub-stroke%d' % (entry + 1), curves_stroke[color]))
 
-        ### 5b. Fix plot traces fill
-        color_idx = 0
-        for color in sorted(curves_fill.keys()):
-            for element in curves_fill[color]:
-                element_style = parseStyle(element.get('style'))
+                if color_pal is not None:
+                    color_idx = (color_idx + 1) % len(color_pal)
 
+            ### 5b. Fix plot traces fill
+            color_idx = 0
+            for (entry, color) in enumerate(sorted(curves_fill.keys())):
                 if color_pal is not None:
-                    element_style['fill'] = color_pal[color_idx]
+                    changes = [('fill', color_pal[color_idx])]
+                elif restored:
+                    changes = [('fill', color)]
+                else:
+                    changes = []
 
-                element.set('style', formatStyle(element_style))
+                for element in curves_fill[color]:
+                    styles.update(element, changes)
+                classes.append(('pdf2pub-fill%d' % (entry + 1), curves_fill[color]))
 
-            if color_pal is not None:
-                color_idx = (color_idx + 1) % len(color_pal)
+                if color_pal is not None:
+                    color_idx = (color_idx + 1) % len(color_pal)
 
 
         # 6. Ticks and labels #################################################
-        ### 6a. Find bounding box left/bottom coordinates
-        xaxis = 0
-        yaxis = float('inf')
-        for element in bbox:
-            path = parsePath(element.get('d'))
+        self.stats.stage('6. Ticks and labels')
+        # Each axes of a subplot gets its own ticks and labels. Re-runs keep
+        # those of the earlier run if their options did not change.
+        (xticks_option, yticks_option) = (xticks, yticks)
+        ticks = []
+        axes_labels = []
+        for axes in (analysis['axes'] if redo['ticks'] else []):
+            (axes_width, axes_height) = axes['size']
+            (xlab_text, ylab_text) = axes['labels']
+
+            ### 6a. Bounding box left/bottom coordinates (found in 3)
+            (xaxis, yaxis) = (axes['xaxis'], axes['yaxis'])
+
+            ### 6b. x and y grids (found in 3)
+            (xgrid, ygrid) = (axes['xgrid'], axes['ygrid'])
+
+            ### 6c. x-axis tick labels
+            xticks = None if xticks_option is None else list(xticks_option)
+            if xticks is None:
+                xticks = ['X'] * len(xgrid)
+
+            if len(xgrid) < len(xticks):
+                inkex.errormsg('WARNING: Number of x-tick labels provided exceeds '
+                                'the number of x-ticks found in the plot. '
+                                'Ignoring extra values.\n')
+            elif len(xgrid) > len(xticks):
+                inkex.errormsg('WARNING: Number of x-tick labels provided is less '
+                                'than the number of x-ticks found in the plot. '
+                                'Filling up with placeholders.\n')
+                xticks.extend(['X'] * (len(xgrid)-len(xticks)))
+
+            # ([x-axis position] + [font height] / scale_size) / scale_y +
+            #   [distance from axis to tick (~5px)] / scale_size
+            xtick_y = (xaxis + self.unittouu('%fpt' % (ticks_size/scale_size)))/scale_y + 5/scale_size
+
+            for (xtick,xticklabel) in zip(sorted(xgrid),xticks):
+                # [position of tick along axis] / scale_x
+                xtick_x = xtick/scale_x
 
-            # Disconsider zero length elements
-            if path[0][1] != path[1][1]:
-                if yaxis >= min(path[0][1][0],path[1][1][0]):
-                    yaxis = min(path[0][1][0],path[1][1][0])
+                last_id = last_id + 1
+                tspan = etree.Element("tspan", id = 'tspan%d' % last_id)
+                tspan.text = xticklabel
 
-                elif xaxis <= max(path[0][1][1], path[1][1][1]):
-                    xaxis = max(path[0][1][1], path[1][1][1])
+                last_id = last_id + 1
+                text = etree.Element("text",
+                    style = 'font-family:%s;fill:%s;font-size:%fpt;' % (font_family, font_color, ticks_size/scale_size) +
+                            'font-weight:normal;fill-opacity:1;'
+                            'text-align:center;text-anchor:middle;'
+                            'fill-rule:nonzero;stroke:none;line-height:125%;'
+                            'letter-spacing:0px;word-spacing:0px;font-stretch:normal;'
+                            'font-variant:normal;writing-mode:lr-tb;',
+                    id = 'text%d' % last_id,
+                    transform = 'scale(%.8f,%.8f)' % (scale_x, scale_y),
+                    x = '%f' % (xtick_x),
+                    y = '%f' % (xtick_y))
+
+                text.append(tspan)
+                main_layer.append(text)
+                ticks.append(text)
+
+            ### 6d. y-axis tick labels
+            yticks = None if yticks_option is None else list(yticks_option)
+            if yticks is None:
+                yticks = ['Y'] * len(ygrid)
+
+            if len(ygrid) < len(yticks):
+                inkex.errormsg('WARNING: Number of y-tick labels provided exceeds '
+                                'the number of y-ticks found in the plot. '
+                                'Ignoring extra values.\n')
+            elif len(ygrid) > len(yticks):
+                inkex.errormsg('WARNING: Number of y-tick labels provided is less '
+                                'than the number of y-ticks found in the plot. '
+                                'Filling up with placeholders.\n')
+                yticks.extend(['Y'] * (len(ygrid)-len(yticks)))
+
+            # [y-axis position] / scale_x +
+            #   [distance from axis to tick (~4px)] / scale_size
+            ytick_x = yaxis/scale_x - 4/scale_size
+
+            for (ytick,yticklabel) in zip(sorted(ygrid, reverse=True),yticks):
+                # ([position of tick along axis] + [font height]/2) / scale_y
+                ytick_y = (ytick + self.unittouu('%fpt' % (ticks_size/scale_size))/2)/scale_y
 
-        ### 6b. Separate x and y grids
-        xgrid = []
-        ygrid = []
-        for element in grid:
-            path = parsePath(element.get('d'))
-            # Disconsider zero length elements
-            if path[0][1] != path[1][1]:
-                if path[0][1][0] == path[1][1][0]:
-                    # Vertical path
-                    xgrid.append(path[0][1][0])
-                elif path[0][1][1] == path[1][1][1]:
-                    # Horizontal path
-                    ygrid.append(path[0][1][1])
-                else:
-                    stop('Error! There appears to be an'
-                         'oblique path in your grid')
-
-        ### 6c. x-axis tick labels
-        if xticks is None:
-            xticks = ['X'] * len(xgrid)
-
-        if len(xgrid) < len(xticks):
-            inkex.errormsg('WARNING: Number of x-tick labels provided exceeds '
-                            'the number of x-ticks found in the plot. '
-                            'Ignoring extra values.\n')
-        elif len(xgrid) > len(xticks):
-            inkex.errormsg('WARNING: Number of x-tick labels provided is less '
-                            'than the number of x-ticks found in the plot. '
-                            'Filling up with placeholders.\n')
-            xticks.extend(['X'] * (len(xgrid)-len(xticks)))
-
-        # ([x-axis position] + [font height] / scale_size) / scale_y +
-        #   [distance from axis to tick (~5px)] / scale_size
-        xtick_y = (xaxis + self.unittouu('%fpt' % (ticks_size/scale_size)))/scale_y + 5/scale_size
-
-        for (xtick,xticklabel) in zip(sorted(xgrid),xticks):
-            # [position of tick along axis] / scale_x
-            xtick_x = xtick/scale_x
+                last_id = last_id + 1
+                tspan = etree.Element("tspan", id = 'tspan%d' % last_id)
+                tspan.text = yticklabel
 
-            last_id = last_id + 1
-            tspan = etree.Element("tspan", id = 'tspan%d' % last_id)
-            tspan.text = xticklabel
+                last_id = last_id + 1
+                text = etree.Element("text",
+                    style = 'font-family:%s;fill:%s;font-size:%fpt;' % (font_family, font_color, ticks_size/scale_size) +
+                            'font-weight:normal;fill-opacity:1;'
+                            'text-align:end;text-anchor:end;'
+                            'fill-rule:nonzero;stroke:none;line-height:125%;'
+                            'letter-spacing:0px;word-spacing:0px;font-stretch:normal;'
+                            'font-variant:normal;writing-mode:lr-tb;',
+                    id = 'text%d' % last_id,
+                    transform = 'scale(%.8f,%.8f)' % (scale_x, scale_y),
+                    x = '%f' % (ytick_x),
+                    y = '%f' % (ytick_y))
+
+                text.append(tspan)
+                main_layer.append(text)
+                ticks.append(text)
+
+
+            ### 6e. x-axis label
+            # x-axis label
+            # ([y-axis position] + [plot width]/2) / scale_x
+            xlab_x = (yaxis + axes_width/2)/scale_x
+            # [tick position] + [font height]/scale_x +
+            #   [distance from tick to label (~6pt)]/scale_x
+            xlab_y = xtick_y + self.unittouu('%fpt' % (labels_size/scale_size))/scale_y + 7/scale_size
 
             last_id = last_id + 1
-            text = etree.Element("text",
-                style = 'font-family:%s;fill:%s;font-size:%fpt;' % (font_family, font_color, ticks_size/scale_size) +
+            xlab = etree.Element("text",
+                style = 'font-family:%s;fill:%s;font-size:%fpt;' % (font_family, font_color, labels_size/scale_size) +
                         'font-weight:normal;fill-opacity:1;'
                         'text-align:center;text-anchor:middle;'
                         'fill-rule:nonzero;stroke:none;line-height:125%;'
@@ -496,122 +1217,61 @@ class pdf2pub(inkex.Effect):
                         'font-variant:normal;writing-mode:lr-tb;',
                 id = 'text%d' % last_id,
                 transform = 'scale(%.8f,%.8f)' % (scale_x, scale_y),
-                x = '%f' % (xtick_x),
-                y = '%f' % (xtick_y))
-
-            text.append(tspan)
-            main_layer.append(text)
-
-        ### 6d. y-axis tick labels
-        if yticks is None:
-            yticks = ['Y'] * len(ygrid)
-
-        if len(ygrid) < len(yticks):
-            inkex.errormsg('WARNING: Number of y-tick labels provided exceeds '
-                            'the number of y-ticks found in the plot. '
-                            'Ignoring extra values.\n')
-        elif len(ygrid) > len(yticks):
-            inkex.errormsg('WARNING: Number of y-tick labels provided is less '
-                            'than the number of y-ticks found in the plot. '
-                            'Filling up with placeholders.\n')
-            yticks.extend(['Y'] * (len(ygrid)-len(yticks)))
-
-        # [y-axis position] / scale_x +
-        #   [distance from axis to tick (~4px)] / scale_size
-        ytick_x = yaxis/scale_x - 4/scale_size
-
-        for (ytick,yticklabel) in zip(sorted(ygrid, reverse=True),yticks):
-            # ([position of tick along axis] + [font height]/2) / scale_y
-            ytick_y = (ytick + self.unittouu('%fpt' % (ticks_size/scale_size))/2)/scale_y
+                x = '%f' % (xlab_x),
+                y = '%f' % (xlab_y))
 
             last_id = last_id + 1
-            tspan = etree.Element("tspan", id = 'tspan%d' % last_id)
-            tspan.text = yticklabel
+            xlab_tspan = etree.Element("tspan", id = 'tspan%d' % last_id)
+            xlab_tspan.text = xlab_text
+            xlab.append(xlab_tspan)
+
+            ### 6f. y-axis label
+            # [tick position] + [# of characters in longest tick]*[width of each character (~4.21px @ 8pt)] +
+            #   [distance between tick and label (~6pt)]
+            ylab_x = ytick_x - max([len(el) for el in yticks])*4.3*ticks_size/8 - 15/scale_size
+            # ([x-axis position] + [plot height]/2) / scale_y
+            ylab_y = (xaxis - axes_height/2)/scale_y
 
             last_id = last_id + 1
-            text = etree.Element("text",
-                style = 'font-family:%s;fill:%s;font-size:%fpt;' % (font_family, font_color, ticks_size/scale_size) +
+            ylab = etree.Element("text",
+                style = 'font-family:%s;fill:%s;font-size:%fpt;' % (font_family, font_color, labels_size/scale_size) +
                         'font-weight:normal;fill-opacity:1;'
-                        'text-align:end;text-anchor:end;'
+                        'text-align:center;text-anchor:middle;'
                         'fill-rule:nonzero;stroke:none;line-height:125%;'
                         'letter-spacing:0px;word-spacing:0px;font-stretch:normal;'
                         'font-variant:normal;writing-mode:lr-tb;',
                 id = 'text%d' % last_id,
-                transform = 'scale(%.8f,%.8f)' % (scale_x, scale_y),
-                x = '%f' % (ytick_x),
-                y = '%f' % (ytick_y))
-
-            text.append(tspan)
-            main_layer.append(text)
-
-
-        ### 6e. x-axis label
-        # x-axis label
-        # ([y-axis position] + [plot width]/2) / scale_x
-        xlab_x = (yaxis + plot_width/2)/scale_x
-        # [tick position] + [font height]/scale_x +
-        #   [distance from tick to label (~6pt)]/scale_x
-        xlab_y = xtick_y + self.unittouu('%fpt' % (labels_size/scale_size))/scale_y + 7/scale_size
-
-        last_id = last_id + 1
-        xlab = etree.Element("text",
-            style = 'font-family:%s;fill:%s;font-size:%fpt;' % (font_family, font_color, labels_size/scale_size) +
-                    'font-weight:normal;fill-opacity:1;'
-                    'text-align:center;text-anchor:middle;'
-                    'fill-rule:nonzero;stroke:none;line-height:125%;'
-                    'letter-spacing:0px;word-spacing:0px;font-stretch:normal;'
-                    'font-variant:normal;writing-mode:lr-tb;',
-            id = 'text%d' % last_id,
-            transform = 'scale(%.8f,%.8f)' % (scale_x, scale_y),
-            x = '%f' % (xlab_x),
-            y = '%f' % (xlab_y))
-
-        last_id = last_id + 1
-        xlab_tspan = etree.Element("tspan", id = 'tspan%d' % last_id)
-        xlab_tspan.text = xlab_text
-        xlab.append(xlab_tspan)
-
-        ### 6f. y-axis label
-        # [tick position] + [# of characters in longest tick]*[width of each character (~4.21px @ 8pt)] +
-        #   [distance between tick and label (~6pt)]
-        ylab_x = ytick_x - max([len(el) for el in yticks])*4.3*ticks_size/8 - 15/scale_size
-        # ([x-axis position] + [plot height]/2) / scale_y
-        ylab_y = (xaxis - plot_height/2)/scale_y
-
-        last_id = last_id + 1
-        ylab = etree.Element("text",
-            style = 'font-family:%s;fill:%s;font-size:%fpt;' % (font_family, font_color, labels_size/scale_size) +
-                    'font-weight:normal;fill-opacity:1;'
-                    'text-align:center;text-anchor:middle;'
-                    'fill-rule:nonzero;stroke:none;line-height:125%;'
-                    'letter-spacing:0px;word-spacing:0px;font-stretch:normal;'
-                    'font-variant:normal;writing-mode:lr-tb;',
-            id = 'text%d' % last_id,
-            transform = 'matrix(0,-%.8f,%.8f,0,0,0)' % (scale_y, scale_x),
-            x = '%f' % (-ylab_y),
-            y = '%f' % (ylab_x))
-            # (x,y transformed due to label rotation in <transform>)
-
-        last_id = last_id + 1
-        ylab_tspan = etree.Element("tspan", id = 'tspan%d' % last_id)
-        ylab_tspan.text = ylab_text
-        ylab.append(ylab_tspan)
-
-        main_layer.append(xlab)
-        main_layer.append(ylab)
+                transform = 'matrix(0,-%.8f,%.8f,0,0,0)' % (scale_y, scale_x),
+                x = '%f' % (-ylab_y),
+                y = '%f' % (ylab_x))
+                # (x,y transformed due to label rotation in <transform>)
+
+            last_id = last_id + 1
+            ylab_tspan = etree.Element("tspan", id = 'tspan%d' % last_id)
+            ylab_tspan.text = ylab_text
+            ylab.append(ylab_tspan)
+
+            main_layer.append(xlab)
+            main_layer.append(ylab)
+            axes_labels.extend([xlab, ylab])
+
+        classes.append(('pdf2pub-ticks', ticks))
+        classes.append(('pdf2pub-labels', axes_labels))
 
 
         # 7. Create elements dictionary #######################################
-        if elements_dict:
+        self.stats.stage('7. Create elements dictionary')
+        legend = []
+        if elements_dict and redo['legend']:
             ### 7a. Arrow
             # Create marker definition (Arrow2Mend)
             last_id = last_id + 1
-            marker_id = last_id
+            marker_id = 'marker%d' % (last_id)
             marker = etree.Element('marker',
                 orient = 'auto',
                 refY = '0',
                 refX = '0',
-                id = 'marker%d' % (last_id),
+                id = marker_id,
                 style = 'overflow:visible')
 
             # Create marker drawing (Arrow2Mend)
@@ -625,17 +1285,22 @@ class pdf2pub(inkex.Effect):
                     'c -1.7454984,2.3720609 -1.7354408,5.6174519 -6e-7,8.035443 z',
                 transform = 'scale(-0.6,-0.6)')
 
-            # Include marker definition under defs node
-            defs_node = root_node.xpath('//svg:defs', namespaces=inkex.NSS)[0]
+            # Include marker definition under defs node, unless an earlier
+            # run already did
+            defs_node = get_defs(root_node)
             marker.append(marker_path)
-            defs_node.append(marker)
+            existing = find_equal(defs_node, marker)
+            if existing is not None and existing.get('id') is not None:
+                marker_id = existing.get('id')
+            else:
+                defs_node.append(marker)
 
             # Add example arrow next to plot
             last_id = last_id + 1
             marker_path = etree.Element('path',
                 style = 'color:%s;solid-color:%s;' % (bbox_style['stroke'], bbox_style['stroke']) +
                         'stroke:%s;stroke-width:%s;' % (bbox_style['stroke'], self.unittouu(arrow_stroke_width)/scale_size) +
-                        'marker-end:url(#marker%d);' % marker_id +
+                        'marker-end:url(#%s);' % marker_id +
                         'mix-blend-mode:normal;color-interpolation:sRGB;'
                         'isolation:auto;color-interpolation-filters:linearRGB;'
                         'fill-rule:nonzero;solid-opacity:1;fill:none;fill-opacity:1;'
@@ -661,6 +1326,8 @@ class pdf2pub(inkex.Effect):
             #   taken care of by the transform in the text node
             legend_text_x = (400 + legend_line_length + 5)/scale_size
 
+            legend_paths = []
+            legend_texts = []
             stroke_legend_entry = 0
             for original_color in curves_stroke.keys():
                 # ([start position] + ([stroke entry number] - 1)*[distance between legend entries]) /
@@ -716,6 +1383,8 @@ class pdf2pub(inkex.Effect):
                 # Add elements to layer
                 main_layer.append(legend_path)
                 main_layer.append(legend_text)
+                legend_paths.append(legend_path)
+                legend_texts.append(legend_text)
 
                 stroke_legend_entry = stroke_legend_entry + 1
 
@@ -785,10 +1454,113 @@ class pdf2pub(inkex.Effect):
                 # Add elements to layer
                 main_layer.append(legend_path)
                 main_layer.append(legend_text)
+                legend_paths.append(legend_path)
+                legend_texts.append(legend_text)
 
                 fill_legend_entry = fill_legend_entry + 1
 
+            classes.append(('pdf2pub-legend-line', legend_paths))
+            classes.append(('pdf2pub-legend', legend_texts))
+            legend = [marker_path] + legend_paths + legend_texts
+
+
+        # 8. Write back styles ################################################
+        self.stats.stage('8. Write back styles')
+        styles.commit()
+
+        # Traces with too many points to be drawn as vectors are replaced by
+        # a single image of them (covering the canvas, see 2b)
+        if self.options.rasterize == 'true':
+            dense = []
+            messages = []
+            for (kind, curves) in (('Traces', curves_stroke), ('Fills', curves_fill)):
+                for color in sorted(curves.keys()):
+                    points = count_points(curves[color])
+                    if points > self.options.raster_points:
+                        dense.extend(curves[color])
+                        messages.append('%s %s: %d points, rasterized at %d dpi.\n' %
+                                        (kind, color, points, self.options.raster_dpi))
+
+            if dense:
+                scale = self.options.raster_dpi/96.0
+                size = (max(1, int(round(width/plot_width*(se_x - nw_x)*scale))),
+                        max(1, int(round(height/plot_height*(se_y - nw_y)*scale))))
+                last_id = last_id + 1
+                try:
+                    rasterize(dense, (nw_x, nw_y, se_x, se_y), size,
+                              self.options.raster_engine, 'image%d' % last_id)
+                    classes = [(name, [element for element in elements if element.getparent() is not None])
+                               for (name, elements) in classes]
+                    for message in messages:
+                        inkex.errormsg(message)
+                except Exception as err:
+                    inkex.errormsg('WARNING: could not rasterize traces (%s). '
+                        'Traces were kept as vectors.\n' % err)
+
+        # Properties shared by the elements of each class go to a style sheet
+        style_sheet = None
+        if self.options.css_classes == 'true':
+            rules = make_classes(classes)
+
+            last_id = last_id + 1
+            style_node = etree.Element('style',
+                type = 'text/css',
+                id = 'style%d' % last_id)
+            style_node.text = '\n' + ''.join(['.%s { %s }\n' % (name, formatStyle(style))
+                                              for (name, style) in rules])
+            get_defs(root_node).insert(0, style_node)
+            style_sheet = style_node.get('id')
+
+        # Sweep definitions and elements nothing uses (e.g., left over from
+        # the PDF import or from earlier runs)
+        if self.options.collect_garbage == 'true':
+            merge_duplicates(root_node)
+            collect_garbage(root_node)
+
+        # Embedded images only keep the resolution they are printed at
+        if self.options.resample_images == 'true':
+            (resampled, skipped) = resample_images(root_node, (width/plot_width, height/plot_height),
+                                                   self.options.image_dpi, self.options.jpeg_quality)
+            for (image_id, dpi, before, after, size_before, size_after) in resampled:
+                inkex.errormsg('Image %s: %dx%d at %d dpi, %dx%d after resampling '
+                               '(%d kB, was %d kB).\n' % (image_id, before[0], before[1], dpi,
+                                                          after[0], after[1], size_after//1024,
+                                                          size_before//1024))
+            if skipped:
+                inkex.errormsg('WARNING: %d images could not be resampled '
+                    '(resampling requires PIL).\n' % skipped)
+
+        # Numbers only keep the digits that are visible in the final figure
+        if self.options.compact == 'true':
+            compact_document(root_node, max(width/plot_width, height/plot_height),
+                             self.options.precision)
+
+        # The analysis is stored last, so that later runs can reuse it
+        if self.options.incremental == 'true':
+            analysis.update({'options': options,
+                             'last_id': last_id,
+                             'style_sheet': style_sheet,
+                             'scale': [scale_x, scale_y, scale_size],
+                             'bbox': element_ids(bbox),
+                             'grid': element_ids(grid),
+                             'strokes': dict([(color, element_ids(curves_stroke[color]))
+                                              for color in curves_stroke]),
+                             'fills': dict([(color, element_ids(curves_fill[color]))
+                                            for color in curves_fill])})
+            if redo['ticks']:
+                analysis.update({'ticks': element_ids(ticks),
+                                 'labels': element_ids(axes_labels)})
+            if redo['legend']:
+                analysis['legend'] = element_ids(legend)
+            write_analysis(root_node, analysis)
+
+        self.stats.finish(stats_file)
+
 
 if __name__ == '__main__':
     e = pdf2pub()
-    e.affect()
+    try:
+        e.affect()
+    except Pdf2pubError as err:
+        inkex.errormsg(str(err))
+        sys.exit(0)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""Analysis of a figure stored in the document for pdf2pub
+
+With --incremental, pdf2pub stores what it found in a figure (plot area,
+scalings, axes and grid positions, the bounding box, grid, and trace
+elements, and the ticks, labels, and legend it added) in a <metadata>
+block. Later runs on its output read it back instead of cleaning up,
+querying, and classifying the document again, and only redo the sections
+whose options changed.
+
+With --analyze_only, the same analysis is written as a JSON report (see
+analysis_report) and the document is left as is.
+"""
+
+import sys, json
+
+import inkex
+from lxml import etree
+
+
+# Metadata block holding the analysis
+analysis_id = 'pdf2pub-analysis'
+analysis_ns = 'http://www.seas.upenn.edu/luizf/pdf2pub/analysis'
+analysis_version = 1
+
+# Options each section depends on (all depend on the figure size)
+size_options = ['width', 'height']
+section_options = {
+    'traces': ['plot_stroke_width', 'color_pal'],
+    'ticks': ['font_family', 'font_color', 'ticks_size', 'labels_size',
+              'xticks', 'yticks'],
+    'legend': ['elements_dict', 'color_pal', 'font_family', 'font_color',
+               'bbox_style']}
+
+
+def _metadata_nodes(root_node):
+    """All <metadata> nodes of the document"""
+    return list(root_node.iter(inkex.addNS('metadata', 'svg'), 'metadata'))
+
+
+def read_analysis(root_node):
+    """Return the analysis stored by an earlier run (None if there is none)"""
+    for metadata in _metadata_nodes(root_node):
+        if metadata.get('id') != analysis_id:
+            continue
+        for node in metadata.iter('{%s}analysis' % analysis_ns):
+            try:
+                analysis = json.loads(node.text or '')
+            except ValueError:
+                inkex.errormsg('WARNING: the stored analysis is damaged. '
+                    'Will analyze the figure again.\n')
+                return None
+            if analysis.get('version') != analysis_version:
+                return None
+            return analysis
+    return None
+
+
+def write_analysis(root_node, analysis):
+    """Store analysis in the document, replacing that of earlier runs"""
+    for metadata in _metadata_nodes(root_node):
+        if metadata.get('id') == analysis_id:
+            metadata.getparent().remove(metadata)
+
+    metadata = etree.SubElement(root_node, 'metadata', id = analysis_id)
+    node = etree.SubElement(metadata, '{%s}analysis' % analysis_ns,
+                            nsmap = {'pdf2pub': analysis_ns})
+    node.text = json.dumps(dict(analysis, version = analysis_version),
+                           sort_keys = True)
+
+
+def element_ids(elements):
+    """Ids of elements that are (still) in the document"""
+    return [element.get('id') for element in elements
+            if element.get('id') is not None and element.getparent() is not None]
+
+
+def restore_elements(root_node, analysis):
+    """Find the elements of a stored analysis
+
+    Returns (bbox, grid, curves_stroke, curves_fill, added), as
+    classify_elements, where added maps 'ticks', 'labels', and 'legend' to
+    the elements added by the earlier run. Elements that are no longer in
+    the document (e.g., rasterized traces) are left out.
+    """
+    wanted = set(analysis['bbox'] + analysis['grid'])
+    for curves in (analysis['strokes'], analysis['fills']):
+        for ids in curves.values():
+            wanted.update(ids)
+    for name in ('ticks', 'labels', 'legend'):
+        wanted.update(analysis[name])
+
+    found = {}
+    for element in root_node.iter():
+        if element.get('id') in wanted:
+            found[element.get('id')] = element
+
+    def lookup(ids):
+        return [found[element_id] for element_id in ids if element_id in found]
+
+    curves_stroke = {}
+    curves_fill = {}
+    for (curves, stored) in ((curves_stroke, analysis['strokes']),
+                             (curves_fill, analysis['fills'])):
+        for (color, ids) in stored.items():
+            elements = lookup(ids)
+            if elements:
+                curves[color] = elements
+
+    added = dict([(name, lookup(analysis[name])) for name in ('ticks', 'labels', 'legend')])
+    return (lookup(analysis['bbox']), lookup(analysis['grid']),
+            curves_stroke, curves_fill, added)
+
+
+def changed_sections(previous, current):
+    """Sections ('traces', 'ticks', 'legend') a re-run must redo
+
+    previous are the options stored with the analysis and current those of
+    the re-run. Returns a dict mapping each section to whether any of the
+    options it depends on changed.
+    """
+    current = json.loads(json.dumps(current))
+    changed = set([name for name in current if previous.get(name) != current[name]])
+    resized = bool(changed.intersection(size_options))
+
+    return dict([(section, resized or bool(changed.intersection(options)))
+                 for (section, options) in section_options.items()])
+
+
+def analysis_report(analysis, bbox, grid, curves_stroke, curves_fill):
+    """What pdf2pub detected in a figure, as a JSON-able dict
+
+    The report has the plot area (x, y, width, height, in user units),
+    the ids of the bounding box and grid elements, the number of trace
+    elements of each stroke and fill color, and for each axes its size,
+    axis positions, grid positions, and axis labels.
+    """
+    (nw_x, nw_y, se_x, se_y) = analysis['extents']
+    axes = []
+    for positions in analysis['axes']:
+        (xlabel, ylabel) = positions['labels']
+        axes.append({'size': positions['size'],
+                     'xaxis': positions['xaxis'],
+                     'yaxis': positions['yaxis'],
+                     'xgrid': sorted(positions['xgrid']),
+                     'ygrid': sorted(positions['ygrid']),
+                     'xlabel': xlabel,
+                     'ylabel': ylabel})
+
+    return {'plot_area': [nw_x, nw_y, se_x - nw_x, se_y - nw_y],
+            'bbox': element_ids(bbox),
+            'grid': element_ids(grid),
+            'strokes': dict([(color, len(curves_stroke[color])) for color in curves_stroke]),
+            'fills': dict([(color, len(curves_fill[color])) for color in curves_fill]),
+            'axes': axes}
+
+
+def write_report(report, filename=''):
+    """Write report as JSON to filename (standard output if empty or -)"""
+    if filename in ('', '-'):
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+            f.write('\n')
@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+"""Batch processing for pdf2pub
+
+Runs pdf2pub on many SVG files in parallel, outside of Inkscape. Takes the
+same options as the extension (see pdf2pub.inx), e.g.,
+
+    python pdf2pub_batch.py --format=half --color_pal=brewer_set1 \
+        --output_dir=pub figures/*.svg
+"""
+
+import sys, os, glob, time, json, hashlib, tempfile, itertools, multiprocessing
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from pdf2pub import pdf2pub, Pdf2pubError
+from pdf2pub_stream import stream_file
+
+
+# Fingerprints of processed figures, kept in the output directory
+manifest_name = '.pdf2pub.json'
+
+# Options that do not change the output
+fingerprint_ignore = ['tabs', 'cache', 'cache_dir', 'cache_size',
+                      'shell_pool_size', 'shell_timeout', 'stats', 'profile']
+
+# Options naming a file written by each run ({option: environment variable})
+per_figure_options = {'--stats': 'PDF2PUB_STATS', '--profile': 'PDF2PUB_PROFILE'}
+
+
+def get_parser():
+    """Extension option parser extended with batch options"""
+    parser = pdf2pub().OptionParser
+    parser.set_usage('usage: %prog [options] --output_dir=DIR SVGfile [SVGfile ...]')
+    parser.add_option('-o', '--output_dir', action='store',
+                      type='string', dest='output_dir',
+                      default='', help='Output directory')
+    parser.add_option('-j', '--jobs', action='store',
+                      type='int', dest='jobs',
+                      default=multiprocessing.cpu_count(),
+                      help='Number of parallel jobs')
+    parser.add_option('-f', '--force', action='store_true',
+                      dest='force', default=False,
+                      help='Process all files, even if up to date')
+
+    return parser
+
+
+def effect_args(options):
+    """Command line arguments that reproduce options for pdf2pub"""
+    args = []
+    for option in pdf2pub().OptionParser.option_list:
+        if option.dest is None or option.dest == 'ids':
+            continue
+        args.append('%s=%s' % (option.get_opt_string(), getattr(options, option.dest)))
+
+    return args
+
+
+def figure_args(args, filename):
+    """args with --stats and --profile files of their own for filename
+
+    Each figure writes its statistics and profile next to the given file,
+    with the name of the figure added (stats.json becomes
+    stats.figure.json), so that parallel jobs do not overwrite each other's.
+    The PDF2PUB_STATS and PDF2PUB_PROFILE environment variables are
+    handled the same way.
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    figure = []
+    for arg in args:
+        (option, value) = (arg.split('=', 1) + [''])[:2]
+        if option in per_figure_options:
+            value = value or os.environ.get(per_figure_options[option], '')
+            if value not in ('', '-'):
+                (root, ext) = os.path.splitext(value)
+                arg = '%s=%s.%s%s' % (option, root, name, ext)
+        figure.append(arg)
+
+    return figure
+
+
+def code_fingerprint():
+    """Hash of the pdf2pub sources, so that updates rebuild all figures"""
+    h = hashlib.sha1()
+    for filename in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                  'pdf2pub*.py'))):
+        with open(filename, 'rb') as f:
+            h.update(f.read())
+
+    return h.hexdigest()
+
+
+def fingerprint(filename, options, code=''):
+    """Hash of the contents of filename and of the options affecting it"""
+    h = hashlib.sha1(code.encode('utf-8'))
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    for option in sorted(pdf2pub().OptionParser.option_list,
+                         key=lambda option: option.get_opt_string()):
+        if option.dest is None or option.dest == 'ids' or option.dest in fingerprint_ignore:
+            continue
+        h.update(('\0%s=%s' % (option.dest, getattr(options, option.dest))).encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def load_manifest(output_dir):
+    """Fingerprints of the figures in output_dir ({output name: fingerprint})"""
+    try:
+        with open(os.path.join(output_dir, manifest_name)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_manifest(output_dir, manifest):
+    """Atomically replace the manifest of output_dir"""
+    (fd, tmp) = tempfile.mkstemp(dir=output_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    filename = os.path.join(output_dir, manifest_name)
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp, filename)
+
+
+def output_path(filename, output_dir, analyze_only=False):
+    """Output of filename (its JSON report if only analyzing it)"""
+    if analyze_only:
+        return os.path.join(output_dir, os.path.splitext(os.path.basename(filename))[0] + '.json')
+    return os.path.join(output_dir, os.path.basename(filename))
+
+
+def name_clashes(files, analyze_only=False):
+    """Groups of files whose outputs (and manifest entries) have the same name
+
+    Outputs are named after the input file only, so that inputs with the
+    same name in different directories would overwrite each other.
+    """
+    names = {}
+    for filename in files:
+        name = os.path.basename(output_path(filename, '', analyze_only))
+        names.setdefault(name, {})[os.path.abspath(filename)] = filename
+
+    return [sorted(group.values()) for (name, group) in sorted(names.items())
+            if len(group) > 1]
+
+
+def expand_files(patterns):
+    """Expand glob patterns (shells on Windows do not), keeping order"""
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for filename in matches:
+            if filename not in files:
+                files.append(filename)
+
+    return files
+
+
+def process_file(job):
+    """Run pdf2pub on one file
+
+    Returns (filename, output, error, warnings, seconds), where error is
+    None on success. Errors never propagate, so that one bad figure does
+    not abort the batch.
+    """
+    (filename, output, args) = job
+    args = figure_args(args, filename)
+    start = time.time()
+    error = None
+
+    # Collect warnings written by inkex.errormsg
+    stderr = sys.stderr
+    sys.stderr = log = StringIO()
+    try:
+        if os.path.abspath(filename) == os.path.abspath(output):
+            raise Pdf2pubError('Error! Output would overwrite input file.')
+        # Reports are never streamed, the figure would be written instead
+        if '--analyze_only=true' in args:
+            e = pdf2pub()
+            e.affect(args=args + ['--report=%s' % output, filename], output=False)
+        elif '--stream=true' in args:
+            stream_file(filename, output, args)
+        else:
+            e = pdf2pub()
+            e.affect(args=args + [filename], output=False)
+            e.document.write(output)
+    except Pdf2pubError as err:
+        error = str(err)
+    except SystemExit:
+        error = 'Error! Processing was aborted.'
+    except Exception as err:
+        error = '%s: %s' % (type(err).__name__, err)
+    finally:
+        sys.stderr = stderr
+
+    return (filename, output, error, log.getvalue().strip(), time.time() - start)
+
+
+def run_batch(files, output_dir, args, jobs=1, report=None, pool=None):
+    """Process files into output_dir using jobs processes
+
+    Calls report with the result of each file (see process_file) as soon as
+    it is done and returns the list of all results. If pool is given, its
+    workers are used (and left running) instead of starting new ones.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    analyze_only = '--analyze_only=true' in args
+    batch = [(filename, output_path(filename, output_dir, analyze_only), args) for filename in files]
+
+    results = []
+    if pool is None and (jobs <= 1 or len(batch) <= 1):
+        for job in batch:
+            results.append(process_file(job))
+            if report is not None:
+                report(results[-1])
+    elif pool is not None:
+        for result in pool.imap_unordered(process_file, batch):
+            results.append(result)
+            if report is not None:
+                report(result)
+    else:
+        pool = multiprocessing.Pool(min(jobs, len(batch)))
+        try:
+            for result in pool.imap_unordered(process_file, batch):
+                results.append(result)
+                if report is not None:
+                    report(result)
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    return results
+
+
+def report_result(result):
+    """Print a one-line summary of a processed file"""
+    (filename, output, error, warnings, seconds) = result
+    if error is None:
+        sys.stdout.write('ok      %s -> %s (%.2f s)\n' % (filename, output, seconds))
+    else:
+        sys.stdout.write('FAILED  %s: %s\n' % (filename, error))
+    for line in warnings.splitlines():
+        if line.strip():
+            sys.stdout.write('        %s\n' % line.strip())
+    sys.stdout.flush()
+
+
+def build(files, options, manifest, pool=None):
+    """Process the files that are not up to date and update the manifest
+
+    Returns (results, skipped): the results of the processed files and the
+    number of up-to-date files.
+    """
+    code = code_fingerprint()
+    fingerprints = {}
+    outdated = []
+    for filename in files:
+        try:
+            fingerprints[filename] = fingerprint(filename, options, code)
+        except (IOError, OSError):
+            fingerprints[filename] = None
+        name = os.path.basename(filename)
+        if (options.force or fingerprints[filename] is None or
+                manifest.get(name) != fingerprints[filename] or
+                not os.path.exists(output_path(filename, options.output_dir,
+                                               options.analyze_only == 'true'))):
+            outdated.append(filename)
+        else:
+            sys.stdout.write('skipped %s (up to date)\n' % filename)
+    sys.stdout.flush()
+
+    # Record results as they come, so that an interrupted build is kept
+    results = []
+    def report(result):
+        results.append(result)
+        report_result(result)
+
+    try:
+        run_batch(outdated, options.output_dir, effect_args(options),
+                  options.jobs, report, pool)
+    finally:
+        for (filename, output, error, warnings, seconds) in results:
+            name = os.path.basename(filename)
+            if error is None and fingerprints[filename] is not None:
+                manifest[name] = fingerprints[filename]
+            elif name in manifest:
+                del manifest[name]
+        save_manifest(options.output_dir, manifest)
+
+    return (results, len(files) - len(outdated))
+
+
+def scan(patterns, output_dir):
+    """Current (mtime, size) of the files matching patterns
+
+    Directories stand for the SVG files they contain. Files in output_dir
+    are ignored, so that outputs never trigger new builds.
+    """
+    output_dir = os.path.abspath(output_dir)
+    stats = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.svg')
+        for filename in expand_files([pattern]):
+            if os.path.dirname(os.path.abspath(filename)) == output_dir:
+                continue
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            stats[filename] = (st.st_mtime, st.st_size)
+
+    return stats
+
+
+def watch(patterns, options, manifest):
+    """Process files again whenever they change, until interrupted
+
+    Files are polled every options.poll_interval seconds. A file is only
+    processed once it stopped changing for options.debounce seconds, so
+    that bursts of writes trigger a single run. The process (and its pool
+    of workers) stays alive in between, so pdf2pub is always loaded.
+    """
+    pool = multiprocessing.Pool(options.jobs) if options.jobs > 1 else None
+
+    seen = scan(patterns, options.output_dir)
+    build(sorted(seen), options, manifest, pool)
+    sys.stdout.write('\nWatching %d files (ctrl+c to stop)...\n' % len(seen))
+    sys.stdout.flush()
+
+    # {filename: ((mtime, size), time the change was first seen)}
+    pending = {}
+    try:
+        while True:
+            time.sleep(options.poll_interval)
+            now = time.time()
+            current = scan(patterns, options.output_dir)
+
+            for (filename, stat) in current.items():
+                if seen.get(filename) != stat and pending.get(filename, (None,))[0] != stat:
+                    pending[filename] = (stat, now)
+
+            ready = []
+            for (filename, (stat, since)) in list(pending.items()):
+                if filename not in current:
+                    del pending[filename]
+                elif now - since >= options.debounce:
+                    seen[filename] = stat
+                    ready.append(filename)
+                    del pending[filename]
+
+            # New files clashing with others are reported instead
+            clashes = set(itertools.chain(*name_clashes(current, options.analyze_only == 'true')))
+            for filename in sorted(clashes.intersection(ready)):
+                report_result((filename, None, 'Error! Output would overwrite the output '
+                               'of another file with the same name.', '', 0.0))
+                ready.remove(filename)
+
+            if ready:
+                build(sorted(ready), options, manifest, pool)
+    except KeyboardInterrupt:
+        sys.stdout.write('\n')
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def main(argv=sys.argv[1:]):
+    parser = get_parser()
+    parser.add_option('-w', '--watch', action='store_true',
+                      dest='watch', default=False,
+                      help='Keep running and process files again when they change')
+    parser.add_option('--poll_interval', action='store',
+                      type='float', dest='poll_interval',
+                      default=1.0, help='Watch: seconds between checks')
+    parser.add_option('--debounce', action='store',
+                      type='float', dest='debounce',
+                      default=0.5, help='Watch: seconds a file must be unchanged')
+    (options, args) = parser.parse_args(argv)
+
+    if len(args) == 0:
+        parser.error('no input files')
+    if options.output_dir == '':
+        parser.error('an output directory is required (--output_dir)')
+
+    if not os.path.isdir(options.output_dir):
+        os.makedirs(options.output_dir)
+    manifest = load_manifest(options.output_dir)
+
+    if options.watch:
+        files = sorted(scan(args, options.output_dir))
+    else:
+        files = expand_files(args)
+    clashes = name_clashes(files, options.analyze_only == 'true')
+    if clashes:
+        parser.error('files with the same name would overwrite each other\'s output: %s' %
+                     '; '.join([', '.join(group) for group in clashes]))
+
+    if options.watch:
+        watch(args, options, manifest)
+        return 0
+
+    if len(files) == 0:
+        parser.error('no input files')
+
+    start = time.time()
+    (results, skipped) = build(files, options, manifest)
+
+    failed = len([result for result in results if result[2] is not None])
+    sys.stdout.write('\n%d succeeded, %d failed, %d up to date (%.2f s)\n' %
+                     (len(results) - failed, failed, skipped, time.time() - start))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""pdf2pub daemon
+
+Keeps pdf2pub loaded in a pool of worker processes and serves figure
+formatting jobs over a local Unix socket, so that editors, build scripts,
+and Makefiles do not pay for starting Python and importing inkex/lxml on
+every figure.
+
+    python pdf2pub_daemon.py serve --jobs=4 &
+    python pdf2pub_daemon.py send --format=half figure.svg pub/figure.svg
+
+Protocol: the client sends one JSON object per line and gets one JSON object
+per line back, in order. Requests hold
+
+    input    path of the SVG file to process, or
+    svg      the SVG document itself
+    output   path of the result (if omitted, the reply holds it as "svg")
+    options  pdf2pub options, e.g., {"format": "half", "xticks": "0,1,2"}
+    id       anything, echoed in the reply
+
+Replies hold "ok", "id", "output" or "svg", "error", "warnings", "seconds"
+(time spent formatting) and "total" (time since the request was read,
+including waiting for a worker). Relative paths are relative to the
+daemon's working directory.
+"""
+
+import sys, os, json, time, socket, signal, tempfile, multiprocessing
+
+try:
+    from SocketServer import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+except ImportError:
+    from socketserver import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+
+
+def default_socket():
+    """Per-user socket path"""
+    directory = os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir())
+    return os.path.join(directory, 'pdf2pub-%d.sock' % os.getuid())
+
+
+def option_args(options):
+    """Command line arguments for pdf2pub from an options dictionary"""
+    args = []
+    for (name, value) in sorted(options.items()):
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        args.append('--%s=%s' % (name, value))
+
+    return args
+
+
+def run_request(request):
+    """Process one request (in a worker process)"""
+    from pdf2pub_batch import process_file
+
+    temporary = []
+    try:
+        if 'svg' in request:
+            (fd, filename) = tempfile.mkstemp(suffix='.svg')
+            with os.fdopen(fd, 'wb') as f:
+                svg = request['svg']
+                f.write(svg if isinstance(svg, bytes) else svg.encode('utf-8'))
+            temporary.append(filename)
+        else:
+            filename = request['input']
+
+        output = request.get('output')
+        if not output:
+            (fd, output) = tempfile.mkstemp(suffix='.svg')
+            os.close(fd)
+            temporary.append(output)
+
+        (filename, output, error, warnings, seconds) = \
+            process_file((filename, output, option_args(request.get('options', {}))))
+
+        reply = {'ok': error is None, 'error': error, 'seconds': seconds,
+                 'warnings': [line.strip() for line in warnings.splitlines() if line.strip()]}
+        if request.get('output'):
+            reply['output'] = output
+        elif error is None:
+            with open(output, 'rb') as f:
+                reply['svg'] = f.read().decode('utf-8')
+    finally:
+        for filename in temporary:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    return reply
+
+
+def check_request(request, option_names):
+    """Return an error message for invalid requests, None otherwise"""
+    if not isinstance(request, dict):
+        return 'Request must be a JSON object'
+    if ('input' in request) == ('svg' in request):
+        return 'Request must have either "input" or "svg"'
+    if not isinstance(request.get('options', {}), dict):
+        return '"options" must be a JSON object'
+    unknown = [name for name in request.get('options', {}) if name not in option_names]
+    if unknown:
+        return 'Unknown options: %s' % ', '.join(sorted(unknown))
+
+    return None
+
+
+def _warm_up():
+    """Import pdf2pub in a new worker, before the first job arrives"""
+    import pdf2pub_batch
+
+
+class JobHandler(StreamRequestHandler):
+    """Reads requests from a connection and answers them in order"""
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            if not line.strip():
+                continue
+            reply = self.server.run_job(line)
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class Pdf2pubServer(ThreadingMixIn, UnixStreamServer):
+    """Unix socket server dispatching jobs to a pool of pdf2pub workers
+
+    Each connection is handled by its own thread, which waits for its jobs
+    on the shared worker pool, so jobs from different connections run in
+    parallel.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, jobs=1):
+        """Constructor"""
+        from pdf2pub import pdf2pub
+        self.option_names = set([option.get_opt_string()[2:]
+                                 for option in pdf2pub().OptionParser.option_list
+                                 if option.dest not in (None, 'ids')])
+
+        # Workers are started (and import pdf2pub) before we accept jobs
+        self.pool = multiprocessing.Pool(jobs, initializer=_warm_up)
+
+        UnixStreamServer.__init__(self, path, JobHandler)
+        os.chmod(path, 0o600)
+
+    def run_job(self, line):
+        start = time.time()
+        try:
+            request = json.loads(line.decode('utf-8') if isinstance(line, bytes) else line)
+        except ValueError as err:
+            return {'ok': False, 'id': None, 'error': 'Invalid JSON: %s' % err}
+
+        error = check_request(request, self.option_names)
+        if error is not None:
+            reply = {'ok': False, 'error': error}
+        else:
+            try:
+                reply = self.pool.apply(run_request, (request,))
+            except Exception as err:
+                reply = {'ok': False, 'error': '%s: %s' % (type(err).__name__, err)}
+
+        reply['id'] = request.get('id') if isinstance(request, dict) else None
+        reply['total'] = time.time() - start
+
+        return reply
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+
+
+def serve(path, jobs=1):
+    """Serve jobs on the Unix socket at path until interrupted"""
+    if os.path.exists(path):
+        # Refuse to take over the socket of a running daemon
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            os.remove(path)
+        else:
+            # Raised outside of the try: IOError is socket.error in Python 3
+            probe.close()
+            raise IOError('A daemon is already listening on %s' % path)
+
+    server = Pdf2pubServer(path, jobs)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sys.stderr.write('pdf2pub daemon listening on %s with %d workers\n' % (path, jobs))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def submit(requests, path=None):
+    """Send requests to the daemon and return its replies"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path or default_socket())
+    try:
+        stream = client.makefile('rwb')
+        replies = []
+        for request in requests:
+            stream.write((json.dumps(request) + '\n').encode('utf-8'))
+            stream.flush()
+            replies.append(json.loads(stream.readline().decode('utf-8')))
+        stream.close()
+    finally:
+        client.close()
+
+    return replies
+
+
+def main(argv=sys.argv[1:]):
+    usage = ('usage: pdf2pub_daemon.py serve [--socket=PATH] [--jobs=N]\n'
+             '       pdf2pub_daemon.py send [--socket=PATH] [--OPTION=VALUE ...] input.svg output.svg\n')
+    if len(argv) == 0 or argv[0] not in ('serve', 'send'):
+        sys.stderr.write(usage)
+        return 2
+
+    # Options are parsed by hand: the client should not import pdf2pub
+    path = default_socket()
+    jobs = multiprocessing.cpu_count()
+    options = {}
+    files = []
+    for arg in argv[1:]:
+        if arg.startswith('--') and '=' in arg:
+            (name, value) = arg[2:].split('=', 1)
+            if name == 'socket':
+                path = value
+            elif name == 'jobs' and argv[0] == 'serve':
+                jobs = int(value)
+            else:
+                options[name] = value
+        else:
+            files.append(arg)
+
+    if argv[0] == 'serve':
+        if options or files:
+            sys.stderr.write(usage)
+            return 2
+        serve(path, jobs)
+        return 0
+
+    if len(files) != 2:
+        sys.stderr.write(usage)
+        return 2
+    reply = submit([{'input': os.path.abspath(files[0]),
+                     'output': os.path.abspath(files[1]),
+                     'options': options}], path)[0]
+
+    for warning in reply.get('warnings', []):
+        sys.stderr.write('%s\n' % warning)
+    if not reply['ok']:
+        sys.stderr.write('%s\n' % reply['error'])
+        return 1
+    sys.stderr.write('%s (%.3f s, %.3f s total)\n' % (reply['output'], reply['seconds'], reply['total']))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
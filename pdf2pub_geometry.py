@@ -0,0 +1,1026 @@
+#!/usr/bin/env python
+"""Geometry queries for pdf2pub
+
+Computes the same "id,x,y,w,h" records as `inkscape --query-all`, either
+in-process from the lxml tree or by calling Inkscape itself.
+"""
+
+from subprocess import Popen, PIPE
+from functools import reduce
+import os, re, math, itertools, threading, atexit, hashlib, tempfile
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import inkex
+from simplestyle import parseStyle
+from simpletransform import parseTransform, composeTransform
+from simplepath import parsePath
+
+
+# Version of the built-in geometry engine (invalidates cached queries)
+geometry_version = '1'
+
+# Rough glyph metrics used to estimate text extents (fraction of font size)
+text_char_width = 0.55
+text_ascent = 0.75
+text_descent = 0.25
+
+# Tolerance used when cross-checking both geometry engines (user units)
+check_tolerance = 1.0
+
+# Tolerance used to classify grid lines and merge duplicate ticks (user units)
+grid_tolerance = 1e-3
+
+# Inkscape shell workers
+shell_command = 'inkscape --shell'
+shell_prompt = '>'
+
+identity = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+
+# Elements whose subtree is never rendered directly
+skip_tags = [inkex.addNS(tag, 'svg') for tag in
+             ('defs', 'metadata', 'marker', 'pattern', 'symbol', 'mask',
+              'linearGradient', 'radialGradient', 'filter', 'style')]
+skip_tags.append(inkex.addNS('namedview', 'sodipodi'))
+
+# Properties that children inherit when computing bounding boxes
+inherited_styles = ['stroke', 'stroke-width', 'font-size', 'text-anchor']
+
+
+def query_inkscape(filename):
+    """Run `inkscape --query-all` on filename and return its output"""
+    p = Popen(['inkscape', '--query-all', filename], stdout=PIPE, stderr=PIPE)
+    allpos = p.communicate()[0]
+    if not isinstance(allpos, str):
+        allpos = allpos.decode('utf-8', 'replace')
+
+    return allpos
+
+
+class InkscapeShell:
+    """A long-lived `inkscape --shell` process answering geometry queries"""
+    def __init__(self, command=shell_command, timeout=60):
+        """Constructor"""
+        self.command = command
+        self.timeout = timeout
+        self.process = None
+        self.start()
+
+    def start(self):
+        """Start Inkscape and wait for its first prompt"""
+        self.process = Popen(self.command, shell=True, stdin=PIPE,
+            stdout=PIPE, stderr=open(os.devnull, 'w'))
+
+        # Pipes are read by a separate thread so that reads can time out
+        self.output = Queue()
+        self.reader = threading.Thread(target=_read_pipe,
+            args=(self.process.stdout, self.output))
+        self.reader.daemon = True
+        self.reader.start()
+
+        self.read_reply()
+
+    def stop(self):
+        """Terminate Inkscape"""
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.process.stdin.write(b'quit\n')
+                self.process.stdin.flush()
+            except (IOError, OSError):
+                pass
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+            self.process.wait()
+            self.reader.join(1)
+        self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def read_reply(self):
+        """Read output until the next prompt"""
+        reply = ''
+        while not _prompted(reply):
+            try:
+                data = self.output.get(timeout=self.timeout)
+            except Empty:
+                raise IOError('Inkscape shell did not answer in %d seconds'
+                    % self.timeout)
+            if data is None:
+                raise IOError('Inkscape shell exited unexpectedly')
+            reply = reply + data
+
+        return reply.rstrip()[:-len(shell_prompt)]
+
+    def query(self, filename):
+        """Return `--query-all` records of filename
+
+        A worker that crashed or hangs is restarted and the query retried
+        once.
+        """
+        command = '"%s" --query-all\n' % filename.replace('"', '\\"')
+        if not isinstance(command, bytes):
+            command = command.encode('utf-8')
+        for attempt in range(2):
+            try:
+                self.process.stdin.write(command)
+                self.process.stdin.flush()
+                return self.read_reply().strip() + '\n'
+            except (IOError, OSError):
+                if attempt == 1:
+                    raise
+                self.restart()
+
+
+class InkscapeShellPool:
+    """Pool of Inkscape shell workers shared by all queries of a process"""
+    def __init__(self, size=1, timeout=60, command=shell_command):
+        """Constructor"""
+        self.size = size
+        self.timeout = timeout
+        self.idle = Queue()
+
+        # Start all workers at once, since start-up is what we are saving
+        workers = [None]*size
+        def start(i):
+            workers[i] = InkscapeShell(command, timeout)
+        threads = [threading.Thread(target=start, args=(i,)) for i in range(size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.workers = [worker for worker in workers if worker is not None]
+        if len(self.workers) == 0:
+            raise IOError('Could not start Inkscape shell')
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def query(self, filename):
+        """Run a `--query-all` job on the first idle worker"""
+        worker = self.idle.get()
+        try:
+            return worker.query(filename)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+
+_shell_pool = None
+
+def shell_pool(size=1, timeout=60):
+    """Return the process-wide Inkscape shell pool, starting it if needed"""
+    global _shell_pool
+    if _shell_pool is None or _shell_pool.size != size or _shell_pool.timeout != timeout:
+        if _shell_pool is not None:
+            _shell_pool.close()
+        _shell_pool = InkscapeShellPool(size, timeout)
+
+    return _shell_pool
+
+
+@atexit.register
+def _close_shell_pool():
+    if _shell_pool is not None:
+        _shell_pool.close()
+
+
+def _read_pipe(pipe, output):
+    """Forward data from pipe to the output queue (None on EOF)"""
+    while True:
+        data = os.read(pipe.fileno(), 65536)
+        if not data:
+            output.put(None)
+            return
+        if not isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        output.put(data)
+
+
+def _prompted(reply):
+    reply = reply.rstrip(' ')
+    return reply.endswith(shell_prompt) and (reply == shell_prompt or
+        reply[-len(shell_prompt)-1] == '\n')
+
+
+class QueryCache:
+    """On-disk cache of `--query-all` records
+
+    Entries are keyed by a hash of the input document and of the engine that
+    produced them. The least recently used entries are evicted once the
+    cache grows beyond max_size bytes.
+    """
+    def __init__(self, directory, max_size):
+        """Constructor"""
+        self.directory = directory
+        self.max_size = max_size
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, filename, engine):
+        """Hash of the contents of filename and of the engine version"""
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        h.update(('\0%s\0%s' % (engine, engine_version(engine))).encode('utf-8'))
+
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.txt')
+
+    def get(self, key):
+        """Return cached records or None"""
+        try:
+            with open(self.path(key), 'rb') as f:
+                allpos = f.read()
+        except (IOError, OSError):
+            return None
+
+        # Mark entry as recently used
+        try:
+            os.utime(self.path(key), None)
+        except OSError:
+            pass
+
+        if not isinstance(allpos, str):
+            allpos = allpos.decode('utf-8')
+
+        return allpos
+
+    def put(self, key, allpos):
+        """Store records and evict old entries if needed"""
+        if not isinstance(allpos, bytes):
+            allpos = allpos.encode('utf-8')
+
+        # Write atomically so that concurrent runs never see partial entries
+        (fd, tmp) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(allpos)
+        try:
+            if os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+            os.rename(tmp, self.path(key))
+        except OSError:
+            os.remove(tmp)
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under max_size"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.txt'):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum([entry[1] for entry in entries])
+        for (mtime, size, name) in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total = total - size
+            except OSError:
+                pass
+
+
+def default_cache_dir():
+    """Per-user cache directory"""
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+
+    return os.path.join(base, 'pdf2pub')
+
+
+def engine_version(engine):
+    """Version string of a geometry engine
+
+    For engines backed by Inkscape, the path and modification time of the
+    executable stand in for its version, which avoids starting Inkscape.
+    """
+    if engine == 'python':
+        return geometry_version
+
+    executable = which('inkscape')
+    if executable is None:
+        return 'none'
+
+    return '%s:%d' % (executable, os.stat(executable).st_mtime)
+
+
+def query_all(root_node, unittouu=None):
+    """Compute `--query-all` records for every element below root_node
+
+    Coordinates are in user units of the document (y axis pointing down) and
+    bounding boxes are visual, i.e., they include half the stroke width as
+    Inkscape does by default.
+    """
+    records = []
+    _visit(root_node, identity, {}, records, unittouu)
+
+    return '\n'.join(['%s,%f,%f,%f,%f' % record for record in records]) + '\n'
+
+
+def compare_queries(allpos, reference, tolerance=check_tolerance):
+    """Return ids whose records differ between two `--query-all` outputs"""
+    ref = parse_query(reference)
+    mismatches = []
+    for (element_id, values) in parse_query(allpos).items():
+        if element_id not in ref:
+            mismatches.append(element_id)
+        elif any([abs(a - b) > tolerance for (a, b) in zip(values, ref[element_id])]):
+            mismatches.append(element_id)
+
+    return sorted(mismatches)
+
+
+def parse_query(allpos):
+    """Parse `--query-all` output into {id: (x, y, w, h)}"""
+    records = {}
+    for line in allpos.splitlines():
+        fields = line.strip().split(',')
+        if len(fields) == 5:
+            try:
+                records[fields[0]] = tuple([float(value) for value in fields[1:]])
+            except ValueError:
+                pass
+
+    return records
+
+
+_number = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+_line_re = re.compile(r'^\s*([Mm])\s*(%s)[\s,]*(%s)[\s,]*([LlHhVv]?)\s*(%s)(?:[\s,]*(%s))?'
+                      % (_number, _number, _number, _number))
+
+def path_endpoints(elements):
+    """First two points of each element's path data
+
+    Returns an array (a list of lists if NumPy is not available) with one
+    row [x1, y1, x2, y2] per element. Paths with less than two points get
+    NaN coordinates. The common "M x,y L x,y" forms (absolute, relative or
+    horizontal/vertical) are read directly, anything else with parsePath.
+    """
+    nan = float('nan')
+    rows = []
+    for element in elements:
+        d = element.get('d', '')
+        data = _line_re.match(d)
+        # A lone number is an incomplete implicit lineto (not H or V)
+        if data is not None and (data.group(6) is not None or
+                                 (data.group(4) and data.group(4) in 'HhVv')):
+            x1 = float(data.group(2))
+            y1 = float(data.group(3))
+            cmd = data.group(4) or ('l' if data.group(1) == 'm' else 'L')
+            a = float(data.group(5))
+            if cmd == 'L':
+                (x2, y2) = (a, float(data.group(6)))
+            elif cmd == 'l':
+                (x2, y2) = (x1 + a, y1 + float(data.group(6)))
+            elif cmd == 'H':
+                (x2, y2) = (a, y1)
+            elif cmd == 'h':
+                (x2, y2) = (x1 + a, y1)
+            elif cmd == 'V':
+                (x2, y2) = (x1, a)
+            else:
+                (x2, y2) = (x1, y1 + a)
+            rows.append([x1, y1, x2, y2])
+        else:
+            # simplepath raises on malformed path data
+            try:
+                path = parsePath(d)
+            except Exception:
+                path = []
+            if len(path) >= 2 and len(path[0][1]) >= 2 and len(path[1][1]) >= 2:
+                rows.append(path[0][1][0:2] + path[1][1][0:2])
+            else:
+                rows.append([nan]*4)
+
+    if numpy is not None:
+        return numpy.array(rows, dtype=float).reshape(-1, 4)
+
+    return rows
+
+
+def find_axes(endpoints):
+    """Bottom (xaxis) and left (yaxis) coordinates of the bounding box
+
+    Zero length paths are disconsidered.
+    """
+    if numpy is not None:
+        (x1, y1, x2, y2) = endpoints.T
+        valid = ~numpy.isnan(endpoints).any(axis=1) & ((x1 != x2) | (y1 != y2))
+        if not valid.any():
+            return (0, float('inf'))
+
+        xaxis = float(numpy.maximum(y1, y2)[valid].max())
+        yaxis = float(numpy.minimum(x1, x2)[valid].min())
+        return (xaxis, yaxis)
+
+    rows = [row for row in endpoints
+            if row[0] == row[0] and (row[0:2] != row[2:4])]
+    if len(rows) == 0:
+        return (0, float('inf'))
+
+    return (max([max(row[1], row[3]) for row in rows]),
+            min([min(row[0], row[2]) for row in rows]))
+
+
+def find_frame(endpoints):
+    """Rectangle (left, top, right, bottom) spanned by the bounding box
+
+    Zero length paths are disconsidered. Returns None if there are no
+    bounding box paths.
+    """
+    if numpy is not None:
+        (x1, y1, x2, y2) = endpoints.T
+        valid = ~numpy.isnan(endpoints).any(axis=1) & ((x1 != x2) | (y1 != y2))
+        if not valid.any():
+            return None
+
+        xs = numpy.concatenate((x1[valid], x2[valid]))
+        ys = numpy.concatenate((y1[valid], y2[valid]))
+        return (float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max()))
+
+    rows = [row for row in endpoints
+            if row[0] == row[0] and (row[0:2] != row[2:4])]
+    if len(rows) == 0:
+        return None
+
+    xs = [row[0] for row in rows] + [row[2] for row in rows]
+    ys = [row[1] for row in rows] + [row[3] for row in rows]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def split_grid(endpoints, tolerance=grid_tolerance):
+    """Positions of vertical (xgrid) and horizontal (ygrid) grid lines
+
+    Returns (xgrid, ygrid, oblique): sorted positions, with lines closer
+    than tolerance merged, and the number of oblique lines. Zero length
+    paths are disconsidered.
+    """
+    if numpy is not None:
+        (x1, y1, x2, y2) = endpoints.T
+        valid = ~numpy.isnan(endpoints).any(axis=1) & ((x1 != x2) | (y1 != y2))
+        with numpy.errstate(invalid='ignore'):
+            vertical = valid & (numpy.abs(x1 - x2) <= tolerance)
+            horizontal = valid & ~vertical & (numpy.abs(y1 - y2) <= tolerance)
+        oblique = int((valid & ~vertical & ~horizontal).sum())
+
+        return (_unique(numpy.sort(x1[vertical]), tolerance),
+                _unique(numpy.sort(y1[horizontal]), tolerance), oblique)
+
+    xgrid = []
+    ygrid = []
+    oblique = 0
+    for row in endpoints:
+        if row[0] != row[0] or row[0:2] == row[2:4]:
+            continue
+        if abs(row[0] - row[2]) <= tolerance:
+            xgrid.append(row[0])
+        elif abs(row[1] - row[3]) <= tolerance:
+            ygrid.append(row[1])
+        else:
+            oblique = oblique + 1
+
+    return (_unique(sorted(xgrid), tolerance), _unique(sorted(ygrid), tolerance), oblique)
+
+
+def _unique(positions, tolerance):
+    """Merge sorted positions closer than tolerance"""
+    if numpy is not None and isinstance(positions, numpy.ndarray):
+        if len(positions) == 0:
+            return []
+        keep = numpy.concatenate(([True], numpy.diff(positions) > tolerance))
+        return positions[keep].tolist()
+
+    unique = []
+    for position in positions:
+        if len(unique) == 0 or position - unique[-1] > tolerance:
+            unique.append(position)
+
+    return unique
+
+
+class BoxIndex:
+    """Spatial index of bounding boxes over a uniform grid
+
+    Boxes are (left, top, right, bottom) tuples. Each box is listed in all
+    grid cells it overlaps, so that the boxes near a point or box are found
+    without going through all of them.
+    """
+    def __init__(self, cell):
+        """Constructor"""
+        self.cell = float(cell)
+        self.cells = {}
+        self.items = []
+        self.bounds = None
+
+    def insert(self, box, item):
+        """Add item with bounding box box"""
+        self.items.append((box, item))
+        cells = self._cells(box)
+        for key in itertools.product(range(cells[0], cells[2] + 1), range(cells[1], cells[3] + 1)):
+            self.cells.setdefault(key, []).append(len(self.items) - 1)
+        self.bounds = _union(self.bounds, cells)
+
+    def intersecting(self, box):
+        """Items whose boxes intersect box, in insertion order"""
+        cells = self._cells(box)
+        found = set()
+        for key in itertools.product(range(cells[0], cells[2] + 1), range(cells[1], cells[3] + 1)):
+            for index in self.cells.get(key, []):
+                if _intersects(self.items[index][0], box):
+                    found.add(index)
+
+        return [self.items[index][1] for index in sorted(found)]
+
+    def nearest(self, point):
+        """Item whose box is the closest to point, None if there are none"""
+        if self.bounds is None:
+            return None
+
+        # Look in growing squares of cells around point. Once a box is
+        # found, closer ones can only be a few rings of cells away.
+        (i, j) = self._cells(point + point)[0:2]
+        rings = max(abs(i - self.bounds[0]), abs(i - self.bounds[2]),
+                    abs(j - self.bounds[1]), abs(j - self.bounds[3]))
+        for ring in range(rings + 1):
+            box = (point[0] - ring*self.cell, point[1] - ring*self.cell,
+                   point[0] + ring*self.cell, point[1] + ring*self.cell)
+            if self.intersecting(box):
+                ring = int(math.ceil((ring + 1)*math.sqrt(2)))
+                box = (point[0] - ring*self.cell, point[1] - ring*self.cell,
+                       point[0] + ring*self.cell, point[1] + ring*self.cell)
+                break
+
+        candidates = [index for index in range(len(self.items))
+                      if _intersects(self.items[index][0], box)]
+        return self.items[min(candidates, key=lambda index:
+                              (_distance(self.items[index][0], point), index))][1]
+
+    def _cells(self, box):
+        return tuple([int(math.floor(value/self.cell)) for value in box])
+
+
+def split_axes(bbox, grid, tolerance=grid_tolerance):
+    """Group the bounding box and grid paths of subplots by axes
+
+    Bounding box paths (boxes and tick marks) that touch each other make up
+    one axes. Grid paths go to the axes whose bounding box contains their
+    midpoint, or else to the closest one. Returns a list of (bbox paths,
+    grid paths, frame) in reading order (see find_frame for frame).
+    """
+    segments = []
+    for (element, row) in zip(bbox, path_endpoints(bbox)):
+        (x1, y1, x2, y2) = [float(value) for value in row]
+        if x1 == x1 and (x1 != x2 or y1 != y2):
+            segments.append((element, (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))))
+    if len(segments) == 0:
+        return []
+
+    extents = reduce(_union, [box for (element, box) in segments])
+    index = BoxIndex(max(extents[2] - extents[0], extents[3] - extents[1], tolerance)/16)
+    for (k, (element, box)) in enumerate(segments):
+        index.insert(box, k)
+
+    # Union-find over touching segments
+    parents = list(range(len(segments)))
+
+    def find(k):
+        while parents[k] != k:
+            parents[k] = parents[parents[k]]
+            k = parents[k]
+        return k
+
+    for (k, (element, box)) in enumerate(segments):
+        grown = (box[0] - tolerance, box[1] - tolerance, box[2] + tolerance, box[3] + tolerance)
+        for other in index.intersecting(grown):
+            parents[find(other)] = find(k)
+
+    clusters = {}
+    for k in range(len(segments)):
+        clusters.setdefault(find(k), []).append(k)
+
+    axes = []
+    for members in clusters.values():
+        frame = reduce(_union, [segments[k][1] for k in members])
+        axes.append(([segments[k][0] for k in members], [], frame))
+    axes.sort(key=lambda item: (item[2][1], item[2][0]))
+
+    points = [[(float(row[0]) + float(row[2]))/2, (float(row[1]) + float(row[3]))/2]
+              for row in path_endpoints(grid)]
+    for (element, owner) in zip(grid, locate([frame for (_, _, frame) in axes], points)):
+        axes[owner][1].append(element)
+
+    return axes
+
+
+def locate(frames, points):
+    """Index of the frame each point falls in (or is the closest to)
+
+    Points with NaN coordinates go to the first frame.
+    """
+    extents = reduce(_union, frames)
+    index = BoxIndex(max(extents[2] - extents[0], extents[3] - extents[1], grid_tolerance)/4)
+    for (k, frame) in enumerate(frames):
+        index.insert(frame, k)
+
+    owners = []
+    for point in points:
+        if point[0] != point[0] or point[1] != point[1]:
+            owners.append(0)
+            continue
+        inside = index.intersecting((point[0], point[1], point[0], point[1]))
+        owners.append(inside[0] if inside else index.nearest(point))
+
+    return owners
+
+
+def _intersects(box, other):
+    return (box[0] <= other[2] and other[0] <= box[2] and
+            box[1] <= other[3] and other[1] <= box[3])
+
+
+def _distance(box, point):
+    """Distance from point to the closest point of box"""
+    return math.hypot(max(box[0] - point[0], 0, point[0] - box[2]),
+                      max(box[1] - point[1], 0, point[1] - box[3]))
+
+
+def query_element(element, mat=identity, parent_style={}, unittouu=None):
+    """Compute the `--query-all` records of element and its descendants
+
+    mat and parent_style are the transform and inherited properties of its
+    parent (see element_context), so that elements can be measured out of
+    their document, e.g., while streaming it. Returns (bbox, records).
+    """
+    records = []
+    bbox = _visit(element, mat, parent_style, records, unittouu)
+
+    return (bbox, records)
+
+
+def element_context(element, mat=identity, parent_style={}):
+    """Transform and inherited properties of element, given its parent's"""
+    mat = composeTransform(mat, parseTransform(element.get('transform')))
+
+    # Resolve inherited presentation properties
+    style = dict(parent_style)
+    element_style = parseStyle(element.get('style'))
+    for name in inherited_styles:
+        if element.get(name) is not None:
+            style[name] = element.get(name)
+        if name in element_style:
+            style[name] = element_style[name]
+
+    return (mat, style)
+
+
+def ancestor_context(element):
+    """Transform and inherited properties of element's parent
+
+    Same as the mat and parent_style of query_element, for an element
+    within its document.
+    """
+    (mat, style) = (identity, {})
+    for ancestor in reversed(list(element.iterancestors())):
+        (mat, style) = element_context(ancestor, mat, style)
+
+    return (mat, style)
+
+
+def element_transform(element):
+    """Transform from the user space of element to document coordinates"""
+    return composeTransform(ancestor_context(element)[0], parseTransform(element.get('transform')))
+
+
+def transform_box(mat, box):
+    """Rectangle (left, top, right, bottom) spanned by box under mat"""
+    (left, top, right, bottom) = box
+    return _points_bbox([[left, top], [right, top], [right, bottom], [left, bottom]], mat)
+
+
+def _visit(element, mat, parent_style, records, unittouu):
+    """Return bbox of element (in document coordinates) and record it"""
+    if not isinstance(element.tag, str) or element.tag in skip_tags:
+        return None
+
+    (mat, style) = element_context(element, mat, parent_style)
+
+    tag = element.tag.split('}')[-1]
+    if element.tag == inkex.addNS('clipPath', 'svg'):
+        # Clip paths are listed, but do not contribute to their parent
+        for child in element:
+            _visit(child, mat, style, records, unittouu)
+        return None
+    elif tag in ('svg', 'g', 'a', 'switch'):
+        bbox = None
+        record_idx = len(records)
+        for child in element:
+            bbox = _union(bbox, _visit(child, mat, style, records, unittouu))
+        if element.get('id') is not None and bbox is not None:
+            records.insert(record_idx, _record(element.get('id'), bbox))
+        return bbox
+    elif tag == 'text':
+        # Records its own nodes, <text> first and then <tspan> children
+        return _text_bbox(element, mat, style, records, unittouu)
+    elif tag == 'use':
+        bbox = _use_bbox(element, mat, style, records, unittouu)
+    else:
+        points = _shape_points(element)
+        bbox = _points_bbox(points, mat)
+        if bbox is not None and style.get('stroke', 'none') != 'none':
+            half = _length(style.get('stroke-width', '1'), unittouu)/2
+            half = half*math.sqrt(abs(mat[0][0]*mat[1][1] - mat[0][1]*mat[1][0]))
+            bbox = (bbox[0] - half, bbox[1] - half, bbox[2] + half, bbox[3] + half)
+
+    if element.get('id') is not None and bbox is not None:
+        records.append(_record(element.get('id'), bbox))
+
+    return bbox
+
+
+def _record(element_id, bbox):
+    return (element_id, bbox[0], bbox[1], bbox[2] - bbox[0], bbox[3] - bbox[1])
+
+
+def _union(bbox, other):
+    if bbox is None:
+        return other
+    if other is None:
+        return bbox
+
+    return (min(bbox[0], other[0]), min(bbox[1], other[1]),
+            max(bbox[2], other[2]), max(bbox[3], other[3]))
+
+
+def _length(value, unittouu):
+    """Convert a length to user units"""
+    if unittouu is not None:
+        return unittouu(value.strip())
+
+    number = re.match(r'\s*([-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?)', value)
+    return float(number.group(1)) if number else 0.0
+
+
+def _numbers(value):
+    return [float(number) for number in
+            re.findall(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?', value or '')]
+
+
+def _points_bbox(points, mat):
+    """Bbox of a list of points (or Bezier control polygons) under mat
+
+    Each item of points is either a point [x, y] or a list of 3 or 4 points
+    representing a quadratic or cubic Bezier segment.
+    """
+    bbox = None
+    for item in points:
+        if isinstance(item[0], list):
+            segment = [_apply(mat, point) for point in item]
+            if len(segment) == 3:
+                # Degree elevation to cubic
+                segment = [segment[0],
+                           [segment[0][i] + 2.0/3*(segment[1][i] - segment[0][i]) for i in (0, 1)],
+                           [segment[2][i] + 2.0/3*(segment[1][i] - segment[2][i]) for i in (0, 1)],
+                           segment[2]]
+            for point in _cubic_extrema(segment):
+                bbox = _union(bbox, (point[0], point[1], point[0], point[1]))
+        else:
+            point = _apply(mat, item)
+            bbox = _union(bbox, (point[0], point[1], point[0], point[1]))
+
+    return bbox
+
+
+def _apply(mat, point):
+    return [mat[0][0]*point[0] + mat[0][1]*point[1] + mat[0][2],
+            mat[1][0]*point[0] + mat[1][1]*point[1] + mat[1][2]]
+
+
+def _cubic_extrema(segment):
+    """Endpoints and axis-aligned extrema of a cubic Bezier segment"""
+    (p0, p1, p2, p3) = segment
+    points = [p0, p3]
+    for i in (0, 1):
+        # Derivative (divided by 3) is a*t^2 + b*t + c
+        a = p3[i] - 3*p2[i] + 3*p1[i] - p0[i]
+        b = 2*(p2[i] - 2*p1[i] + p0[i])
+        c = p1[i] - p0[i]
+
+        if abs(a) < 1e-12:
+            roots = [-c/b] if abs(b) > 1e-12 else []
+        else:
+            delta = b*b - 4*a*c
+            if delta < 0:
+                roots = []
+            else:
+                roots = [(-b + math.sqrt(delta))/(2*a), (-b - math.sqrt(delta))/(2*a)]
+
+        for t in roots:
+            if 0 < t < 1:
+                points.append([(1-t)**3*p0[j] + 3*(1-t)**2*t*p1[j] +
+                               3*(1-t)*t**2*p2[j] + t**3*p3[j] for j in (0, 1)])
+
+    return points
+
+
+def _arc_points(start, params):
+    """Sample an elliptical arc given in SVG endpoint parameterization"""
+    (rx, ry, phi, large_arc, sweep, x, y) = params
+    end = [x, y]
+    rx = abs(rx)
+    ry = abs(ry)
+    if rx == 0 or ry == 0 or start == end:
+        return [end]
+
+    phi = math.radians(phi)
+    (cos_phi, sin_phi) = (math.cos(phi), math.sin(phi))
+    dx = (start[0] - x)/2
+    dy = (start[1] - y)/2
+    x1 = cos_phi*dx + sin_phi*dy
+    y1 = -sin_phi*dx + cos_phi*dy
+
+    # Scale radii up if they cannot span the endpoints
+    lam = (x1/rx)**2 + (y1/ry)**2
+    if lam > 1:
+        rx = rx*math.sqrt(lam)
+        ry = ry*math.sqrt(lam)
+
+    num = rx*rx*ry*ry - rx*rx*y1*y1 - ry*ry*x1*x1
+    den = rx*rx*y1*y1 + ry*ry*x1*x1
+    coef = math.sqrt(max(num, 0)/den) if den else 0
+    if large_arc == sweep:
+        coef = -coef
+    cx1 = coef*rx*y1/ry
+    cy1 = -coef*ry*x1/rx
+    cx = cos_phi*cx1 - sin_phi*cy1 + (start[0] + x)/2
+    cy = sin_phi*cx1 + cos_phi*cy1 + (start[1] + y)/2
+
+    theta = math.atan2((y1 - cy1)/ry, (x1 - cx1)/rx)
+    dtheta = math.atan2((-y1 - cy1)/ry, (-x1 - cx1)/rx) - theta
+    if sweep and dtheta < 0:
+        dtheta = dtheta + 2*math.pi
+    elif not sweep and dtheta > 0:
+        dtheta = dtheta - 2*math.pi
+
+    points = []
+    for k in range(1, 17):
+        angle = theta + dtheta*k/16.0
+        points.append([cx + rx*math.cos(angle)*cos_phi - ry*math.sin(angle)*sin_phi,
+                       cy + rx*math.cos(angle)*sin_phi + ry*math.sin(angle)*cos_phi])
+
+    return points
+
+
+def _path_points(d):
+    """Points and Bezier segments of path data"""
+    points = []
+    pen = [0.0, 0.0]
+    start = pen
+    for (cmd, params) in parsePath(d):
+        if cmd == 'Z':
+            pen = start
+            continue
+        elif cmd == 'M':
+            start = list(params[0:2])
+            points.append(params[0:2])
+        elif cmd == 'L':
+            points.append(params[0:2])
+        elif cmd == 'C':
+            points.append([pen, params[0:2], params[2:4], params[4:6]])
+        elif cmd == 'Q':
+            points.append([pen, params[0:2], params[2:4]])
+        elif cmd == 'A':
+            points.extend(_arc_points(pen, params))
+        pen = list(params[-2:])
+
+    return points
+
+
+def _shape_points(element):
+    """Points describing the geometry of a basic shape or path"""
+    tag = element.tag.split('}')[-1]
+    get = lambda name: float(element.get(name, 0))
+
+    if tag == 'path':
+        return _path_points(element.get('d', ''))
+    elif tag in ('rect', 'image'):
+        return [[get('x'), get('y')],
+                [get('x') + get('width'), get('y') + get('height')]]
+    elif tag == 'line':
+        return [[get('x1'), get('y1')], [get('x2'), get('y2')]]
+    elif tag in ('circle', 'ellipse'):
+        rx = get('r') if tag == 'circle' else get('rx')
+        ry = get('r') if tag == 'circle' else get('ry')
+        # Four quarter-circle cubic segments
+        k = 0.5522847498
+        (cx, cy) = (get('cx'), get('cy'))
+        return [[[cx + rx, cy], [cx + rx, cy + k*ry], [cx + k*rx, cy + ry], [cx, cy + ry]],
+                [[cx, cy + ry], [cx - k*rx, cy + ry], [cx - rx, cy + k*ry], [cx - rx, cy]],
+                [[cx - rx, cy], [cx - rx, cy - k*ry], [cx - k*rx, cy - ry], [cx, cy - ry]],
+                [[cx, cy - ry], [cx + k*rx, cy - ry], [cx + rx, cy - k*ry], [cx + rx, cy]]]
+    elif tag in ('polyline', 'polygon'):
+        coords = _numbers(element.get('points'))
+        return [coords[i:i+2] for i in range(0, len(coords) - 1, 2)]
+
+    return []
+
+
+def _text_bbox(element, mat, style, records, unittouu):
+    """Estimate the bbox of a <text> element and its <tspan> children
+
+    Glyph outlines are not available outside Inkscape, so extents are
+    estimated from the font size, the number of characters and, when
+    present, the per-glyph x positions written by the PDF import.
+    """
+    text_x = _numbers(element.get('x'))[:1] or [0.0]
+    text_y = _numbers(element.get('y'))[:1] or [0.0]
+
+    bbox = None
+    record_idx = len(records)
+    pieces = [(element, style)]
+    for child in element.iter(inkex.addNS('tspan', 'svg')):
+        child_style = dict(style)
+        child_style.update([(name, value) for (name, value) in
+                            parseStyle(child.get('style')).items()
+                            if name in inherited_styles])
+        pieces.append((child, child_style))
+
+    for (piece, piece_style) in pieces:
+        text = piece.text
+        if text is None or text.strip() == '':
+            continue
+
+        size = _length(piece_style.get('font-size', '12px'), unittouu)
+        xs = _numbers(piece.get('x')) or text_x
+        ys = _numbers(piece.get('y')) or text_y
+
+        if len(xs) > 1:
+            width = xs[-1] - xs[0] + text_char_width*size
+        else:
+            width = len(text.strip())*text_char_width*size
+
+        x0 = xs[0]
+        anchor = piece_style.get('text-anchor', 'start')
+        if anchor == 'middle':
+            x0 = x0 - width/2
+        elif anchor == 'end':
+            x0 = x0 - width
+
+        piece_bbox = _points_bbox([[x0, ys[0] - text_ascent*size],
+                                   [x0 + width, ys[0] + text_descent*size]], mat)
+        if piece is not element and piece.get('id') is not None:
+            records.append(_record(piece.get('id'), piece_bbox))
+        bbox = _union(bbox, piece_bbox)
+
+    # Keep <text> before its <tspan> nodes as Inkscape does
+    if element.get('id') is not None and bbox is not None:
+        records.insert(record_idx, _record(element.get('id'), bbox))
+
+    return bbox
+
+
+def _use_bbox(element, mat, style, records, unittouu):
+    """Bbox of a <use> clone"""
+    href = element.get(inkex.addNS('href', 'xlink')) or element.get('href')
+    if href is None or not href.startswith('#'):
+        return None
+
+    targets = element.getroottree().getroot().xpath('//*[@id="%s"]' % href[1:])
+    if len(targets) == 0:
+        return None
+
+    mat = composeTransform(mat, [[1.0, 0.0, float(element.get('x', 0))],
+                                 [0.0, 1.0, float(element.get('y', 0))]])
+    # Clones are not listed themselves
+    return _visit(targets[0], mat, style, [], unittouu)
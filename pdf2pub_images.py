@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""Embedded image processing for pdf2pub
+
+Resamples the raster images embedded in the document (e.g., by MATLAB's
+imagesc or surf) to the resolution they are printed at once the figure is
+resized, and re-encodes them. Images are only decoded if they need to be
+resampled; PIL (or Pillow) is required for that.
+"""
+
+import re, math, base64, struct, io
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import inkex
+from simplestyle import parseStyle
+from simpletransform import parseTransform, composeTransform
+
+
+# User units (px) per inch
+px_per_inch = 96.0
+
+# Images are only resampled if their resolution exceeds the target by more
+# than this fraction
+dpi_slack = 0.05
+
+_data_re = re.compile(r'^\s*data:image/(png|jpeg|jpg|gif|bmp|tiff?)\s*;\s*base64\s*,(.*)$',
+                      re.DOTALL | re.IGNORECASE)
+_length_re = re.compile(r'^\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*(px)?\s*$')
+
+
+def resample_images(root_node, scale, dpi, quality=90):
+    """Resample embedded images printed above dpi
+
+    scale is the size (x, y) of a user unit in the final figure (in px).
+    Images whose resolution in the final figure is more than dpi are
+    downsampled to dpi and re-encoded, as PNG if they have transparency or
+    few colors and as JPEG of the given quality otherwise (quality 0 always
+    uses PNG). Images referenced by file name and images drawn with a
+    negligible size are left alone.
+
+    Returns (resampled, skipped): resampled lists (id, dpi, size before,
+    size after, bytes before, bytes after) for each resampled image and
+    skipped counts the images that should have been resampled but could not
+    (e.g., because PIL is missing).
+    """
+    href = inkex.addNS('href', 'xlink')
+    resampled = []
+    skipped = 0
+
+    for element in root_node.iter(inkex.addNS('image', 'svg'), 'image'):
+        attribute = href if element.get(href) is not None else 'href'
+        data = _data_re.match(element.get(attribute, ''))
+        if data is None:
+            continue
+
+        # Only the header is needed to find the resolution
+        encoded = re.sub(r'\s+', '', data.group(2))
+        size = _image_size(encoded)
+        box = _output_box(element, scale)
+        if size is None or box is None:
+            continue
+
+        (dpi_x, dpi_y) = (size[0]*px_per_inch/box[0], size[1]*px_per_inch/box[1])
+        aspect = element.get('preserveAspectRatio', '').split() or ['xMidYMid', 'meet']
+        if aspect[0] == 'none':
+            factors = (min(1.0, dpi/dpi_x), min(1.0, dpi/dpi_y))
+        else:
+            # The image is scaled uniformly to fit (meet) or fill (slice) its box
+            image_dpi = min(dpi_x, dpi_y) if aspect[-1] == 'slice' else max(dpi_x, dpi_y)
+            factors = (min(1.0, dpi/image_dpi),)*2
+        if min(factors) > 1/(1 + dpi_slack):
+            continue
+
+        if Image is None:
+            skipped = skipped + 1
+            continue
+
+        try:
+            image = Image.open(io.BytesIO(base64.b64decode(encoded)))
+            new_size = (max(1, int(round(size[0]*factors[0]))),
+                        max(1, int(round(size[1]*factors[1]))))
+            (mime, encoded_image) = _encode(_resize(image, new_size, element), quality)
+        except Exception:
+            skipped = skipped + 1
+            continue
+
+        # Keep the original if re-encoding did not help
+        if len(encoded_image) >= len(encoded):
+            continue
+
+        element.set(attribute, 'data:%s;base64,%s' % (mime, encoded_image))
+        resampled.append((element.get('id'), max(dpi_x, dpi_y), size, new_size,
+                          len(encoded)*3//4, len(encoded_image)*3//4))
+
+    return (resampled, skipped)
+
+
+def _image_size(encoded):
+    """Pixel size (width, height) of a base64 encoded image, None if unknown
+
+    PNG and GIF sizes are read from the first bytes, JPEG sizes from the
+    first frame header, without decoding the pixels.
+    """
+    try:
+        head = base64.b64decode(encoded[:32])
+        if head[:8] == b'\x89PNG\r\n\x1a\n':
+            return struct.unpack('>II', head[16:24])
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+        if head[:2] == b'\xff\xd8':
+            return _jpeg_size(base64.b64decode(encoded[:len(encoded)//4*4]))
+    except (TypeError, ValueError, struct.error):
+        return None
+
+    if Image is not None:
+        # Other formats: PIL reads the header only
+        try:
+            return Image.open(io.BytesIO(base64.b64decode(encoded))).size
+        except Exception:
+            return None
+
+    return None
+
+
+def _jpeg_size(data):
+    """Pixel size of JPEG data from its first frame header"""
+    position = 2
+    while position + 9 < len(data):
+        if data[position:position + 1] != b'\xff':
+            return None
+        marker = ord(data[position + 1:position + 2])
+        if marker == 0xff:
+            position = position + 1
+            continue
+        (length,) = struct.unpack('>H', data[position + 2:position + 4])
+        # Start of frame markers (but for DHT, JPG, and DAC)
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            (height, width) = struct.unpack('>HH', data[position + 5:position + 9])
+            return (width, height)
+        position = position + 2 + length
+
+    return None
+
+
+def _output_box(element, scale):
+    """Size (width, height) of the image box in the final figure (in px)"""
+    lengths = []
+    for name in ('width', 'height'):
+        length = _length_re.match(element.get(name, ''))
+        if length is None:
+            return None
+        lengths.append(float(length.group(1)))
+
+    # Transforms from the image to the document
+    mat = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+    node = element
+    while node is not None:
+        if node.get('transform') is not None:
+            mat = composeTransform(parseTransform(node.get('transform')), mat)
+        node = node.getparent()
+
+    box = (lengths[0]*math.hypot(mat[0][0], mat[1][0])*scale[0],
+           lengths[1]*math.hypot(mat[0][1], mat[1][1])*scale[1])
+    if min(box) < 1e-6:
+        return None
+
+    return box
+
+
+def _resize(image, size, element):
+    """Image resized to size, keeping pixelated images sharp"""
+    style = parseStyle(element.get('style', ''))
+    rendering = style.get('image-rendering', element.get('image-rendering', 'auto'))
+    if image.mode not in ('1', 'L', 'LA', 'RGB', 'RGBA'):
+        image = image.convert('RGBA')
+
+    if rendering in ('optimizeSpeed', 'pixelated', 'crisp-edges'):
+        return image.resize(size, Image.NEAREST)
+
+    return image.resize(size, Image.LANCZOS if hasattr(Image, 'LANCZOS') else Image.ANTIALIAS)
+
+
+def _encode(image, quality):
+    """Encode image as (mime type, base64 data)"""
+    output = io.BytesIO()
+    if quality <= 0 or _transparent(image) or image.getcolors(256) is not None:
+        image.save(output, 'PNG', optimize=True)
+        mime = 'image/png'
+    else:
+        image.convert('L' if image.mode in ('1', 'L', 'LA') else 'RGB').save(
+            output, 'JPEG', quality=quality, optimize=True)
+        mime = 'image/jpeg'
+
+    return (mime, base64.b64encode(output.getvalue()).decode('ascii'))
+
+
+def _transparent(image):
+    """Check if image has transparent pixels"""
+    if image.mode not in ('LA', 'RGBA'):
+        return False
+
+    return image.split()[-1].getextrema()[0] < 255
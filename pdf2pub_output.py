@@ -0,0 +1,627 @@
+#!/usr/bin/env python
+"""Output optimization for pdf2pub
+
+Rewrites the finished document in a more compact form, without changing
+what it looks like at the final size of the figure.
+"""
+
+import re, math
+
+import inkex
+from simplestyle import parseStyle, formatStyle
+from simpletransform import parseTransform
+
+from pdf2pub_analysis import analysis_id
+
+
+# Significant digits of the linear part of transforms
+transform_digits = 8
+
+# Numeric attributes (without units) that hold coordinates or lengths
+length_attributes = ['x', 'y', 'width', 'height', 'x1', 'y1', 'x2', 'y2',
+                     'cx', 'cy', 'r', 'rx', 'ry']
+
+# Elements whose contents are not in user units
+skip_tags = [inkex.addNS(tag, 'svg') for tag in ('marker', 'pattern', 'mask')] + \
+            ['marker', 'pattern', 'mask']
+
+# Elements whose contents are not drawn where they are
+container_tags = ['defs', 'clipPath', 'mask', 'marker', 'pattern', 'symbol',
+                  'metadata', 'namedview', 'style', 'script']
+
+# Drawing elements that can be merged with an equal previous sibling
+shape_tags = ['path', 'rect', 'circle', 'ellipse', 'line', 'polyline', 'polygon', 'use']
+
+# Properties whose references are removed when missing
+reference_properties = ['clip-path', 'mask', 'filter', 'marker', 'marker-start',
+                        'marker-mid', 'marker-end']
+
+_number = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+_number_re = re.compile(r'^\s*(%s)\s*$' % _number)
+_numbers_re = re.compile(_number)
+_path_token_re = re.compile(r'([MmZzLlHhVvCcSsQqTtAa])|(%s)|([^\s,])' % _number)
+
+_url_re = re.compile(r'url\(\s*[\'"]?#([^\'")\s]+)[\'"]?\s*\)')
+_font_family_re = re.compile(r'font-family\s*:\s*([^;}]+)')
+
+# Number of parameters of each path command
+_arity = {'M': 2, 'L': 2, 'H': 1, 'V': 1, 'C': 6, 'S': 4, 'Q': 4, 'T': 2, 'A': 7, 'Z': 0}
+
+
+def format_number(value, decimals):
+    """Shortest text for value rounded to decimals (e.g., .5, -2, 10.25)"""
+    text = '%.*f' % (decimals, value)
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    if text.startswith('0.'):
+        text = text[1:]
+    elif text.startswith('-0.'):
+        text = '-' + text[2:]
+    if text == '-0':
+        text = '0'
+
+    return text
+
+
+def significant_decimals(value, digits):
+    """Decimals that keep digits significant digits of value"""
+    if value == 0:
+        return 0
+
+    return max(0, digits - 1 - int(math.floor(math.log10(abs(value)))))
+
+
+def join_numbers(numbers, previous=None):
+    """Join formatted numbers with as few separators as possible
+
+    previous is the number written just before the first one, if any.
+    """
+    parts = []
+    for number in numbers:
+        # A minus sign always starts a new number, and so does ".5" after
+        # "1.5" (but not after "15" or "1e5")
+        if previous is not None and number[0] != '-' and \
+           not (number[0] == '.' and '.' in previous and 'e' not in previous):
+            parts.append(' ')
+        parts.append(number)
+        previous = number
+
+    return ''.join(parts)
+
+
+def compact_path(d, decimals, numbers=None):
+    """Shortest path data for d with coordinates rounded to decimals
+
+    Each segment is written with an absolute or relative command, whichever
+    is shorter, lines along an axis become H/V, repeated commands are left
+    implicit, and numbers are written by format_number. Relative
+    coordinates are computed from rounded positions, so rounding errors do
+    not accumulate. numbers optionally caches formatted numbers between
+    calls with the same decimals. Returns d unchanged if it cannot be
+    parsed.
+    """
+    segments = parse_path(d)
+    if segments is None:
+        return d
+
+    return compact_segments(segments, decimals, numbers)
+
+
+def compact_segments(segments, decimals, numbers=None):
+    """Shortest path data for absolute segments [(command, params)]
+
+    Same as compact_path, for segments as returned by parse_path (or
+    simplepath.parsePath).
+    """
+    if numbers is None:
+        numbers = {}
+
+    def text(value):
+        try:
+            return numbers[value]
+        except KeyError:
+            numbers[value] = format_number(value, decimals)
+            return numbers[value]
+
+    parts = []
+    previous = None
+    implicit = None
+    (x, y) = (0.0, 0.0)
+    start = (0.0, 0.0)
+    for (cmd, params) in segments:
+        if cmd == 'Z':
+            parts.append('z')
+            (previous, implicit) = (None, None)
+            (x, y) = start
+            continue
+
+        # Absolute values, rounded, and the same relative to (x, y)
+        if cmd == 'L':
+            values = [round(params[0], decimals), round(params[1], decimals)]
+            if values[1] == y and values[0] != x:
+                (cmd, values) = ('H', values[0:1])
+            elif values[0] == x and values[1] != y:
+                (cmd, values) = ('V', values[1:2])
+
+        if cmd == 'H':
+            values = [round(params[0], decimals)] if len(params) == 1 else values
+            absolute = [text(values[0])]
+            relative = [text(round(values[0] - x, decimals))]
+        elif cmd == 'V':
+            values = [round(params[-1], decimals)] if len(params) == 1 else values
+            absolute = [text(values[0])]
+            relative = [text(round(values[0] - y, decimals))]
+        elif cmd == 'A':
+            values = [round(params[5], decimals), round(params[6], decimals)]
+            head = [text(round(value, decimals)) for value in params[0:3]] + \
+                   [str(int(params[3])), str(int(params[4]))]
+            absolute = head + [text(values[0]), text(values[1])]
+            relative = head + [text(round(values[0] - x, decimals)),
+                               text(round(values[1] - y, decimals))]
+        else:
+            if cmd != 'L':
+                values = [round(value, decimals) for value in params]
+            absolute = [text(value) for value in values]
+            relative = [text(round(value - (x if i % 2 == 0 else y), decimals))
+                        for (i, value) in enumerate(values)]
+
+        # Pick the shorter of the absolute and relative forms
+        absolute = _segment(cmd, absolute, implicit, previous)
+        relative = _segment(cmd.lower(), relative, implicit, previous)
+        if len(relative[0]) < len(absolute[0]):
+            (segment, letter, previous) = relative
+        else:
+            (segment, letter, previous) = absolute
+        parts.append(segment)
+        # Coordinate pairs after a moveto are linetos
+        implicit = {'M': 'L', 'm': 'l'}.get(letter, letter)
+
+        if cmd == 'H':
+            x = values[0]
+        elif cmd == 'V':
+            y = values[0]
+        else:
+            (x, y) = (values[-2], values[-1])
+        if cmd == 'M':
+            start = (x, y)
+
+    return ''.join(parts)
+
+
+def _segment(letter, numbers, implicit, previous):
+    """Text of a path segment, its command and its last number"""
+    if letter == implicit:
+        return (join_numbers(numbers, previous), letter, numbers[-1])
+
+    return (letter + join_numbers(numbers), letter, numbers[-1])
+
+
+def parse_path(d):
+    """Absolute path segments [(command, params)], None on errors
+
+    Commands are kept as written (S, T, H, and V are not expanded).
+    """
+    segments = []
+    cmd = None
+    args = []
+    (x, y) = (0.0, 0.0)
+    start = (0.0, 0.0)
+    for (letter, number, other) in _path_token_re.findall(d):
+        if other:
+            return None
+        if letter:
+            if args:
+                return None
+            cmd = letter
+            if cmd in 'Zz':
+                segments.append(('Z', []))
+                (x, y) = start
+            continue
+        if cmd is None or cmd in 'Zz':
+            return None
+
+        args.append(float(number))
+        if len(args) < _arity[cmd.upper()]:
+            continue
+
+        upper = cmd.upper()
+        if upper == 'A' and (args[3] not in (0, 1) or args[4] not in (0, 1)):
+            return None
+        if cmd.islower():
+            if upper == 'H':
+                args = [args[0] + x]
+            elif upper == 'V':
+                args = [args[0] + y]
+            elif upper == 'A':
+                args = args[0:5] + [args[5] + x, args[6] + y]
+            else:
+                args = [value + (x if i % 2 == 0 else y) for (i, value) in enumerate(args)]
+        segments.append((upper, args))
+
+        if upper == 'H':
+            x = args[0]
+        elif upper == 'V':
+            y = args[0]
+        else:
+            (x, y) = (args[-2], args[-1])
+        if upper == 'M':
+            start = (x, y)
+            cmd = 'l' if cmd == 'm' else 'L'
+        args = []
+
+    if args:
+        return None
+
+    return segments
+
+
+def compact_transform(value, decimals):
+    """Shortest transform equivalent to value
+
+    Translations are rounded to decimals, the linear part keeps
+    transform_digits significant digits.
+    """
+    try:
+        mat = parseTransform(value)
+    except Exception:
+        return value
+
+    linear = [format_number(v, significant_decimals(v, transform_digits))
+              for v in (mat[0][0], mat[1][0], mat[0][1], mat[1][1])]
+    translation = [format_number(v, decimals) for v in (mat[0][2], mat[1][2])]
+
+    if linear == ['1', '0', '0', '1']:
+        if translation == ['0', '0']:
+            return ''
+        return 'translate(%s)' % ','.join(translation)
+    if linear[1:3] == ['0', '0'] and translation == ['0', '0']:
+        return 'scale(%s,%s)' % (linear[0], linear[3])
+
+    return 'matrix(%s)' % ','.join(linear + translation)
+
+
+def compact_document(root_node, scale, precision):
+    """Rewrite numbers of root_node's descendants to the precision needed
+
+    scale is the size of a user unit in the final figure (in output units)
+    and precision the smallest visible distance there (in output units).
+    Path data, numeric attributes, and transforms are rewritten; contents
+    of markers, patterns, and masks are left alone.
+    """
+    path_tag = inkex.addNS('path', 'svg')
+    decimals = {}
+    # Formatted numbers, by decimals
+    numbers = {}
+
+    stack = [(child, scale) for child in root_node]
+    while stack:
+        (element, element_scale) = stack.pop()
+        if not isinstance(element.tag, str) or element.tag in skip_tags:
+            continue
+
+        parent_scale = element_scale
+        if element.get('transform') is not None:
+            try:
+                mat = parseTransform(element.get('transform'))
+                element_scale = element_scale*math.sqrt(abs(mat[0][0]*mat[1][1] - mat[0][1]*mat[1][0]))
+            except Exception:
+                pass
+
+            transform = compact_transform(element.get('transform'),
+                                          _decimals(decimals, parent_scale, precision))
+            if transform:
+                element.set('transform', transform)
+            else:
+                del element.attrib['transform']
+
+        digits = _decimals(decimals, element_scale, precision)
+        if element.tag == path_tag and element.get('d') is not None:
+            element.set('d', compact_path(element.get('d'), digits,
+                                          numbers.setdefault(digits, {})))
+
+        for name in length_attributes:
+            value = element.get(name)
+            if value is not None:
+                number = _number_re.match(value)
+                if number is not None:
+                    element.set(name, format_number(float(number.group(1)), digits))
+
+        if element.get('points') is not None:
+            points = [format_number(float(number), digits)
+                      for number in _numbers_re.findall(element.get('points'))]
+            element.set('points', join_numbers(points))
+
+        stack.extend([(child, element_scale) for child in element])
+
+
+def precision_decimals(scale, precision):
+    """Decimals of user units needed to resolve precision at scale
+
+    scale is the size of a user unit in the final figure and precision the
+    smallest visible distance there (see compact_document).
+    """
+    if scale <= 0:
+        return 8
+
+    return max(0, int(math.ceil(-math.log10(precision/scale))))
+
+
+def _decimals(cache, scale, precision):
+    if scale not in cache:
+        cache[scale] = precision_decimals(scale, precision)
+
+    return cache[scale]
+
+
+def find_equal(parent, element):
+    """Return a child of parent equal to element (but for ids), or None"""
+    key = _key(element)
+    for child in parent:
+        if child is not element and isinstance(child.tag, str) and _key(child) == key:
+            return child
+
+    return None
+
+
+def merge_duplicates(root_node):
+    """Remove elements that duplicate others
+
+    Definitions equal to an earlier one (but for ids) are removed and
+    references to them point to the earlier one instead. Drawing elements
+    equal to their previous sibling are removed if they are opaque (drawing
+    them twice has no visible effect) and nothing refers to them. Returns
+    the number of removed elements.
+    """
+    removed = 0
+
+    # References to a removed definition may make other definitions equal,
+    # e.g., gradients pointing to duplicate gradients
+    while True:
+        kept = {}
+        renamed = {}
+        for defs in _defs_nodes(root_node):
+            for child in list(defs):
+                if not isinstance(child.tag, str) or child.get('id') is None or \
+                   _local(child.tag) in ('style', 'script'):
+                    continue
+
+                key = _key(child)
+                if key not in kept:
+                    kept[key] = child
+                    continue
+
+                # Same structure, so descendants pair up in document order
+                for (duplicate, original) in zip(_elements(child), _elements(kept[key])):
+                    if duplicate.get('id') is not None:
+                        if original.get('id') is None:
+                            original.set('id', duplicate.get('id'))
+                        else:
+                            renamed[duplicate.get('id')] = original.get('id')
+                defs.remove(child)
+                removed = removed + 1
+
+        if not renamed:
+            break
+        _rename_references(root_node, renamed)
+
+    referenced = referenced_ids(root_node)
+    stack = [root_node]
+    while stack:
+        parent = stack.pop()
+        previous = None
+        for child in list(parent):
+            if not isinstance(child.tag, str):
+                continue
+            if _local(child.tag) not in shape_tags:
+                # Groups, text, etc. are drawn in between
+                previous = None
+                if _local(child.tag) not in container_tags:
+                    stack.append(child)
+                continue
+
+            key = _key(child)
+            if key == previous and _opaque(child) and \
+               not any([element.get('id') in referenced for element in _elements(child)]):
+                parent.remove(child)
+                removed = removed + 1
+            else:
+                previous = key
+
+    return removed
+
+
+def collect_garbage(root_node):
+    """Remove metadata and the definitions nothing refers to
+
+    Definitions are kept if they are referenced (through url(#id) or an
+    href) by the drawing, by a style sheet, or by another definition that
+    is kept; SVG fonts are kept if their font family is used. References
+    to missing clip paths, masks, filters, and markers (e.g., to the clip
+    paths removed by pdf2pub) are removed. The analysis stored by pdf2pub
+    (see pdf2pub_analysis) is kept. Returns the number of removed elements.
+    """
+    removed = 0
+    for element in list(root_node.iter(inkex.addNS('metadata', 'svg'), 'metadata')):
+        if element.get('id') == analysis_id:
+            continue
+        element.getparent().remove(element)
+        removed = removed + 1
+
+    defs_nodes = _defs_nodes(root_node)
+
+    # Top-level definition holding each id (None outside of defs)
+    owners = {}
+    for defs in defs_nodes:
+        for child in defs:
+            for element in _elements(child):
+                if element.get('id') is not None:
+                    owners[element.get('id')] = child
+    in_defs = set(owners.values())
+
+    # Everything outside of defs (and style sheets) is in use
+    pending = []
+    families = set()
+    stack = [root_node]
+    while stack:
+        element = stack.pop()
+        if not isinstance(element.tag, str):
+            continue
+        if element in in_defs and _local(element.tag) not in ('style', 'script'):
+            continue
+        if element.get('id') is not None and element.get('id') not in owners:
+            owners[element.get('id')] = None
+        pending.extend(_references(element))
+        families.update(_font_families(element))
+        stack.extend(element)
+
+    live = set()
+    for child in in_defs:
+        if _local(child.tag) == 'font' and \
+           any([_font_name(face.get('font-family', '')) in families
+                for face in child if isinstance(face.tag, str) and _local(face.tag) == 'font-face']):
+            live.add(child)
+            for element in _elements(child):
+                pending.extend(_references(element))
+
+    seen = set()
+    while pending:
+        element_id = pending.pop()
+        if element_id in seen:
+            continue
+        seen.add(element_id)
+
+        owner = owners.get(element_id)
+        if owner is not None and owner not in live:
+            live.add(owner)
+            for element in _elements(owner):
+                pending.extend(_references(element))
+
+    for defs in defs_nodes:
+        for child in list(defs):
+            if isinstance(child.tag, str) and child not in live and \
+               _local(child.tag) not in ('style', 'script'):
+                defs.remove(child)
+                removed = removed + 1
+
+    _drop_missing_references(root_node, set([element_id for (element_id, owner) in owners.items()
+                                             if owner is None or owner in live]))
+
+    return removed
+
+
+def referenced_ids(root_node):
+    """Set of all ids referred to in the document"""
+    ids = set()
+    for element in root_node.iter():
+        if isinstance(element.tag, str):
+            ids.update(_references(element))
+
+    return ids
+
+
+def _local(tag):
+    """Tag without its namespace"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _elements(element):
+    """Element and its descendants, without comments"""
+    return [child for child in element.iter() if isinstance(child.tag, str)]
+
+
+def _key(element):
+    """Comparable contents of element, but for ids"""
+    return (_local(element.tag),
+            tuple(sorted([(name, value) for (name, value) in element.attrib.items() if name != 'id'])),
+            (element.text or '').strip(),
+            tuple([_key(child) for child in element if isinstance(child.tag, str)]))
+
+
+def _defs_nodes(root_node):
+    """All <defs> nodes of the document"""
+    return [element for element in root_node.iter(inkex.addNS('defs', 'svg'), 'defs')]
+
+
+def _references(element):
+    """Ids element refers to (through url(#id), hrefs, or its style sheet)"""
+    ids = []
+    for (name, value) in element.attrib.items():
+        if name in (inkex.addNS('href', 'xlink'), 'href'):
+            if value.startswith('#'):
+                ids.append(value[1:])
+        elif 'url(' in value:
+            ids.extend(_url_re.findall(value))
+    if _local(element.tag) == 'style' and element.text:
+        ids.extend(_url_re.findall(element.text))
+
+    return ids
+
+
+def _rename_references(root_node, renamed):
+    """Point references to the ids in renamed to their new ids"""
+    def rename(match):
+        if match.group(1) in renamed:
+            return 'url(#%s)' % renamed[match.group(1)]
+        return match.group(0)
+
+    for element in root_node.iter():
+        if not isinstance(element.tag, str):
+            continue
+        for (name, value) in element.attrib.items():
+            if name in (inkex.addNS('href', 'xlink'), 'href'):
+                if value.startswith('#') and value[1:] in renamed:
+                    element.set(name, '#' + renamed[value[1:]])
+            elif 'url(' in value:
+                element.set(name, _url_re.sub(rename, value))
+        if _local(element.tag) == 'style' and element.text:
+            element.text = _url_re.sub(rename, element.text)
+
+
+def _drop_missing_references(root_node, ids):
+    """Remove clip paths, masks, filters, and markers not in ids"""
+    def missing(value):
+        return any([element_id not in ids for element_id in _url_re.findall(value)])
+
+    for element in root_node.iter():
+        if not isinstance(element.tag, str):
+            continue
+        for name in reference_properties:
+            if missing(element.get(name, '')):
+                del element.attrib[name]
+        style = element.get('style')
+        if style is not None and 'url(' in style and missing(style):
+            element_style = parseStyle(style)
+            for name in reference_properties:
+                if missing(element_style.get(name, '')):
+                    del element_style[name]
+            element.set('style', formatStyle(element_style))
+
+
+def _font_families(element):
+    """Font families (normalized) used by element"""
+    values = _font_family_re.findall(element.get('style', ''))
+    if element.get('font-family') is not None:
+        values.append(element.get('font-family'))
+    if _local(element.tag) == 'style' and element.text:
+        values.extend(_font_family_re.findall(element.text))
+
+    return set([_font_name(name) for value in values for name in value.split(',')])
+
+
+def _font_name(name):
+    """Font family name without quotes and case"""
+    return name.strip().strip('\'"').strip().lower()
+
+
+def _opaque(element):
+    """Check if drawing element twice looks the same as drawing it once"""
+    style = parseStyle(element.get('style', ''))
+    for name in ('opacity', 'fill-opacity', 'stroke-opacity'):
+        value = style.get(name, element.get(name, '1'))
+        try:
+            if float(value) < 1:
+                return False
+        except ValueError:
+            return False
+
+    return True
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+"""Pipeline from a multipage PDF to finished figures
+
+Runs the whole workflow on a PDF with one figure per page (e.g., created by
+`export_fig -append`): each page is split, imported as SVG, ungrouped,
+formatted by pdf2pub and exported. Stages run concurrently and are
+connected by bounded queues, so that page N+1 is being converted while
+page N is formatted, and only a few pages are in flight at any time.
+
+    python pdf2pub_pipeline.py --format=half --output_dir=pub figures.pdf
+"""
+
+from subprocess import Popen, PIPE
+import sys, os, re, math, time, shutil, tempfile, threading
+from copy import deepcopy
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from lxml import etree
+
+import inkex
+from simplestyle import parseStyle, formatStyle
+from simpletransform import parseTransform, composeTransform, formatTransform, invertTransform
+from simplepath import parsePath, formatPath
+
+from pdf2pub_batch import get_parser, effect_args, process_file
+from pdf2pub_output import container_tags, referenced_ids
+
+
+# External commands ({input}, {output} and {page} are replaced in each
+# argument, which is passed as is, without a shell)
+info_command = ['pdfinfo', '{input}']
+split_command = ['pdfseparate', '-f', '{page}', '-l', '{page}', '{input}', '{output}']
+convert_command = ['inkscape', '--without-gui', '--export-plain-svg={output}', '{input}']
+export_commands = {
+    'svg': None,
+    'pdf': ['inkscape', '--without-gui', '--export-pdf={output}', '{input}'],
+    'eps': ['inkscape', '--without-gui', '--export-eps={output}', '{input}'],
+    'png': ['inkscape', '--without-gui', '--export-dpi=600', '--export-png={output}', '{input}']}
+
+identity = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+
+# Presentation attributes groups pass on to their children
+presentation_attributes = ['fill', 'fill-opacity', 'fill-rule', 'stroke', 'stroke-width',
+                           'stroke-opacity', 'stroke-linecap', 'stroke-linejoin',
+                           'stroke-miterlimit', 'stroke-dasharray', 'stroke-dashoffset',
+                           'opacity', 'clip-path', 'clip-rule', 'mask', 'filter', 'color',
+                           'display', 'visibility', 'font-family', 'font-size',
+                           'font-style', 'font-weight', 'text-anchor']
+
+
+def run_command(template, **kwargs):
+    """Run an external command and check that it produced its output"""
+    try:
+        p = Popen([arg.format(**kwargs) for arg in template], stdout=PIPE, stderr=PIPE)
+    except OSError as err:
+        raise IOError('"%s" failed: %s' % (template[0], err))
+    (out, err) = p.communicate()
+
+    if p.returncode != 0 or ('output' in kwargs and not os.path.exists(kwargs['output'])):
+        if not isinstance(err, str):
+            err = err.decode('utf-8', 'replace')
+        raise IOError('"%s" failed: %s' % (template[0], err.strip()))
+
+    if not isinstance(out, str):
+        out = out.decode('utf-8', 'replace')
+
+    return out
+
+
+def count_pages(filename):
+    """Number of pages of a PDF file"""
+    info = run_command(info_command, input=filename)
+    pages = re.search(r'^Pages:\s*(\d+)', info, re.MULTILINE)
+    if pages is None:
+        raise IOError('Could not read number of pages of %s' % filename)
+
+    return int(pages.group(1))
+
+
+def flatten_groups(root_node):
+    """Ungroup every group that is not a layer (like ctrl+shift+g)
+
+    Group transforms are baked into path data, so that coordinates of paths
+    are document coordinates, as pdf2pub expects. Other elements (and paths
+    with arcs) get the composed transform as attribute. Group styles and
+    presentation attributes are inherited by their children (unless they
+    set them), group opacity is multiplied into theirs, and group clip
+    paths move to the children, as Inkscape does.
+
+    Groups inside of definitions (e.g., markers, patterns, or symbols) and
+    groups referred to (e.g., by a <use>) are kept, along with their
+    contents.
+    """
+    layer = inkex.addNS('groupmode', 'inkscape')
+    containers = [inkex.addNS(tag, 'svg') for tag in container_tags]
+    references = referenced_ids(root_node)
+    groups = [group for group in root_node.iter(inkex.addNS('g', 'svg'))
+              if group.get(layer) != 'layer' and group.get('id') not in references and
+              not any([ancestor.tag in containers or ancestor.get('id') in references
+                       for ancestor in group.iterancestors()])]
+    clip_paths = dict([(clip.get('id'), clip) for clip in
+                       root_node.iter(inkex.addNS('clipPath', 'svg'))])
+    ids = set(root_node.xpath('//@id'))
+
+    # Outer groups come first, so that transforms move down to the leaves
+    for group in groups:
+        mat = parseTransform(group.get('transform'))
+        group_style = dict([(name, group.get(name)) for name in presentation_attributes
+                            if group.get(name) is not None])
+        group_style.update(parseStyle(group.get('style')))
+        opacity = group_style.pop('opacity', None)
+        clip = group_style.pop('clip-path', None)
+
+        parent = group.getparent()
+        idx = parent.index(group)
+        for child in list(group):
+            if isinstance(child.tag, str):
+                child_style = parseStyle(child.get('style'))
+                for (name, value) in group_style.items():
+                    if name not in child_style and child.get(name) is None:
+                        child_style[name] = value
+                if opacity is not None:
+                    child_opacity = child_style.get('opacity', child.attrib.pop('opacity', '1'))
+                    child_style['opacity'] = '%.8g' % (float(opacity)*float(child_opacity))
+                if child_style and (group_style or opacity is not None):
+                    child.set('style', formatStyle(child_style))
+                push_transform(child, mat)
+                if clip is not None and clip != 'none':
+                    push_clip(child, clip, mat, clip_paths, ids)
+
+            parent.insert(idx, child)
+            idx = idx + 1
+
+        parent.remove(group)
+
+
+def push_clip(element, clip, mat, clip_paths, ids):
+    """Clip element by the clip path of its group
+
+    clip is in the user space of the group, whose transform is mat. The
+    clip path is copied (with a transform) if element's user space is not
+    the group's, or if element has a clip path of its own, which then clips
+    the copy.
+    """
+    mat = composeTransform(invertTransform(parseTransform(element.get('transform'))), mat)
+
+    style = parseStyle(element.get('style'))
+    own_clip = style.pop('clip-path', element.get('clip-path'))
+    if own_clip == 'none':
+        own_clip = None
+
+    clip_id = re.match(r'\s*url\(\s*#([^)\s]+)\s*\)', clip)
+    clip_path = clip_paths.get(clip_id.group(1)) if clip_id is not None else None
+    if clip_path is not None and (own_clip is not None or
+                                  (mat != identity and
+                                   clip_path.get('clipPathUnits') != 'objectBoundingBox')):
+        copy = deepcopy(clip_path)
+        for node in copy.iter():
+            if 'id' in node.attrib:
+                del node.attrib['id']
+        n = 1
+        while '%s-%d' % (clip_id.group(1), n) in ids:
+            n = n + 1
+        copy.set('id', '%s-%d' % (clip_id.group(1), n))
+        ids.add(copy.get('id'))
+
+        if clip_path.get('clipPathUnits') != 'objectBoundingBox':
+            mat = composeTransform(mat, parseTransform(clip_path.get('transform')))
+            if mat == identity:
+                if 'transform' in copy.attrib:
+                    del copy.attrib['transform']
+            else:
+                copy.set('transform', formatTransform(mat))
+        if own_clip is not None:
+            copy.set('clip-path', own_clip)
+
+        clip_path.addnext(copy)
+        clip_paths[copy.get('id')] = copy
+        clip = 'url(#%s)' % copy.get('id')
+
+    if 'clip-path' in parseStyle(element.get('style')):
+        element.set('style', formatStyle(style))
+    element.set('clip-path', clip)
+
+
+def push_transform(element, mat):
+    """Apply mat on top of element's own transform"""
+    mat = composeTransform(mat, parseTransform(element.get('transform')))
+    if mat == identity:
+        if 'transform' in element.attrib:
+            del element.attrib['transform']
+        return
+
+    if element.tag == inkex.addNS('path', 'svg') and element.get('d') is not None:
+        path = parsePath(element.get('d'))
+        if all([cmd != 'A' for (cmd, params) in path]):
+            for (cmd, params) in path:
+                for i in range(0, len(params) - 1, 2):
+                    (x, y) = (params[i], params[i+1])
+                    params[i] = mat[0][0]*x + mat[0][1]*y + mat[0][2]
+                    params[i+1] = mat[1][0]*x + mat[1][1]*y + mat[1][2]
+            element.set('d', formatPath(path))
+            if 'transform' in element.attrib:
+                del element.attrib['transform']
+
+            # Strokes are scaled along with the path
+            scale = math.sqrt(abs(mat[0][0]*mat[1][1] - mat[0][1]*mat[1][0]))
+            style = parseStyle(element.get('style'))
+            if 'stroke-width' in style:
+                style['stroke-width'] = _scale_length(style['stroke-width'], scale)
+                element.set('style', formatStyle(style))
+            if element.get('stroke-width') is not None:
+                element.set('stroke-width', _scale_length(element.get('stroke-width'), scale))
+            return
+
+    element.set('transform', formatTransform(mat))
+
+
+def _scale_length(value, scale):
+    length = re.match(r'\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(.*)', value)
+    if length is None:
+        return value
+
+    return '%.8g%s' % (float(length.group(1))*scale, length.group(2).strip())
+
+
+class Pipeline:
+    """PDF to figures pipeline
+
+    Each page travels through the stages as a dict holding its page number,
+    the current file, any error, and warnings. Pages that fail in one stage
+    are passed through the remaining ones untouched and reported.
+    """
+    def __init__(self, filename, output_dir, args, export='svg', jobs=1,
+                 queue_size=2):
+        """Constructor"""
+        self.filename = filename
+        self.output_dir = output_dir
+        self.args = args
+        self.export = export
+        self.jobs = jobs
+        self.queue_size = queue_size
+
+        if export not in export_commands:
+            raise ValueError('Unknown export format "%s"' % export)
+
+    def run(self, report=None):
+        """Process all pages, calling report with each finished page"""
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        self.tmp = tempfile.mkdtemp(prefix='pdf2pub-')
+        self.basename = os.path.splitext(os.path.basename(self.filename))[0]
+
+        try:
+            pages = Queue(self.queue_size)
+            converted = Queue(self.queue_size)
+            formatted = Queue(self.queue_size)
+            done = Queue()
+
+            # Conversion runs external processes, so several may overlap
+            threads = (self.stage(self.convert, pages, converted, self.jobs) +
+                       self.stage(self.transform, converted, formatted) +
+                       self.stage(self.export_page, formatted, done))
+
+            # Split pages lazily: the queue bound blocks the producer
+            results = []
+            feeder = threading.Thread(target=self.split_pages, args=(pages,))
+            feeder.daemon = True
+            feeder.start()
+
+            while True:
+                page = done.get()
+                if page is None:
+                    break
+                results.append(page)
+                if report is not None:
+                    report(page)
+
+            feeder.join()
+            for thread in threads:
+                thread.join()
+        finally:
+            shutil.rmtree(self.tmp, True)
+
+        return sorted(results, key=lambda page: page['page'])
+
+    def stage(self, work, inbox, outbox, workers=1):
+        """Start workers applying work to pages from inbox into outbox
+
+        A None page signals the end of the stream. It is forwarded once all
+        workers of the stage are done.
+        """
+        remaining = [workers]
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                page = inbox.get()
+                if page is None:
+                    # Let the other workers of the stage see the end too
+                    inbox.put(None)
+                    break
+
+                if page['error'] is None:
+                    start = time.time()
+                    try:
+                        work(page)
+                    except Exception as err:
+                        page['error'] = '%s: %s' % (type(err).__name__, err)
+                    page['times'][work.__name__] = time.time() - start
+                outbox.put(page)
+
+            with lock:
+                remaining[0] = remaining[0] - 1
+                if remaining[0] == 0:
+                    outbox.put(None)
+
+        threads = [threading.Thread(target=worker) for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        return threads
+
+    def split_pages(self, pages):
+        """Producer: split the PDF into single-page PDFs"""
+        try:
+            npages = count_pages(self.filename)
+        except (IOError, OSError) as err:
+            pages.put({'page': 0, 'file': self.filename, 'output': None,
+                       'error': str(err), 'warnings': '', 'times': {}})
+            npages = 0
+
+        for n in range(1, npages + 1):
+            page = {'page': n, 'file': None, 'output': None,
+                    'error': None, 'warnings': '', 'times': {}}
+            start = time.time()
+            try:
+                page['file'] = os.path.join(self.tmp, 'page-%d.pdf' % n)
+                run_command(split_command, input=self.filename, output=page['file'], page=n)
+            except (IOError, OSError) as err:
+                page['error'] = str(err)
+            page['times']['split'] = time.time() - start
+
+            # Blocks while the next stages are busy
+            pages.put(page)
+
+        pages.put(None)
+
+    def convert(self, page):
+        """Import page as SVG"""
+        svg = os.path.join(self.tmp, 'page-%d.svg' % page['page'])
+        try:
+            run_command(convert_command, input=page['file'], output=svg)
+        finally:
+            os.remove(page['file'])
+        page['file'] = svg
+
+    def transform(self, page):
+        """Ungroup and format page with pdf2pub"""
+        document = etree.parse(page['file'], parser=etree.XMLParser(huge_tree=True))
+        flatten_groups(document.getroot())
+        document.write(page['file'])
+        del document
+
+        output = os.path.join(self.tmp, 'page-%d-pub.svg' % page['page'])
+        (filename, output, error, warnings, seconds) = \
+            process_file((page['file'], output, self.args))
+        os.remove(page['file'])
+
+        page['file'] = output
+        page['warnings'] = warnings
+        if error is not None:
+            raise IOError(error)
+
+    def export_page(self, page):
+        """Write page to the output directory in the final format"""
+        output = os.path.join(self.output_dir, '%s-%03d.%s' %
+                              (self.basename, page['page'], self.export))
+        if export_commands[self.export] is None:
+            shutil.move(page['file'], output)
+        else:
+            try:
+                run_command(export_commands[self.export], input=page['file'], output=output)
+            finally:
+                os.remove(page['file'])
+        page['file'] = None
+        page['output'] = output
+
+
+def report_page(page):
+    """Print a one-line summary of a finished page"""
+    if page['error'] is None:
+        sys.stdout.write('ok      page %d -> %s (%.2f s)\n' %
+                         (page['page'], page['output'], sum(page['times'].values())))
+    else:
+        sys.stdout.write('FAILED  page %d: %s\n' % (page['page'], page['error']))
+    for line in page['warnings'].splitlines():
+        if line.strip():
+            sys.stdout.write('        %s\n' % line.strip())
+    sys.stdout.flush()
+
+
+def main(argv=sys.argv[1:]):
+    parser = get_parser()
+    parser.set_usage('usage: %prog [options] --output_dir=DIR PDFfile')
+    parser.add_option('--export', action='store',
+                      type='string', dest='export',
+                      default='svg', help='Output format (svg, pdf, eps, or png)')
+    parser.add_option('--queue_size', action='store',
+                      type='int', dest='queue_size',
+                      default=2, help='Pages waiting between stages')
+    (options, args) = parser.parse_args(argv)
+
+    if len(args) != 1:
+        parser.error('exactly one PDF file is required')
+    if options.output_dir == '':
+        parser.error('an output directory is required (--output_dir)')
+    if options.export not in export_commands:
+        parser.error('unknown export format "%s"' % options.export)
+
+    start = time.time()
+    pipeline = Pipeline(args[0], options.output_dir, effect_args(options),
+                        options.export, options.jobs, options.queue_size)
+    results = pipeline.run(report_page)
+
+    failed = len([page for page in results if page['error'] is not None])
+    sys.stdout.write('\n%d succeeded, %d failed (%.2f s)\n' %
+                     (len(results) - failed, failed, time.time() - start))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
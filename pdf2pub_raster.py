@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+"""Trace rasterization for pdf2pub
+
+Replaces plot traces too dense to be drawn as vectors by a single embedded
+image (as matplotlib's rasterized=True does), rendered either in-process
+with PIL or by a local Inkscape.
+"""
+
+from subprocess import Popen, PIPE
+import os, re, io, math, copy, base64, shutil, tempfile
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+from lxml import etree
+
+import inkex
+from simplestyle import parseStyle, parseColor
+from simpletransform import parseTransform, composeTransform, invertTransform, formatTransform
+
+from pdf2pub_output import parse_path
+
+
+# Inkscape renderer (the document is sized so that 1 user unit is 1 pixel)
+render_command = ['inkscape', '--without-gui', '--export-area-page', '--export-dpi=96',
+                  '--export-background-opacity=0', '--export-png={output}', '{input}']
+
+# The built-in renderer draws at this multiple of the final resolution and
+# downsamples the result (antialiasing)
+supersampling = 4
+
+# Maximum number of line segments per curve in the built-in renderer
+curve_segments = 32
+
+# Distance (in pixels of the built-in renderer) between curves and the line
+# segments that replace them
+flatness = 0.5
+
+identity = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+
+# Properties inherited from groups by the built-in renderer
+inherited_styles = ['fill', 'fill-opacity', 'stroke', 'stroke-width', 'stroke-opacity']
+
+# Elements kept in the document rendered by Inkscape, even if not rasterized
+support_tags = ['defs', 'namedview', 'metadata', 'style']
+
+_number_re = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+
+def count_points(elements):
+    """Number of points (coordinate pairs) of the paths in elements"""
+    return sum([len(_number_re.findall(element.get('d', ''))) for element in elements])//2
+
+
+def rasterize(elements, area, size, engine='python', image_id=None):
+    """Replace elements by an image of them
+
+    area (left, top, right, bottom) is the part of the document covered by
+    the image (in user units) and size its (width, height) in pixels.
+    elements are rendered with their current styles by engine ('python' or
+    'inkscape'), the image takes the place of the first one in document
+    order, and all of them are removed. Returns the image element.
+
+    The built-in renderer only draws shapes (not text), with straight lines
+    for arcs and nonzero filling, and ignores clip paths; Inkscape renders
+    everything as the document would. Raises an exception (with the
+    document unchanged) if the elements cannot be rendered.
+    """
+    root_node = elements[0].getroottree().getroot()
+    order = dict([(element, position) for (position, element) in enumerate(root_node.iter())])
+    elements = sorted(set(elements), key=lambda element: order[element])
+
+    if engine == 'inkscape':
+        png = _render_inkscape(root_node, elements, area, size)
+    else:
+        png = _render_python(root_node, elements, area, size)
+
+    # The image is drawn in document coordinates, whatever its parent is
+    first = elements[0]
+    parent = first.getparent()
+    image = etree.Element('image',
+        x = '%f' % area[0],
+        y = '%f' % area[1],
+        width = '%f' % (area[2] - area[0]),
+        height = '%f' % (area[3] - area[1]),
+        preserveAspectRatio = 'none')
+    if image_id is not None:
+        image.set('id', image_id)
+    mat = _document_transform(parent)
+    if mat != identity:
+        image.set('transform', formatTransform(invertTransform(mat)))
+    image.set(inkex.addNS('href', 'xlink'), 'data:image/png;base64,%s' %
+              base64.b64encode(png).decode('ascii'))
+    parent.insert(parent.index(first), image)
+
+    for element in elements:
+        if element.getparent() is not None:
+            element.getparent().remove(element)
+
+    return image
+
+
+def _render_inkscape(root_node, elements, area, size):
+    """PNG data of elements rendered by Inkscape"""
+    # Rasterized elements are marked to find them in the copy
+    mark = inkex.addNS('rasterize', 'inkscape')
+    for element in elements:
+        element.set(mark, 'true')
+    try:
+        document = copy.deepcopy(root_node)
+    finally:
+        for element in elements:
+            del element.attrib[mark]
+
+    # Only the marked elements (and what they need) are drawn
+    kept = set()
+    for element in document.iter():
+        if element.get(mark) is not None:
+            kept.update([element] + list(element.iterancestors()) + list(element.iter()))
+    for element in list(document.iter()):
+        if element is document or element in kept or element.getparent() is None or \
+           not isinstance(element.tag, str):
+            continue
+        if element.tag.rsplit('}', 1)[-1] in support_tags:
+            kept.update(element.iter())
+            continue
+        element.getparent().remove(element)
+
+    document.set('viewBox', '%.8f %.8f %.8f %.8f' % (area[0], area[1], area[2] - area[0], area[3] - area[1]))
+    document.set('width', '%dpx' % size[0])
+    document.set('height', '%dpx' % size[1])
+    document.set('preserveAspectRatio', 'none')
+
+    directory = tempfile.mkdtemp(prefix='pdf2pub-')
+    try:
+        (svg, png) = (os.path.join(directory, 'traces.svg'), os.path.join(directory, 'traces.png'))
+        etree.ElementTree(document).write(svg)
+        try:
+            p = Popen([arg.format(input=svg, output=png) for arg in render_command],
+                      stdout=PIPE, stderr=PIPE)
+        except OSError as err:
+            raise IOError('Inkscape could not render traces (%s)' % err)
+        err = p.communicate()[1]
+        if not os.path.exists(png):
+            raise IOError('Inkscape could not render traces (%s)' %
+                          err.decode('utf-8', 'replace').strip())
+        with open(png, 'rb') as f:
+            return f.read()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _render_python(root_node, elements, area, size):
+    """PNG data of elements rendered with PIL"""
+    if Image is None:
+        raise ImportError('the built-in renderer requires PIL')
+
+    ids = dict([(element.get('id'), element) for element in root_node.iter()
+                if isinstance(element.tag, str) and element.get('id') is not None])
+
+    image = Image.new('RGBA', (size[0]*supersampling, size[1]*supersampling), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(image, 'RGBA')
+    (sx, sy) = (size[0]*supersampling/(area[2] - area[0]), size[1]*supersampling/(area[3] - area[1]))
+    pixels = [[sx, 0.0, -area[0]*sx], [0.0, sy, -area[1]*sy]]
+
+    for element in elements:
+        # Styles inherited from groups above the element
+        inherited = {}
+        for ancestor in reversed(list(element.iterancestors())):
+            inherited = _inherit(inherited, ancestor)
+        mat = composeTransform(pixels, _document_transform(element.getparent()))
+        _draw(draw, element, mat, inherited, ids)
+
+    image = image.resize(size, Image.LANCZOS if hasattr(Image, 'LANCZOS') else Image.ANTIALIAS)
+    output = io.BytesIO()
+    image.save(output, 'PNG', optimize=True)
+
+    return output.getvalue()
+
+
+def _draw(draw, element, mat, inherited, ids):
+    """Draw element (and its children) with the transform mat"""
+    if not isinstance(element.tag, str):
+        return
+    tag = element.tag.rsplit('}', 1)[-1]
+    if element.get('transform') is not None:
+        mat = composeTransform(mat, parseTransform(element.get('transform')))
+    style = _inherit(inherited, element)
+    if style.get('display') == 'none' or style.get('visibility') == 'hidden':
+        return
+
+    if tag in ('g', 'symbol', 'a'):
+        for child in element:
+            _draw(draw, child, mat, style, ids)
+        return
+    if tag == 'use':
+        target = ids.get((element.get(inkex.addNS('href', 'xlink')) or element.get('href', ''))[1:])
+        if target is not None:
+            mat = composeTransform(mat, [[1.0, 0.0, float(element.get('x', 0))],
+                                         [0.0, 1.0, float(element.get('y', 0))]])
+            _draw(draw, target, mat, style, ids)
+        return
+
+    scale = math.sqrt(abs(mat[0][0]*mat[1][1] - mat[0][1]*mat[1][0]))
+    subpaths = _subpaths(element, tag, flatness/scale if scale > 0 else 1.0)
+    if subpaths is None:
+        raise ValueError('cannot render <%s> elements' % tag)
+
+    subpaths = [([(mat[0][0]*x + mat[0][1]*y + mat[0][2], mat[1][0]*x + mat[1][1]*y + mat[1][2])
+                  for (x, y) in points], closed) for (points, closed) in subpaths]
+    opacity = _float(style.get('opacity'), 1.0)
+
+    fill = _color(style.get('fill', 'black'), opacity*_float(style.get('fill-opacity'), 1.0))
+    if fill is not None and tag != 'line':
+        for (points, closed) in subpaths:
+            if len(points) > 2:
+                draw.polygon(points, fill=fill)
+
+    stroke = _color(style.get('stroke', 'none'), opacity*_float(style.get('stroke-opacity'), 1.0))
+    if stroke is not None:
+        width = _float(re.sub(r'px$', '', style.get('stroke-width', '1')), 1.0)*scale
+        for (points, closed) in subpaths:
+            if closed:
+                points = points + points[0:1]
+            if len(points) > 1:
+                _line(draw, points, stroke, max(1, int(round(width))))
+
+
+def _line(draw, points, color, width):
+    """Draw a polyline with round joints (if opaque)"""
+    draw.line(points, fill=color, width=width)
+
+    # Joints that leave a visible notch are covered by discs (which would
+    # show if drawn translucent)
+    if width > 2 and color[3] == 255:
+        r = width/2.0
+        for i in range(1, len(points) - 1):
+            ((x0, y0), (x, y), (x1, y1)) = points[i - 1:i + 2]
+            lengths = math.hypot(x - x0, y - y0)*math.hypot(x1 - x, y1 - y)
+            if lengths == 0:
+                continue
+            turn = ((x - x0)*(x1 - x) + (y - y0)*(y1 - y))/lengths
+            if r*(1 - math.sqrt(max(0.0, (1 + turn)/2))) > flatness:
+                draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+
+
+def _inherit(inherited, element):
+    """Style of element, with the inherited properties of its parent"""
+    style = dict([(name, value) for (name, value) in inherited.items() if name in inherited_styles])
+    for name in inherited_styles + ['opacity', 'display', 'visibility']:
+        if element.get(name) is not None:
+            style[name] = element.get(name)
+    style.update(parseStyle(element.get('style')))
+
+    return style
+
+
+def _color(value, opacity):
+    """RGBA tuple of a paint, None if nothing is painted"""
+    value = value.strip()
+    if value in ('none', 'transparent', '') or value.startswith('url(') or opacity <= 0:
+        return None
+
+    return tuple(parseColor(value)) + (int(round(255*min(opacity, 1.0))),)
+
+
+def _float(value, default):
+    """value as a number, default if it is not one"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _subpaths(element, tag, tolerance):
+    """Flattened subpaths [(points, closed)] of a shape, None if unknown
+
+    Curves are replaced by line segments at most tolerance away from them.
+    """
+    def number(name):
+        return _float(re.sub(r'px$', '', element.get(name, '0')), 0.0)
+
+    if tag == 'path':
+        return _flatten(element.get('d', ''), tolerance)
+    if tag in ('polyline', 'polygon'):
+        values = [float(value) for value in _number_re.findall(element.get('points', ''))]
+        return [(list(zip(values[0::2], values[1::2])), tag == 'polygon')]
+    if tag == 'line':
+        return [([(number('x1'), number('y1')), (number('x2'), number('y2'))], False)]
+    if tag == 'rect':
+        (x, y, w, h) = (number('x'), number('y'), number('width'), number('height'))
+        return [([(x, y), (x + w, y), (x + w, y + h), (x, y + h)], True)]
+    if tag in ('circle', 'ellipse'):
+        (cx, cy) = (number('cx'), number('cy'))
+        (rx, ry) = (number('r'), number('r')) if tag == 'circle' else (number('rx'), number('ry'))
+        n = 4*_segments(math.pi/2*max(rx, ry), tolerance)
+        return [([(cx + rx*math.cos(2*math.pi*i/n), cy + ry*math.sin(2*math.pi*i/n))
+                  for i in range(n)], True)]
+
+    return None
+
+
+def _segments(length, tolerance):
+    """Line segments replacing a curve of (at most) length"""
+    return max(1, min(curve_segments, int(math.ceil(math.sqrt(length/(8*tolerance))))))
+
+
+def _flatten(d, tolerance):
+    """Subpaths of path data with curves replaced by line segments"""
+    segments = parse_path(d)
+    if segments is None:
+        return []
+
+    subpaths = []
+    (x, y) = (0.0, 0.0)
+    control = None
+    for (cmd, params) in segments:
+        if cmd == 'M':
+            subpaths.append(([(params[0], params[1])], False))
+            (x, y) = (params[0], params[1])
+            control = None
+            continue
+        if cmd == 'Z':
+            if subpaths:
+                subpaths[-1] = (subpaths[-1][0], True)
+                (x, y) = subpaths[-1][0][0]
+                subpaths.append(([(x, y)], False))
+            control = None
+            continue
+        if not subpaths:
+            subpaths.append(([(x, y)], False))
+        points = subpaths[-1][0]
+
+        # Reflected control points of smooth curves
+        if cmd in ('S', 'T'):
+            reflected = (2*x - control[0], 2*y - control[1]) if control is not None else (x, y)
+            (cmd, params) = ('C', list(reflected) + params) if cmd == 'S' else ('Q', list(reflected) + params)
+
+        if cmd == 'H':
+            points.append((params[0], y))
+        elif cmd == 'V':
+            points.append((x, params[0]))
+        elif cmd == 'C':
+            (x1, y1, x2, y2, x3, y3) = params
+            n = _segments(math.hypot(x1 - x, y1 - y) + math.hypot(x2 - x1, y2 - y1) +
+                          math.hypot(x3 - x2, y3 - y2), tolerance)
+            for i in range(1, n + 1):
+                t = float(i)/n
+                u = 1 - t
+                points.append((u*u*u*x + 3*u*u*t*x1 + 3*u*t*t*x2 + t*t*t*x3,
+                               u*u*u*y + 3*u*u*t*y1 + 3*u*t*t*y2 + t*t*t*y3))
+        elif cmd == 'Q':
+            (x1, y1, x2, y2) = params
+            n = _segments(math.hypot(x1 - x, y1 - y) + math.hypot(x2 - x1, y2 - y1), tolerance)
+            for i in range(1, n + 1):
+                t = float(i)/n
+                u = 1 - t
+                points.append((u*u*x + 2*u*t*x1 + t*t*x2, u*u*y + 2*u*t*y1 + t*t*y2))
+        else:
+            # Lines, and arcs drawn as lines
+            points.append((params[-2], params[-1]))
+
+        control = (params[-4], params[-3]) if cmd in ('C', 'Q') else None
+        (x, y) = points[-1]
+
+    return [(points, closed) for (points, closed) in subpaths if len(points) > 1 or closed]
+
+
+def _document_transform(element):
+    """Transform from element's coordinates to the document's"""
+    mat = identity
+    while element is not None:
+        if element.get('transform') is not None:
+            mat = composeTransform(parseTransform(element.get('transform')), mat)
+        element = element.getparent()
+
+    return mat
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Instrumentation of the pdf2pub stages
+
+Records, for each stage of pdf2pub (the geometry query, the label scan,
+and the numbered sections), its wall time, the number of elements in the
+document when it started, how many it removed or added, and the peak
+memory allocated during it. Memory is measured by tracemalloc, which
+only exists in Python 3 (it is reported as missing otherwise).
+"""
+
+import sys, time, json
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class Stages:
+    """Time, element counts, and peak memory of consecutive stages
+
+    stage(name) ends the current stage and starts the next one, and
+    finish() ends the last one and writes the report. Stages with the same
+    name (e.g., a section split in two) are added up. Removed and added
+    elements are the net change of the number of elements in the document.
+    Nothing is recorded unless enabled.
+    """
+    def __init__(self, root_node, enabled=True):
+        """Constructor"""
+        self.root_node = root_node
+        self.enabled = enabled
+        self.stages = []
+        self.index = {}
+        self.current = None
+        self.started = None
+        self.elements = 0
+        self.tracing = False
+        self.begin = time.time()
+
+        # Allocations are only traced if we started tracing them
+        if enabled and tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+
+    def count(self):
+        """Number of elements in the document"""
+        return sum(1 for element in self.root_node.iter())
+
+    def stage(self, name):
+        """End the current stage and start stage name"""
+        if not self.enabled:
+            return
+        self.end()
+
+        if name not in self.index:
+            self.index[name] = len(self.stages)
+            self.stages.append({'name': name, 'seconds': 0.0,
+                                'elements': None, 'removed': 0, 'added': 0,
+                                'peak_memory': None})
+        self.current = self.stages[self.index[name]]
+        self.elements = self.count()
+        if self.current['elements'] is None:
+            self.current['elements'] = self.elements
+
+        # Peaks are per stage where tracemalloc can reset them (3.9+)
+        if self.tracing and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.started = time.time()
+
+    def end(self):
+        """End the current stage (if any)"""
+        if self.current is None:
+            return
+        self.current['seconds'] += time.time() - self.started
+
+        elements = self.count()
+        if elements < self.elements:
+            self.current['removed'] += self.elements - elements
+        else:
+            self.current['added'] += elements - self.elements
+
+        if self.tracing:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.current['peak_memory'] = max(peak, self.current['peak_memory'] or 0)
+        self.current = None
+
+    def report(self):
+        """All stages and the total time, as a JSON-able dict"""
+        return {'stages': self.stages,
+                'seconds': time.time() - self.begin,
+                'tracemalloc': self.tracing}
+
+    def finish(self, filename='-'):
+        """End the last stage and write the report
+
+        The report is written as JSON to filename, or as a table to the
+        standard error if filename is - (or empty).
+        """
+        if not self.enabled:
+            return
+        self.end()
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+        if filename not in ('', '-'):
+            with open(filename, 'w') as f:
+                json.dump(self.report(), f, indent=1, sort_keys=True)
+                f.write('\n')
+            return
+
+        lines = ['%-34s %9s %9s %8s %8s %10s\n' % ('Stage', 'Time (s)', 'Elements',
+                                                  'Removed', 'Added', 'Peak (kB)')]
+        for stage in self.stages:
+            if stage['peak_memory'] is None:
+                peak = '-'
+            else:
+                peak = '%d' % (stage['peak_memory']//1024)
+            lines.append('%-34s %9.3f %9d %8d %8d %10s\n' % (stage['name'], stage['seconds'],
+                                                             stage['elements'], stage['removed'],
+                                                             stage['added'], peak))
+        lines.append('%-34s %9.3f\n' % ('Total', time.time() - self.begin))
+        sys.stderr.write(''.join(lines))
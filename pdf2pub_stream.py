@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+"""Streaming mode for pdf2pub
+
+Formats documents too large to be loaded at once (e.g., scatter plots with
+millions of markers) in two passes over the file, parsed incrementally:
+
+1. What pdf2pub needs to place the axes, ticks, labels, and legend (layers,
+   definitions, texts, the bounding box and grid paths, and one trace of
+   each color) is copied to a skeleton document, together with the extents
+   of the traces left out. The skeleton is then formatted as usual.
+
+2. The document is streamed to the output. Traces are classified, clipped,
+   and restyled as they go past, in the same way as the trace of their
+   color in the skeleton, and everything else is replaced by its formatted
+   copy.
+
+Memory use depends on the size of the skeleton, not on the number of
+traces. Options that need all traces at once are not available:
+
+    python pdf2pub_stream.py [options] input.svg > output.svg
+"""
+
+from lxml import etree
+from copy import deepcopy
+import sys, os, re, tempfile
+
+import inkex
+from simplestyle import parseStyle
+from simpletransform import parseTransform, composeTransform, formatTransform, invertTransform
+from simpletransform import applyTransformToPoint
+
+from pdf2pub import pdf2pub, StyleCache, Pdf2pubError, style_matches
+from pdf2pub_geometry import query_element, element_context, path_endpoints, find_frame
+from pdf2pub_geometry import element_transform, transform_box, identity
+from pdf2pub_traces import clip_paths
+from pdf2pub_output import precision_decimals
+
+
+# Skeleton elements are tagged with their position in the document
+stream_ns = 'http://www.seas.upenn.edu/luizf/pdf2pub/stream'
+ordinal_attribute = '{%s}ordinal' % stream_ns
+placeholder_attribute = '{%s}placeholder' % stream_ns
+
+# Elements streamed through their own children
+container_tags = ('svg', 'g', 'a', 'switch')
+
+# Elements that may be traces (everything else is copied to the skeleton)
+drawing_tags = ('path', 'rect', 'circle', 'ellipse', 'line', 'polyline',
+                'polygon', 'image', 'use')
+
+# Options that need all traces at once (turned off when streaming)
+unsupported_options = ['multi_axes', 'merge_traces', 'decimate', 'instance_markers', 'rasterize',
+                       'css_classes', 'collect_garbage', 'resample_images', 'compact', 'incremental',
+                       'analyze_only']
+
+# Records that count towards the plot area (see 2a in pdf2pub.py)
+_extents_re = re.compile(r'^(?!svg)(?!layer)(?!tspan)(?!text)[-\w]+$')
+_id_re = re.compile(r'[A-z]+(\d+)')
+_xmlns_re = re.compile(br' xmlns(?::([\w.-]+))?="([^"]*)"')
+
+
+def stream_file(filename, output, args):
+    """Run pdf2pub on filename in streaming mode
+
+    args are the pdf2pub command line options and output is a file name or
+    a binary file object.
+    """
+    effect = pdf2pub()
+    effect.getoptions(args + [filename])
+    options = effect.options
+
+    ignored = [name for name in unsupported_options if getattr(options, name) == 'true']
+    if options.geometry != 'python':
+        ignored.append('geometry=%s' % options.geometry)
+    if ignored:
+        inkex.errormsg('WARNING: not available in streaming mode, ignored: %s.\n' %
+                       ', '.join(ignored))
+
+    (skeleton, copied, representatives, frame) = build_skeleton(filename, options)
+
+    # Format the skeleton with the built-in geometry engine
+    (handle, skeleton_file) = tempfile.mkstemp(suffix='.svg', prefix='pdf2pub-')
+    os.close(handle)
+    try:
+        etree.ElementTree(skeleton).write(skeleton_file)
+        effect.affect(args=args + ['--%s=false' % name for name in unsupported_options] +
+                      ['--geometry=python', '--cache=false', skeleton_file], output=False)
+    finally:
+        os.remove(skeleton_file)
+
+    formatted = {}
+    for element in effect.document.getroot().iter():
+        if isinstance(element.tag, str) and element.get(ordinal_attribute) is not None:
+            formatted[int(element.get(ordinal_attribute))] = element
+
+    # Traces are restyled as their color's representative was
+    changes = ({}, {})
+    for (ordinal, colors) in representatives.items():
+        if ordinal not in formatted:
+            continue
+        style = parseStyle(formatted[ordinal].get('style'))
+        for (kind, color, names) in ((0, colors[0], ('stroke-width', 'stroke')),
+                                     (1, colors[1], ('fill',))):
+            if color is not None:
+                changes[kind][color] = [(name, style[name]) for name in names if name in style]
+
+    if hasattr(output, 'write'):
+        write_stream(filename, output, formatted, copied, changes, frame, options)
+    else:
+        with open(output, 'wb') as f:
+            write_stream(filename, f, formatted, copied, changes, frame, options)
+
+
+def build_skeleton(filename, options):
+    """First pass: copy what pdf2pub needs to a skeleton document
+
+    Traces are left out, but for one of each stroke and fill color, which
+    is reduced to a point in the middle of the bounding box. Layers keep a
+    placeholder for what was left out, so that pdf2pub removes the same
+    ones, and the skeleton ends with placeholders spanning the extents of
+    the traces and holding the largest id.
+
+    Returns (skeleton, copied, representatives, frame): copied holds the
+    ordinals of the elements copied as they are and representatives maps
+    the ordinals of the reduced traces to the (stroke, fill) colors they
+    stand for (None if another trace does). frame is the rectangle spanned
+    by the bounding box (see find_frame).
+    """
+    bbox_style_find = parseStyle(options.bbox_style_find)
+    grid_style_find = parseStyle(options.grid_style_find)
+    clip = options.clip_traces == 'true'
+    styles = StyleCache()
+
+    skeleton = None
+    unittouu = None
+    copied = set()
+    representatives = {}
+    reduced = []
+    bbox = []
+    represented = (set(['none']), set(['none']))
+    extents = None
+    clipped_extents = None
+    last_record = None
+    nrecords = 0
+
+    # Open containers: [copy, transform, style, bbox, left out bbox, blank,
+    # has left out blank children, has left out other children, nrecords]
+    stack = []
+    ordinal = 0
+    depth = 0
+
+    for (event, element) in etree.iterparse(filename, events=('start', 'end'), huge_tree=True):
+        if event == 'start':
+            if depth > 0 or not _is_container(element):
+                depth = depth + 1
+                if depth == 1:
+                    ordinal = ordinal + 1
+                continue
+
+            ordinal = ordinal + 1
+            if stack:
+                (mat, style) = element_context(element, stack[-1][1], stack[-1][2])
+                copy = etree.SubElement(stack[-1][0], element.tag, dict(element.attrib),
+                                        nsmap=element.nsmap)
+            else:
+                (mat, style) = element_context(element)
+                copy = etree.Element(element.tag, dict(element.attrib), nsmap=element.nsmap)
+                skeleton = copy
+                unittouu = _unittouu(element)
+            copy.set(ordinal_attribute, str(ordinal))
+
+            stack.append([copy, mat, style, None, None, True, False, False, nrecords])
+            continue
+
+        if depth > 1:
+            depth = depth - 1
+            continue
+
+        if depth == 1:
+            # Leaf element (with its subtree)
+            depth = 0
+            parent = stack[-1]
+            (element_bbox, records) = query_element(element, parent[1], parent[2], unittouu)
+            kind = _classify(element, styles, bbox_style_find, grid_style_find)
+
+            if kind == 'copy':
+                copy = deepcopy(element)
+                copy.tail = None
+                copy.set(ordinal_attribute, str(ordinal))
+                parent[0].append(copy)
+                copied.add(ordinal)
+                if element.tag == inkex.addNS('path', 'svg') and element.get('style') is not None:
+                    if style_matches(styles.get(element), bbox_style_find):
+                        bbox.append(copy)
+            else:
+                parent[4] = _union(parent[4], element_bbox)
+                if kind == 'blank':
+                    parent[6] = True
+                else:
+                    parent[7] = True
+
+                clipped = (kind == 'trace' and clip and
+                           (element.get('clip-path') is not None or
+                            'clip-path' in styles.get(element)))
+                if kind != 'blank':
+                    for record in records:
+                        if _extents_re.match(record[0]):
+                            box = (record[1], record[2], record[1] + record[3], record[2] + record[4])
+                            if clipped:
+                                clipped_extents = _union(clipped_extents, box)
+                            else:
+                                extents = _union(extents, box)
+
+                # Each trace color gets a representative, even if copied
+                # elements (e.g., texts) have the same color
+                if kind == 'trace':
+                    style = styles.get(element)
+                    stroke = style.get('stroke', 'none')
+                    fill = style.get('fill', 'none')
+                    new = (stroke if stroke not in represented[0] else None,
+                           fill if fill not in represented[1] else None)
+                    if new != (None, None):
+                        represented[0].add(stroke)
+                        represented[1].add(fill)
+                        tag = 'path' if element.tag == inkex.addNS('path', 'svg') else 'polyline'
+                        copy = etree.SubElement(parent[0], inkex.addNS(tag, 'svg'))
+                        for name in ('id', 'style', 'clip-path'):
+                            if element.get(name) is not None:
+                                copy.set(name, element.get(name))
+                        copy.set(ordinal_attribute, str(ordinal))
+                        representatives[ordinal] = new
+                        reduced.append((copy, parent[1]))
+
+            parent[3] = _union(parent[3], element_bbox)
+            parent[5] = parent[5] and kind == 'blank'
+            nrecords = nrecords + len(records)
+            if records:
+                last_record = records[-1][0]
+
+            _prune(element)
+            continue
+
+        # End of a container
+        (copy, mat, style, container_bbox, left_out, blank, has_blank, has_other,
+         start_records) = stack.pop()
+        blank = blank and element.tag == inkex.addNS('g', 'svg')
+        if element.get('id') is not None and container_bbox is not None:
+            if nrecords == start_records:
+                last_record = element.get('id')
+            nrecords = nrecords + 1
+            if left_out is not None and not blank and _extents_re.match(element.get('id')):
+                extents = _union(extents, left_out)
+
+        if has_blank:
+            etree.SubElement(copy, inkex.addNS('path', 'svg'),
+                             {placeholder_attribute: 'true', 'style': 'fill:#ffffff;stroke:none'})
+        if has_other:
+            etree.SubElement(copy, inkex.addNS('path', 'svg'), {placeholder_attribute: 'true'})
+
+        if stack:
+            parent = stack[-1]
+            parent[3] = _union(parent[3], container_bbox)
+            parent[4] = _union(parent[4], left_out)
+            parent[5] = parent[5] and blank
+            _prune(element)
+            continue
+
+        # Traces clipped by pdf2pub do not reach beyond the bounding box
+        frame = find_frame(path_endpoints(bbox))
+        if frame is not None:
+            frame = transform_box(element_transform(bbox[0]), frame)
+        if frame is None or not clip:
+            extents = _union(extents, clipped_extents)
+
+        center = frame or extents or (0, 0, 0, 0)
+        center = [(center[0] + center[2])/2.0, (center[1] + center[3])/2.0]
+        for (copy, parent_mat) in reduced:
+            point = list(center)
+            applyTransformToPoint(invertTransform(parent_mat), point)
+            if copy.tag == inkex.addNS('path', 'svg'):
+                copy.set('d', 'M %f,%f' % tuple(point))
+            else:
+                copy.set('points', '%f,%f' % tuple(point))
+
+        inverse = invertTransform(mat)
+        applyTransformToPoint(inverse, center)
+        if extents is not None:
+            corners = [list(extents[0:2]), list(extents[2:4])]
+            for point in corners:
+                applyTransformToPoint(inverse, point)
+            etree.SubElement(skeleton, inkex.addNS('path', 'svg'),
+                             {placeholder_attribute: 'true', 'id': 'pdf2pub-extents',
+                              'd': 'M %f,%f %f,%f' % tuple(corners[0] + corners[1])})
+        if last_record is not None:
+            etree.SubElement(skeleton, inkex.addNS('path', 'svg'),
+                             {placeholder_attribute: 'true', 'id': '%s-last' % last_record,
+                              'd': 'M %f,%f' % tuple(center)})
+
+    return (skeleton, copied, representatives, frame)
+
+
+def write_stream(filename, output, formatted, copied, changes, frame, options):
+    """Second pass: write the formatted document to output
+
+    formatted maps ordinals to the elements of the formatted skeleton and
+    changes holds the style changes ({stroke: changes}, {fill: changes}) of
+    traces of each color (see stream_file).
+    """
+    bbox_style_find = parseStyle(options.bbox_style_find)
+    grid_style_find = parseStyle(options.grid_style_find)
+    clip = options.clip_traces == 'true' and frame is not None
+    styles = StyleCache()
+
+    # Cut traces keep the precision of the final figure, whose size and
+    # viewBox pdf2pub set on the root (ordinal 1)
+    root = formatted.get(1)
+    try:
+        scale = float(root.get('width'))/float(root.get('viewBox').split()[2])
+    except (AttributeError, ValueError, IndexError, ZeroDivisionError):
+        scale = 0
+    decimals = precision_decimals(scale, options.precision)
+
+    # New elements get ids after those of the formatted skeleton
+    last_id = 0
+    for element in formatted.values():
+        for node in element.iter():
+            number = _id_re.match(node.get('id', '')) if isinstance(node.tag, str) else None
+            if number is not None:
+                last_id = max(last_id, int(number.group(1)))
+    # Clip paths of crossing traces, by transform (see clip_paths)
+    clip_ids = {}
+    crossed = []
+
+    declared = set()
+    unittouu = None
+
+    # Open containers: [formatted copy (None if removed), transform, style]
+    stack = []
+    ordinal = 0
+    depth = 0
+
+    output.write(b'<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n')
+    for (event, element) in etree.iterparse(filename, events=('start', 'end'), huge_tree=True):
+        if event == 'start':
+            if depth > 0 or not _is_container(element):
+                depth = depth + 1
+                if depth == 1:
+                    ordinal = ordinal + 1
+                continue
+
+            ordinal = ordinal + 1
+            if stack:
+                (mat, style) = element_context(element, stack[-1][1], stack[-1][2])
+                copy = formatted.get(ordinal) if stack[-1][0] is not None else None
+            else:
+                (mat, style) = element_context(element)
+                copy = formatted.get(ordinal)
+                unittouu = _unittouu(element)
+
+            if copy is not None:
+                output.write(_start_tag(copy, element.nsmap, declared))
+            stack.append([copy, mat, style])
+            continue
+
+        if depth > 1:
+            depth = depth - 1
+            continue
+
+        if depth == 1:
+            depth = 0
+            parent = stack[-1]
+            if parent[0] is None:
+                pass
+            elif ordinal in copied:
+                if ordinal in formatted:
+                    copy = deepcopy(formatted[ordinal])
+                    del copy.attrib[ordinal_attribute]
+                    output.write(_serialize(copy, declared))
+            else:
+                kind = _classify(element, styles, bbox_style_find, grid_style_find)
+                if kind == 'trace':
+                    style = styles.get(element)
+                    element_changes = []
+                    if clip and (element.get('clip-path') is not None or 'clip-path' in style):
+                        (removed, cut, crossing) = clip_paths([element], frame, styles,
+                                                              decimals, unittouu)
+                        if removed:
+                            kind = 'blank'
+                        elif crossing:
+                            mat = invertTransform(composeTransform(
+                                parent[1], parseTransform(element.get('transform'))))
+                            key = formatTransform(mat) if mat != identity else None
+                            if key not in clip_ids:
+                                clip_ids[key] = 'clipPath%d' % (last_id + 2*len(crossed) + 1)
+                                crossed.append(key)
+                            clip_id = clip_ids[key]
+                            element.set('clip-path', 'url(#%s)' % clip_id)
+                            if 'clip-path' in style:
+                                element_changes.append(('clip-path', 'url(#%s)' % clip_id))
+
+                    stroke = style.get('stroke', 'none')
+                    fill = style.get('fill', 'none')
+                    if stroke != 'none':
+                        element_changes.extend(changes[0].get(stroke, []))
+                    if stroke != 'none' or fill != 'none' or element_changes:
+                        if fill != 'none':
+                            element_changes.extend(changes[1].get(fill, []))
+                        styles.update(element, element_changes)
+                        styles.commit()
+
+                if kind != 'blank':
+                    output.write(_serialize(element, declared))
+
+            if element.getparent() is not None:
+                _prune(element)
+            continue
+
+        # End of a container: elements added by pdf2pub come last
+        (copy, mat, style) = stack.pop()
+        if copy is not None:
+            for child in copy:
+                if (isinstance(child.tag, str) and child.get(ordinal_attribute) is None and
+                        child.get(placeholder_attribute) is None):
+                    output.write(_serialize(child, declared))
+
+            if not stack and crossed:
+                defs = etree.Element(inkex.addNS('defs', 'svg'))
+                for (k, key) in enumerate(crossed):
+                    clip_path = etree.SubElement(defs, inkex.addNS('clipPath', 'svg'),
+                                                 id=clip_ids[key], clipPathUnits='userSpaceOnUse')
+                    if key is not None:
+                        clip_path.set('transform', key)
+                    etree.SubElement(clip_path, inkex.addNS('rect', 'svg'),
+                                     id='rect%d' % (last_id + 2*k + 2),
+                                     x='%f' % frame[0], y='%f' % frame[1],
+                                     width='%f' % (frame[2] - frame[0]),
+                                     height='%f' % (frame[3] - frame[1]))
+                output.write(_serialize(defs, declared))
+
+            output.write(('</%s>\n' % _qualified_name(copy.tag, element.nsmap)).encode('utf-8'))
+
+        if stack:
+            _prune(element)
+
+
+def _is_container(element):
+    return (element.tag.startswith('{%s}' % inkex.NSS['svg']) and
+            element.tag.split('}')[-1] in container_tags)
+
+
+def _classify(element, styles, bbox_style_find, grid_style_find):
+    """How an element below a container is streamed
+
+    Returns 'copy' (the element goes to the skeleton as it is), 'blank'
+    (white elements pdf2pub removes), 'trace', or 'plain' (unstyled elements
+    that are left alone), following classify_elements in pdf2pub.py.
+    """
+    if (not element.tag.startswith('{%s}' % inkex.NSS['svg']) or
+            element.tag.split('}')[-1] not in drawing_tags):
+        return 'copy'
+    if element.get('style') is None:
+        return 'plain'
+
+    style = styles.get(element)
+    if element.tag == inkex.addNS('path', 'svg'):
+        fill = style.get('fill')
+        stroke = style.get('stroke')
+        if ((fill == '#ffffff' and stroke == 'none') or
+                (fill == 'none' and stroke == '#ffffff')):
+            return 'blank'
+        if style_matches(style, bbox_style_find) or style_matches(style, grid_style_find):
+            return 'copy'
+
+    return 'trace'
+
+
+def _unittouu(root):
+    """Unit conversion of the document whose root is root"""
+    effect = pdf2pub()
+    effect.document = etree.ElementTree(etree.Element(root.tag, dict(root.attrib),
+                                                      nsmap=root.nsmap))
+    return effect.unittouu
+
+
+def _union(bbox, other):
+    if bbox is None:
+        return other
+    if other is None:
+        return bbox
+
+    return (min(bbox[0], other[0]), min(bbox[1], other[1]),
+            max(bbox[2], other[2]), max(bbox[3], other[3]))
+
+
+def _prune(element):
+    """Free an element and its earlier siblings once they were handled"""
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
+def _qualified_name(name, nsmap):
+    """Prefixed name of a tag or attribute, given the namespaces in scope"""
+    if not name.startswith('{'):
+        return name
+    (uri, local) = name[1:].split('}')
+    if nsmap.get(None) == uri:
+        return local
+    for (prefix, namespace) in nsmap.items():
+        if namespace == uri:
+            return local if prefix is None else '%s:%s' % (prefix, local)
+    if uri == inkex.NSS['svg']:
+        return local
+
+    return name
+
+
+def _start_tag(element, nsmap, declared):
+    """Start tag of element with the namespaces not yet declared"""
+    parts = [_qualified_name(element.tag, nsmap)]
+    for (prefix, uri) in nsmap.items():
+        if (prefix, uri) not in declared and uri != stream_ns:
+            declared.add((prefix, uri))
+            parts.append('xmlns="%s"' % uri if prefix is None else 'xmlns:%s="%s"' % (prefix, uri))
+    for (name, value) in element.attrib.items():
+        if not name.startswith('{%s}' % stream_ns):
+            parts.append('%s=%s' % (_qualified_name(name, nsmap), _quote(value)))
+
+    return ('<%s>\n' % ' '.join(parts)).encode('utf-8')
+
+
+def _quote(value):
+    return '"%s"' % (value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                     .replace('"', '&quot;').replace('\n', '&#10;').replace('\t', '&#9;'))
+
+
+def _serialize(element, declared):
+    """Serialize element, without the namespace declarations in scope"""
+    text = etree.tostring(element, with_tail=False)
+    end = text.find(b'>')
+
+    def strip(match):
+        prefix = match.group(1).decode('utf-8') if match.group(1) is not None else None
+        uri = match.group(2).decode('utf-8')
+        if (prefix, uri) in declared or uri == stream_ns:
+            return b''
+        return match.group(0)
+
+    return _xmlns_re.sub(strip, text[:end]) + text[end:] + b'\n'
+
+
+def main(argv=sys.argv[1:]):
+    parser = pdf2pub().OptionParser
+    parser.set_usage('usage: %prog [options] SVGfile > output.svg')
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('one input file is required')
+
+    output = sys.stdout.buffer if hasattr(sys.stdout, 'buffer') else sys.stdout
+    try:
+        stream_file(args[0], output, [arg for arg in argv if arg != args[0]])
+    except Pdf2pubError as err:
+        inkex.errormsg(str(err))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
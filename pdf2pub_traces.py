@@ -0,0 +1,613 @@
+#!/usr/bin/env python
+"""Plot trace processing for pdf2pub
+
+Optional stages that rewrite the path data of plot traces found by pdf2pub
+(its curves_stroke), e.g., to undo the fragmentation of MATLAB exports.
+"""
+
+import re, math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from lxml import etree
+
+import inkex
+from simplepath import parsePath, formatPath
+
+from pdf2pub_geometry import identity, ancestor_context, query_element
+from pdf2pub_output import compact_segments
+
+
+# Commands (after the initial moveto) of paths that can be joined
+merge_commands = ['L', 'C', 'Q', 'A']
+
+# Digits kept when comparing marker shapes
+instance_digits = 6
+
+# Path data starting with a moveto followed by relative commands
+_relative_re = re.compile(r'^\s*[Mm]\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)[\s,]*'
+                          r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)[\s,]*([a-df-z].*)$', re.DOTALL)
+_absolute_re = re.compile(r'[A-DF-Z]')
+
+# Path data tokens: line commands, numbers, and any other command
+_token_re = re.compile(r'([MmLlHhVvZz])|([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)|([A-Za-z])')
+
+
+def merge_segments(elements, styles, decimals):
+    """Join end-to-end path segments into continuous paths
+
+    Only runs of consecutive siblings with the same style and attributes are
+    joined, so that the stacking order of the drawing does not change. A
+    segment joins another if it starts exactly where the other one ends (or
+    ends where it starts). Each chain of segments is written to its first
+    element and the other elements are removed from the document.
+
+    Filled, dashed, and marked paths are left alone, since joining them
+    would change how they are drawn. Styles are read through styles (a
+    StyleCache). Joined path data is written with coordinates rounded to
+    decimals (see compact_path). Returns the set of removed elements.
+    """
+    path_tag = inkex.addNS('path', 'svg')
+
+    # Parsed path data of the paths that can be joined
+    paths = {}
+    parents = []
+    for element in elements:
+        if element.tag != path_tag or element in paths:
+            continue
+
+        style = styles.get(element)
+        if style.get('fill', 'black') != 'none' or style.get('stroke-dasharray', 'none') != 'none':
+            continue
+
+        if _has_markers(element, style):
+            continue
+
+        path = _joinable_path(element.get('d', ''))
+        if path is not None:
+            paths[element] = path
+            parents.append(element.getparent())
+
+    removed = set()
+    for parent in _unique(parents):
+        run = []
+        key = None
+        for child in parent:
+            child_key = _merge_key(child) if child in paths else None
+            if child_key is None or child_key != key:
+                removed.update(_merge_run(run, paths, decimals))
+                run = []
+            key = child_key
+            if child_key is not None:
+                run.append(child)
+        removed.update(_merge_run(run, paths, decimals))
+
+    return removed
+
+
+def decimate_paths(elements, tolerance, scale, styles, decimals):
+    """Remove points of polylines that barely change their shape
+
+    Points are dropped with the Ramer-Douglas-Peucker algorithm, so that no
+    polyline moves by more than tolerance. Coordinates are multiplied by
+    scale, (sx, sy), before measuring distances, so that tolerance can be
+    given in output units. End points of each subpath are always kept.
+    Path data is written with coordinates rounded to decimals (see
+    compact_path).
+
+    Only paths made of straight lines and without transform or markers are
+    decimated. Returns the number of points (before, after).
+    """
+    path_tag = inkex.addNS('path', 'svg')
+
+    before = 0
+    after = 0
+    for element in elements:
+        if (element.tag != path_tag or element.get('transform') is not None or
+                _has_markers(element, styles.get(element))):
+            continue
+
+        subpaths = _polylines(element.get('d', ''))
+        if subpaths is None:
+            continue
+
+        path = []
+        for (points, closed) in subpaths:
+            kept = [points[idx] for idx in _rdp(points, tolerance, scale)]
+            before = before + len(points)
+            after = after + len(kept)
+
+            path.append(['M', kept[0]])
+            path.extend([['L', point] for point in kept[1:]])
+            if closed:
+                path.append(['Z', []])
+
+        if path:
+            element.set('d', compact_segments(path, decimals))
+
+    return (before, after)
+
+
+def clip_paths(elements, frame, styles, decimals, unittouu=None):
+    """Cut traces that were clipped in the original drawing to frame
+
+    Only elements referencing a clip path (which pdf2pub removes) are
+    handled, using frame, (left, top, right, bottom) in document
+    coordinates, instead. Elements whose bounding box lies outside of frame
+    are removed from the document. The path data of stroked polylines that
+    cross the frame is cut to it (if they are drawn in document
+    coordinates, i.e., neither they nor their parents are transformed), and
+    written with coordinates rounded to decimals (see compact_path).
+
+    Returns (removed, clipped, crossing): the sets of removed elements, of
+    elements whose path data was cut, and of elements that cross the frame
+    but could not be cut (e.g., markers drawn with curves).
+    """
+    path_tag = inkex.addNS('path', 'svg')
+    (left, top, right, bottom) = frame
+
+    removed = set()
+    clipped = set()
+    crossing = set()
+    contexts = {}
+    for element in elements:
+        if element in removed or element in clipped or element in crossing:
+            continue
+
+        style = styles.get(element)
+        if element.get('clip-path') is None and 'clip-path' not in style:
+            continue
+
+        # Bounding boxes are computed in document coordinates, as frame
+        parent = element.getparent()
+        if parent not in contexts:
+            contexts[parent] = ancestor_context(element)
+        (mat, parent_style) = contexts[parent]
+        bbox = query_element(element, mat, parent_style, unittouu)[0]
+        if bbox is not None:
+            (x1, y1, x2, y2) = bbox
+            if x1 > right or y1 > bottom or x2 < left or y2 < top:
+                element.getparent().remove(element)
+                removed.add(element)
+                continue
+            if x1 >= left and y1 >= top and x2 <= right and y2 <= bottom:
+                continue
+
+        if (element.tag != path_tag or element.get('transform') is not None or
+                mat != identity or style.get('fill', 'black') != 'none' or
+                _has_markers(element, style)):
+            crossing.add(element)
+            continue
+
+        subpaths = _polylines(element.get('d', ''))
+        if subpaths is None:
+            crossing.add(element)
+            continue
+
+        path = []
+        cut = False
+        for (points, closed) in subpaths:
+            # Subpaths inside of the frame are kept as they are
+            if all([left <= x <= right and top <= y <= bottom for (x, y) in points]):
+                path.append(['M', points[0]])
+                path.extend([['L', point] for point in points[1:]])
+                if closed:
+                    path.append(['Z', []])
+                continue
+
+            cut = True
+            if closed:
+                points = points + [points[0]]
+            for part in _clip_polyline(points, frame):
+                path.append(['M', part[0]])
+                path.extend([['L', point] for point in part[1:]])
+
+        if not cut:
+            continue
+        if path:
+            element.set('d', compact_segments(path, decimals))
+            clipped.add(element)
+        else:
+            element.getparent().remove(element)
+            removed.add(element)
+
+    return (removed, clipped, crossing)
+
+
+def instance_markers(elements, styles, defs_node, last_id):
+    """Replace copies of the same marker by references to one definition
+
+    Paths with the same style and the same path data up to a translation
+    (e.g., scatter plot markers) are drawn by a single path inside a
+    <symbol> under defs_node. Each copy is replaced, in place, by a <use>
+    that keeps its id and clip path and only adds the translation.
+
+    New ids continue from last_id. Returns (instances, last_id), where
+    instances maps each replaced element to the path of its definition.
+    """
+    path_tag = inkex.addNS('path', 'svg')
+    href = inkex.addNS('href', 'xlink')
+
+    # {(shape, style, clip path): [(element, x, y), ...]}
+    copies = {}
+    order = []
+    seen = set()
+    for element in elements:
+        # Elements with both a stroke and a fill come up twice
+        if element.tag != path_tag or element in seen:
+            continue
+        seen.add(element)
+        if any([name not in ('id', 'd', 'style', 'clip-path') for name in element.keys()]):
+            continue
+        style = styles.get(element)
+        if any([name in style for name in ('clip-path', 'mask', 'filter')]):
+            continue
+
+        shape = _marker_shape(element.get('d', ''))
+        if shape is None:
+            continue
+
+        (outline, x, y, d) = shape
+        key = (outline, element.get('style'), element.get('clip-path'))
+        if key not in copies:
+            copies[key] = []
+            order.append(key)
+        copies[key].append((element, x, y, d))
+
+    instances = {}
+    for key in order:
+        if len(copies[key]) < 2:
+            continue
+        (first, x, y, d) = copies[key][0]
+
+        last_id = last_id + 1
+        symbol = etree.Element('symbol',
+            id = 'symbol%d' % last_id,
+            style = 'overflow:visible')
+
+        last_id = last_id + 1
+        definition = etree.Element('path',
+            id = 'path%d' % last_id,
+            style = first.get('style'),
+            d = d)
+
+        symbol.append(definition)
+        defs_node.append(symbol)
+
+        for (element, x, y, d) in copies[key]:
+            use = etree.Element('use')
+            use.set('id', element.get('id'))
+            use.set(href, '#%s' % symbol.get('id'))
+            use.set('x', repr(x))
+            use.set('y', repr(y))
+            if element.get('clip-path') is not None:
+                use.set('clip-path', element.get('clip-path'))
+
+            element.getparent().replace(element, use)
+            instances[element] = definition
+
+    return (instances, last_id)
+
+
+def _marker_shape(d):
+    """Shape of path data, independent of its position
+
+    Returns (outline, x, y, d): a hashable outline, the start point, and
+    path data drawing the shape from the origin. None for paths that do not
+    start with a moveto.
+    """
+    # Relative path data (as written by Inkscape) is compared as text
+    data = _relative_re.match(d)
+    if data is not None and _absolute_re.search(data.group(3)) is None:
+        rest = data.group(3).strip()
+        return (rest, float(data.group(1)), float(data.group(2)), 'm 0,0 ' + rest)
+
+    try:
+        path = parsePath(d)
+    except Exception:
+        return None
+    if len(path) < 2 or path[0][0] != 'M':
+        return None
+
+    (x, y) = path[0][1][0:2]
+    shape = _translate(path, -x, -y)
+    outline = tuple([(cmd, tuple([round(value, instance_digits) for value in params]))
+                     for (cmd, params) in shape])
+
+    return (outline, x, y, formatPath(shape))
+
+
+def _translate(path, dx, dy):
+    """Copy of (absolute) path data moved by (dx, dy)"""
+    moved = []
+    for (cmd, params) in path:
+        params = list(params)
+        # Only the end point of arcs is a coordinate
+        first = 5 if cmd == 'A' else 0
+        for i in range(first, len(params) - 1, 2):
+            params[i] = params[i] + dx
+            params[i+1] = params[i+1] + dy
+        moved.append([cmd, params])
+
+    return moved
+
+
+def _clip_polyline(points, frame):
+    """Parts of a polyline inside frame (Liang-Barsky)
+
+    Returns a list of polylines (lists of [x, y] points).
+    """
+    if len(points) < 2:
+        return []
+
+    (left, top, right, bottom) = frame
+    if numpy is not None:
+        xy = numpy.array(points, dtype=float)
+        start = xy[:-1]
+        delta = xy[1:] - start
+        t0 = numpy.zeros(len(start))
+        t1 = numpy.ones(len(start))
+        visible = numpy.ones(len(start), dtype=bool)
+
+        # Each frame side as p*t <= q along the segments
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            for (p, q) in [(-delta[:, 0], start[:, 0] - left),
+                           (delta[:, 0], right - start[:, 0]),
+                           (-delta[:, 1], start[:, 1] - top),
+                           (delta[:, 1], bottom - start[:, 1])]:
+                visible &= (p != 0) | (q >= 0)
+                ratio = q/p
+                t0 = numpy.where(p < 0, numpy.maximum(t0, ratio), t0)
+                t1 = numpy.where(p > 0, numpy.minimum(t1, ratio), t1)
+        visible &= t0 <= t1
+
+        first = (start + t0[:, None]*delta).tolist()
+        last = (start + t1[:, None]*delta).tolist()
+        (t0, t1, visible) = (t0.tolist(), t1.tolist(), visible.tolist())
+    else:
+        (t0, t1, visible, first, last) = ([], [], [], [], [])
+        for ((x0, y0), (x1, y1)) in zip(points[:-1], points[1:]):
+            (dx, dy) = (x1 - x0, y1 - y0)
+            (a, b, inside) = (0.0, 1.0, True)
+            for (p, q) in [(-dx, x0 - left), (dx, right - x0),
+                           (-dy, y0 - top), (dy, bottom - y0)]:
+                if p == 0:
+                    inside = inside and q >= 0
+                elif p < 0:
+                    a = max(a, q/p)
+                else:
+                    b = min(b, q/p)
+            t0.append(a)
+            t1.append(b)
+            visible.append(inside and a <= b)
+            first.append([x0 + a*dx, y0 + a*dy])
+            last.append([x0 + b*dx, y0 + b*dy])
+
+    # Consecutive segments are joined unless the polyline left the frame
+    parts = []
+    joined = False
+    for idx in range(len(visible)):
+        if not visible[idx]:
+            joined = False
+            continue
+        if not joined or t0[idx] > 0:
+            parts.append([first[idx]])
+        parts[-1].append(last[idx])
+        joined = t1[idx] >= 1
+
+    return parts
+
+
+def _polylines(d):
+    """Subpaths of path data made only of straight lines
+
+    Returns a list of (points, closed), with absolute [x, y] points, or
+    None if the path has curves.
+    """
+    subpaths = []
+    cmd = None
+    args = []
+    (x, y) = (0.0, 0.0)
+    start = (0.0, 0.0)
+    closed = False
+    for (letter, number, other) in _token_re.findall(d):
+        if other:
+            return None
+        if letter:
+            cmd = letter
+            args = []
+            if cmd in 'Zz':
+                if subpaths:
+                    subpaths[-1][1] = True
+                (x, y) = start
+                closed = True
+            continue
+        if cmd is None or cmd in 'Zz':
+            return None
+
+        args.append(float(number))
+        if len(args) < (1 if cmd in 'HhVv' else 2):
+            continue
+
+        if cmd in 'MmLl':
+            (dx, dy) = args if cmd.islower() else (args[0] - x, args[1] - y)
+        elif cmd in 'Hh':
+            (dx, dy) = (args[0] if cmd == 'h' else args[0] - x, 0.0)
+        else:
+            (dx, dy) = (0.0, args[0] if cmd == 'v' else args[0] - y)
+        (x, y) = (x + dx, y + dy)
+        args = []
+
+        if cmd in 'Mm':
+            subpaths.append([[[x, y]], False])
+            start = (x, y)
+            closed = False
+            # Further coordinate pairs are implicit linetos
+            cmd = 'l' if cmd == 'm' else 'L'
+        else:
+            if closed or len(subpaths) == 0:
+                # Drawing after closepath starts a new subpath
+                subpaths.append([[list(start)], False])
+                closed = False
+            subpaths[-1][0].append([x, y])
+
+    return [(points, closed) for (points, closed) in subpaths]
+
+
+def _rdp(points, tolerance, scale):
+    """Indices of the points kept by Ramer-Douglas-Peucker"""
+    if len(points) < 3:
+        return list(range(len(points)))
+
+    if numpy is not None:
+        xy = numpy.array(points, dtype=float)*numpy.array(scale, dtype=float)
+        keep = numpy.zeros(len(points), dtype=bool)
+        keep[0] = keep[-1] = True
+
+        stack = [(0, len(points) - 1)]
+        while stack:
+            (first, last) = stack.pop()
+            if last - first < 2:
+                continue
+
+            (dx, dy) = xy[last] - xy[first]
+            norm = math.hypot(dx, dy)
+            inner = xy[first+1:last] - xy[first]
+            # Distance to the line through first and last (or to first)
+            if norm > 0:
+                dist = numpy.abs(dx*inner[:, 1] - dy*inner[:, 0])/norm
+            else:
+                dist = numpy.hypot(inner[:, 0], inner[:, 1])
+
+            idx = int(numpy.argmax(dist))
+            if dist[idx] > tolerance:
+                idx = first + 1 + idx
+                keep[idx] = True
+                stack.append((first, idx))
+                stack.append((idx, last))
+
+        return numpy.nonzero(keep)[0].tolist()
+
+    xy = [(x*scale[0], y*scale[1]) for (x, y) in points]
+    keep = set([0, len(points) - 1])
+    stack = [(0, len(points) - 1)]
+    while stack:
+        (first, last) = stack.pop()
+        if last - first < 2:
+            continue
+
+        (x0, y0) = xy[first]
+        (dx, dy) = (xy[last][0] - x0, xy[last][1] - y0)
+        norm = math.hypot(dx, dy)
+        (dist, idx) = (-1, None)
+        for i in range(first + 1, last):
+            if norm > 0:
+                d = abs(dx*(xy[i][1] - y0) - dy*(xy[i][0] - x0))/norm
+            else:
+                d = math.hypot(xy[i][0] - x0, xy[i][1] - y0)
+            if d > dist:
+                (dist, idx) = (d, i)
+
+        if dist > tolerance:
+            keep.add(idx)
+            stack.append((first, idx))
+            stack.append((idx, last))
+
+    return sorted(keep)
+
+
+def _has_markers(element, style):
+    """Check if element has markers (as style property or attribute)"""
+    return any([name.startswith('marker') for name in list(style.keys()) + list(element.keys())])
+
+
+def _joinable_path(d):
+    """Absolute path data of a single open subpath, None for other paths"""
+    try:
+        path = parsePath(d)
+    except Exception:
+        return None
+
+    if len(path) < 2 or path[0][0] != 'M':
+        return None
+    if any([cmd not in merge_commands for (cmd, params) in path[1:]]):
+        return None
+
+    return path
+
+
+def _merge_key(element):
+    """Attributes that must match for elements to be joined"""
+    return tuple(sorted([(name, value) for (name, value) in element.items()
+                         if name not in ('id', 'd')]))
+
+
+def _merge_run(run, paths, decimals):
+    """Join the chains of segments in run, returning the removed elements"""
+    if len(run) < 2:
+        return []
+
+    # Chains are [elements, path]; heads/tails index them by end point
+    chains = []
+    heads = {}
+    tails = {}
+    for element in run:
+        chain = [[element], list(paths[element])]
+
+        following = heads.pop(_end(chain[1]), None)
+        if following is not None:
+            if tails.get(_end(following[1])) is following:
+                del tails[_end(following[1])]
+            chain[0].extend(following[0])
+            chain[1].extend(following[1][1:])
+            following[0] = []
+
+        preceding = tails.pop(_start(chain[1]), None)
+        if preceding is not None and preceding[0]:
+            if heads.get(_start(preceding[1])) is preceding:
+                del heads[_start(preceding[1])]
+            preceding[0].extend(chain[0])
+            preceding[1].extend(chain[1][1:])
+            chain = preceding
+        else:
+            chains.append(chain)
+
+        heads[_start(chain[1])] = chain
+        tails[_end(chain[1])] = chain
+
+    # Each chain is drawn by its first element in document order
+    order = dict([(element, idx) for (idx, element) in enumerate(run)])
+    removed = []
+    for (elements, path) in chains:
+        if len(elements) < 2:
+            continue
+        elements = sorted(elements, key=lambda element: order[element])
+        elements[0].set('d', compact_segments(path, decimals))
+        for element in elements[1:]:
+            element.getparent().remove(element)
+        removed.extend(elements[1:])
+
+    return removed
+
+
+def _start(path):
+    return tuple(path[0][1][-2:])
+
+
+def _end(path):
+    return tuple(path[-1][1][-2:])
+
+
+def _unique(items):
+    """Items without repetitions, keeping order"""
+    seen = set()
+    unique = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            unique.append(item)
+
+    return unique
@@ -0,0 +1,46 @@
+"""Tests of incremental re-runs (see test_traces.py to run them)"""
+
+import os, sys, shutil, tempfile, unittest
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+import inkex
+from pdf2pub import pdf2pub
+
+
+test_figure = os.path.join(root_dir, 'pdf2pub_test.svg')
+options = ['--geometry=python', '--cache=false', '--incremental=true']
+
+
+class IncrementalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_pdf2pub(self, filename, args, output):
+        effect = pdf2pub()
+        effect.affect(args=options + args + [filename], output=False)
+        effect.document.write(output)
+        return effect.document.getroot()
+
+    def test_css_classes(self):
+        # The style sheet of the first run is replaced, not overridden
+        first = os.path.join(self.directory, 'first.svg')
+        second = os.path.join(self.directory, 'second.svg')
+        self.run_pdf2pub(test_figure, ['--css_classes=true', '--color_pal=original'], first)
+        root_node = self.run_pdf2pub(first, ['--css_classes=true', '--color_pal=brewer_set1'], second)
+
+        sheets = list(root_node.iter(inkex.addNS('style', 'svg'), 'style'))
+        self.assertEqual(len(sheets), 1)
+        self.assertTrue('stroke:#e41a1c' in sheets[0].text.split('.pdf2pub-stroke2')[0])
+        for element in root_node.iter():
+            if isinstance(element.tag, str) and element.get('class') is not None:
+                names = element.get('class').split()
+                self.assertEqual(len(names), len(set(names)))
+
+
+if __name__ == '__main__':
+    unittest.main()
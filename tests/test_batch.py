@@ -0,0 +1,36 @@
+"""Tests of pdf2pub_batch (see test_traces.py to run them)"""
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pdf2pub_batch import figure_args
+
+
+class FigureArgsTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+        for name in ('PDF2PUB_STATS', 'PDF2PUB_PROFILE'):
+            os.environ.pop(name, None)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def test_files(self):
+        # Parallel figures write their statistics to different files
+        args = ['--format=half', '--stats=out/stats.json', '--profile=prof.out']
+        self.assertEqual(figure_args(args, 'figures/plot.svg'),
+                         ['--format=half', '--stats=out/stats.plot.json', '--profile=prof.plot.out'])
+
+    def test_standard_error(self):
+        args = ['--stats=-', '--profile=']
+        self.assertEqual(figure_args(args, 'plot.svg'), args)
+
+    def test_environment(self):
+        os.environ['PDF2PUB_STATS'] = 'stats.json'
+        self.assertEqual(figure_args(['--stats='], 'plot.svg'), ['--stats=stats.plot.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""Tests of pdf2pub_daemon (see test_traces.py to run them)"""
+
+import os, sys, time, shutil, tempfile, threading, subprocess, unittest
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+from pdf2pub_daemon import Pdf2pubServer, submit
+
+
+class ServeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'pdf2pub.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_second_server(self):
+        # A second daemon on the same socket exits and leaves the first
+        # one running (instead of taking its socket over)
+        server = Pdf2pubServer(self.path, 1)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            second = subprocess.Popen([sys.executable, os.path.join(root_dir, 'pdf2pub_daemon.py'),
+                                       'serve', '--socket=%s' % self.path, '--jobs=1'],
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            deadline = time.time() + 30
+            while second.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if second.poll() is None:
+                second.terminate()
+                second.wait()
+                self.fail('Second daemon took over the socket')
+            self.assertNotEqual(second.returncode, 0)
+
+            self.assertTrue(os.path.exists(self.path))
+            reply = submit([{'id': 1}], self.path)[0]
+            self.assertEqual(reply['id'], 1)
+            self.assertFalse(reply['ok'])
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""Tests of pdf2pub_geometry (see test_traces.py to run them)"""
+
+import os, sys, math, stat, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lxml import etree
+
+from pdf2pub_geometry import path_endpoints, query_inkscape
+
+
+class PathEndpointsTest(unittest.TestCase):
+    def endpoints(self, d):
+        return [float(x) for x in path_endpoints([etree.Element('path', d=d)])[0]]
+
+    def test_lines(self):
+        self.assertEqual(self.endpoints('M 1,2 3,4'), [1, 2, 3, 4])
+        self.assertEqual(self.endpoints('m 1,2 3,4'), [1, 2, 4, 6])
+        self.assertEqual(self.endpoints('M 1,2 H 3'), [1, 2, 3, 2])
+        self.assertEqual(self.endpoints('m 1,2 v 3'), [1, 2, 1, 5])
+
+    def test_incomplete_line(self):
+        # A single coordinate after the move is not a H or V
+        self.assertTrue(all([math.isnan(x) for x in self.endpoints('M 1,2 3')]))
+
+
+class QueryInkscapeTest(unittest.TestCase):
+    def setUp(self):
+        # A fake inkscape that records its arguments
+        self.directory = tempfile.mkdtemp()
+        inkscape = os.path.join(self.directory, 'inkscape')
+        with open(inkscape, 'w') as f:
+            f.write('#!/bin/sh\nprintf "%s\\n" "$@" > "$(dirname "$0")/args"\n'
+                    'echo svg1,0,0,10,10\n')
+        os.chmod(inkscape, stat.S_IRWXU)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.directory + os.pathsep + self.path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.directory)
+
+    def test_file_name(self):
+        # File names are not interpreted by a shell
+        filename = os.path.join(self.directory, 'my "figure" $(touch pwned).svg')
+        allpos = query_inkscape(filename)
+
+        self.assertEqual(allpos, 'svg1,0,0,10,10\n')
+        self.assertTrue(isinstance(allpos, str))
+        with open(os.path.join(self.directory, 'args')) as f:
+            self.assertEqual(f.read().splitlines(), ['--query-all', filename])
+        self.assertFalse(os.path.exists('pwned'))
+
+
+if __name__ == '__main__':
+    unittest.main()
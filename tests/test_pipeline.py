@@ -0,0 +1,112 @@
+"""Tests of pdf2pub_pipeline (see test_traces.py to run them)"""
+
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lxml import etree
+
+import inkex
+from simplestyle import parseStyle
+from simplepath import parsePath
+from simpletransform import parseTransform
+from pdf2pub_pipeline import flatten_groups, run_command
+
+
+svg_ns = inkex.NSS['svg']
+
+figure = '''<svg xmlns="http://www.w3.org/2000/svg">
+  <defs>
+    <clipPath id="clip1" clipPathUnits="userSpaceOnUse">
+      <path id="clip1-path" d="M 0,0 10,0 10,10 0,10 z"/>
+    </clipPath>
+    <clipPath id="clip2" clipPathUnits="userSpaceOnUse">
+      <path d="M 0,0 5,0 5,5 0,5 z"/>
+    </clipPath>
+    <marker id="marker1">
+      <g id="marker-group" transform="scale(2)"><path id="marker-path" d="M 0,0 1,1"/></g>
+    </marker>
+  </defs>
+  <g id="group" clip-path="url(#clip1)" fill="#ff0000" style="opacity:0.5">
+    <path id="path1" d="M 1,1 2,2" style="stroke:#000000"/>
+    <path id="path2" d="M 1,1 2,2" fill="#00ff00" opacity="0.5" clip-path="url(#clip2)"/>
+  </g>
+  <g id="moved" transform="translate(10,20)" clip-path="url(#clip1)">
+    <path id="path3" d="M 1,1 2,2"/>
+  </g>
+  <g id="symbol" transform="translate(5,5)">
+    <g id="symbol-part"><path id="symbol-path" d="M 0,0 1,1"/></g>
+  </g>
+  <use id="copy" xlink:href="#symbol" xmlns:xlink="http://www.w3.org/1999/xlink"/>
+</svg>'''
+
+
+class FlattenGroupsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = etree.fromstring(figure)
+        flatten_groups(self.root)
+        self.elements = dict([(element.get('id'), element) for element in self.root.iter()])
+
+    def clip_path(self, element):
+        return self.elements[element.get('clip-path')[5:-1]]
+
+    def test_presentation_attributes(self):
+        self.assertEqual(parseStyle(self.elements['path1'].get('style')),
+                         {'stroke': '#000000', 'fill': '#ff0000', 'opacity': '0.5'})
+        # The children's own attributes win, and opacities multiply
+        self.assertEqual(parseStyle(self.elements['path2'].get('style')), {'opacity': '0.25'})
+        self.assertEqual(self.elements['path2'].get('fill'), '#00ff00')
+        self.assertEqual(self.elements['path2'].get('opacity'), None)
+
+    def test_clip_path(self):
+        self.assertEqual(self.elements['path1'].get('clip-path'), 'url(#clip1)')
+
+        # Clip paths of children clip the copy of the group's
+        clip = self.clip_path(self.elements['path2'])
+        self.assertNotEqual(clip.get('id'), 'clip1')
+        self.assertEqual(clip.get('clip-path'), 'url(#clip2)')
+        self.assertEqual(clip[0].get('d'), 'M 0,0 10,0 10,10 0,10 z')
+        self.assertEqual(clip[0].get('id'), None)
+
+    def test_transformed_clip_path(self):
+        # Transforms are baked into the path, and the clip path follows
+        path = self.elements['path3']
+        self.assertEqual(parsePath(path.get('d')), [['M', [11, 21]], ['L', [12, 22]]])
+        self.assertEqual(path.get('transform'), None)
+        self.assertEqual(parseTransform(self.clip_path(path).get('transform')),
+                         [[1, 0, 10], [0, 1, 20]])
+        self.assertFalse('moved' in self.elements)
+
+    def test_kept_groups(self):
+        # Groups in definitions and groups used elsewhere keep their contents
+        for name in ('marker-group', 'symbol', 'symbol-part'):
+            self.assertTrue(name in self.elements)
+        self.assertEqual(self.elements['marker-group'].get('transform'), 'scale(2)')
+        self.assertEqual(self.elements['symbol-path'].get('d'), 'M 0,0 1,1')
+
+
+class RunCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_file_names(self):
+        # Arguments are passed as they are, without a shell
+        filename = os.path.join(self.directory, 'my "figure" $(touch pwned).pdf')
+        output = os.path.join(self.directory, 'output.txt')
+        run_command(['sh', '-c', 'printf %s "$0" > "$1"', '{input}', '{output}'],
+                    input=filename, output=output)
+
+        with open(output) as f:
+            self.assertEqual(f.read(), filename)
+        self.assertFalse(os.path.exists('pwned'))
+
+    def test_missing_command(self):
+        self.assertRaises(IOError, run_command, ['pdf2pub-missing-command', '{input}'],
+                          input='figure.pdf')
+
+
+if __name__ == '__main__':
+    unittest.main()
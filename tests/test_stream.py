@@ -0,0 +1,71 @@
+"""Tests of pdf2pub_stream (see test_traces.py to run them)"""
+
+import os, sys, io, shutil, tempfile, unittest
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+from lxml import etree
+
+from pdf2pub import pdf2pub
+from pdf2pub_stream import stream_file
+
+
+test_figure = os.path.join(root_dir, 'pdf2pub_test.svg')
+options = ['--color_pal=brewer_set1', '--geometry=python', '--cache=false']
+
+
+def elements(document):
+    """{id: (tag, attributes, text)} and the elements without id"""
+    by_id = {}
+    anonymous = []
+    for element in document.iter():
+        if not isinstance(element.tag, str):
+            continue
+        entry = (element.tag.split('}')[-1], sorted(element.attrib.items()),
+                 (element.text or '').strip())
+        if element.get('id') is None:
+            anonymous.append(entry)
+        else:
+            by_id[element.get('id')] = entry
+    return (by_id, sorted(anonymous))
+
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def compare(self, filename, args):
+        effect = pdf2pub()
+        effect.affect(args=args + [filename], output=False)
+        expected = elements(effect.document.getroot())
+
+        output = io.BytesIO()
+        stream_file(filename, output, args)
+        streamed = elements(etree.fromstring(output.getvalue()))
+
+        self.assertEqual(sorted(expected[0].keys()), sorted(streamed[0].keys()))
+        for key in expected[0]:
+            self.assertEqual(expected[0][key], streamed[0][key], key)
+        self.assertEqual(expected[1], streamed[1])
+
+    def test_figure(self):
+        self.compare(test_figure, options + ['--clip_traces=false'])
+
+    def test_trace_with_text_color(self):
+        # Traces of the same color as the texts are restyled and get a
+        # legend entry, as in normal mode
+        with open(test_figure) as f:
+            figure = f.read().replace('fill:none;stroke:#edb120;', 'fill:#262626;stroke:none;')
+        filename = os.path.join(self.directory, 'figure.svg')
+        with open(filename, 'w') as f:
+            f.write(figure)
+
+        self.compare(filename, options)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+"""Tests of pdf2pub_traces
+
+Run from the repository with Inkscape's extension folder (inkex.py, etc.)
+in the PYTHONPATH:
+
+    python -m unittest discover tests
+"""
+
+import os, re, sys, unittest
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+from lxml import etree
+
+import inkex
+from pdf2pub import pdf2pub, StyleCache
+from pdf2pub_traces import instance_markers, clip_paths, decimate_paths
+from simplepath import parsePath
+
+
+svg_ns = inkex.NSS['svg']
+test_figure = os.path.join(root_dir, 'pdf2pub_test.svg')
+
+
+class InstanceMarkersTest(unittest.TestCase):
+    def make_document(self, count, style):
+        root = etree.Element('{%s}svg' % svg_ns, nsmap={None: svg_ns})
+        defs = etree.SubElement(root, '{%s}defs' % svg_ns)
+        layer = etree.SubElement(root, '{%s}g' % svg_ns)
+        markers = []
+        for k in range(count):
+            markers.append(etree.SubElement(layer, '{%s}path' % svg_ns,
+                id = 'path%d' % (k + 1),
+                style = style,
+                d = 'm %d,10 5,0 0,5 -5,0 z' % (10*k)))
+        return (root, defs, layer, markers)
+
+    def test_stroked_and_filled_markers(self):
+        # Markers with both a stroke and a fill are in curves_stroke and
+        # curves_fill, so they are passed twice
+        (root, defs, layer, markers) = self.make_document(6, 'fill:#77ac30;stroke:#77ac30')
+        (instances, last_id) = instance_markers(markers + markers, StyleCache(), defs, 100)
+
+        self.assertEqual(len(instances), 6)
+        self.assertEqual(last_id, 102)
+        self.assertEqual(len(defs), 1)
+        self.assertEqual([(child.tag, child.get('id')) for child in layer],
+                         [('use', 'path%d' % (k + 1)) for k in range(6)])
+
+    def test_single_marker(self):
+        (root, defs, layer, markers) = self.make_document(1, 'fill:#77ac30;stroke:none')
+        (instances, last_id) = instance_markers(markers, StyleCache(), defs, 100)
+
+        self.assertEqual(instances, {})
+        self.assertEqual(last_id, 100)
+        self.assertEqual(len(defs), 0)
+
+
+class ClipPathsTest(unittest.TestCase):
+    frame = (0, 0, 100, 100)
+
+    def make_path(self, parent, d, transform=None):
+        path = etree.SubElement(parent, '{%s}path' % svg_ns,
+            style = 'fill:none;stroke:#0072bd;stroke-width:1;clip-path:url(#clipPath1)',
+            d = d)
+        if transform is not None:
+            path.set('transform', transform)
+        return path
+
+    def test_closed_subpath(self):
+        # Subpaths inside of the frame keep their closepath
+        root = etree.Element('{%s}svg' % svg_ns, nsmap={None: svg_ns})
+        path = self.make_path(root, 'M 10,10 20,10 20,20 z M 50,50 150,50')
+        (removed, clipped, crossing) = clip_paths([path], self.frame, StyleCache(), 2)
+
+        self.assertEqual(clipped, set([path]))
+        self.assertEqual([cmd for (cmd, params) in parsePath(path.get('d'))],
+                         ['M', 'L', 'L', 'Z', 'M', 'L'])
+        self.assertEqual(parsePath(path.get('d'))[-1], ['L', [100, 50]])
+
+    def test_transformed_parent(self):
+        # Boxes are compared in document coordinates
+        root = etree.Element('{%s}svg' % svg_ns, nsmap={None: svg_ns})
+        group = etree.SubElement(root, '{%s}g' % svg_ns, transform='translate(-200,0)')
+        inside = self.make_path(group, 'M 210,10 220,20')
+        outside = self.make_path(root, 'M 210,10 220,20')
+        across = self.make_path(group, 'M 210,10 400,20')
+        (removed, clipped, crossing) = clip_paths([inside, outside, across], self.frame,
+                                                   StyleCache(), 2)
+
+        self.assertEqual(removed, set([outside]))
+        self.assertEqual(clipped, set())
+        self.assertEqual(crossing, set([across]))
+        self.assertEqual(inside.get('d'), 'M 210,10 220,20')
+
+    def test_transformed_path(self):
+        # Rotated paths cannot be cut, they are clipped instead
+        root = etree.Element('{%s}svg' % svg_ns, nsmap={None: svg_ns})
+        path = self.make_path(root, 'M -50,10 -50,200', 'matrix(0,-1,1,0,0,0)')
+        (removed, clipped, crossing) = clip_paths([path], self.frame, StyleCache(), 2)
+
+        self.assertEqual(crossing, set([path]))
+        self.assertEqual(path.get('d'), 'M -50,10 -50,200')
+
+
+class DecimatePathsTest(unittest.TestCase):
+    def test_rounded_path_data(self):
+        root = etree.Element('{%s}svg' % svg_ns, nsmap={None: svg_ns})
+        d = 'M 174.3772,10.1 ' + ' '.join(['%r,%r' % (174.3772 + 0.1*k, 10.1 + 0.001*k*k)
+                                           for k in range(1, 100)])
+        path = etree.SubElement(root, '{%s}path' % svg_ns, style='fill:none;stroke:#0072bd', d=d)
+        (before, after) = decimate_paths([path], 0.1, (1, 1), StyleCache(), 2)
+
+        self.assertTrue(after < before)
+        self.assertTrue(path.get('d').startswith('M174.38 10.1'))
+        self.assertTrue(all([len(number.split('.')[-1]) <= 2
+                             for number in re.findall(r'[\d.]+', path.get('d'))]))
+
+    def test_smaller_output(self):
+        # Decimated figures are smaller, not only in points
+        sizes = []
+        for args in ([], ['--decimate=true', '--decimate_tolerance=0.1']):
+            effect = pdf2pub()
+            effect.affect(args=['--geometry=python', '--cache=false'] + args + [test_figure],
+                          output=False)
+            sizes.append(len(etree.tostring(effect.document)))
+
+        self.assertTrue(sizes[1] < sizes[0])
+
+
+if __name__ == '__main__':
+    unittest.main()